@@ -0,0 +1,321 @@
+"""
+This module contains the in-process caches used by the API.
+
+The caches are per process: with several gunicorn workers every worker has its own, only the
+results cache can be shared through MongoDb, see MongoCacheBackend.
+
+Classes:
+    ResultCache: LRU cache of analysis results, concurrent misses share a single fetch.
+    MongoCacheBackend: Results cache shared by the worker processes, stored in MongoDb.
+    EncodedCache: LRU cache of encoded responses and their ETag, bounded by entries and bytes.
+
+Functions:
+    normalize_url: Normalize an URL so that equivalent URLs share the same cache key.
+    etag_matches: Return True if the If-None-Match header matches the given ETag.
+"""
+
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+import time
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit, urlunsplit
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+from app.models.database import RequestModel
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Ports omitted from normalized URLs
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """Normalize an URL so that equivalent URLs share the same cache key.
+
+    The scheme and the host are lowercased, the default port and the fragment are removed
+    and an empty path becomes "/".
+
+    Args:
+        url (str): The URL to normalize.
+
+    Returns:
+        str: The normalized URL, or the URL itself if it can not be parsed.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url
+    if ':' in host:
+        host = f'[{host}]'
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f'{host}:{port}'
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = f'{userinfo}:{parts.password}'
+        netloc = f'{userinfo}@{netloc}'
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+class MongoCacheBackend:
+    """Results cache shared by the worker processes, stored in a MongoDb collection.
+
+    Entries expire through a TTL index on stored_at, see app/database.py.
+    Errors of MongoDb are logged and handled as misses: the shared cache is optional.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    @staticmethod
+    def _id(key: tuple) -> str:
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    async def get(self, key: tuple, max_age: float) -> tuple[RequestModel, float] | None:
+        """Return the cached result and its age in seconds, if not older than max_age."""
+        now = datetime.now(timezone.utc)
+        try:
+            entry = await self.collection.find_one({
+                '_id': self._id(key),
+                'stored_at': {'$gte': now - timedelta(seconds=max_age)}
+            })
+        except PyMongoError:
+            logger.exception('Shared results cache read failed')
+            return None
+        if entry is None:
+            return None
+        return RequestModel(**entry['record']), (now - entry['stored_at']).total_seconds()
+
+    async def set(self, key: tuple, record: RequestModel) -> None:
+        """Store a result, replacing the previous one of the same key."""
+        entry_id = self._id(key)
+        try:
+            await self.collection.replace_one({'_id': entry_id}, {
+                '_id': entry_id,
+                'stored_at': datetime.now(timezone.utc),
+                'record': record.to_document()
+            }, upsert=True)
+        except PyMongoError:
+            logger.exception('Shared results cache write failed')
+
+
+class ResultCache:
+    """LRU cache of analysis results, keyed on the HTTP method and the normalized URL.
+
+    Concurrent misses of the same key share a single fetch (single-flight) instead of
+    running the same redirect chain many times. With a shared backend, the results are
+    also shared with the other worker processes.
+    """
+
+    def __init__(self, max_size: int, shared: MongoCacheBackend | None = None):
+        self.max_size = max_size
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        # key -> (time the result was stored, result)
+        self._entries: OrderedDict[tuple, tuple[float, RequestModel]] = OrderedDict()
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+
+    @staticmethod
+    def key(method: str, url: str, *options) -> tuple:
+        """Return the cache key of the given method, URL and request options."""
+        return method.upper(), normalize_url(url), *options
+
+    def get(self, key: tuple, max_age: float) -> RequestModel | None:
+        """Return the cached result if it is not older than max_age seconds."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > max_age:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: tuple, record: RequestModel, age: float = 0) -> None:
+        """Store a result, evicting the least recently used one if the cache is full.
+
+        Args:
+            key (tuple): The cache key, see ResultCache.key.
+            record (RequestModel): The result.
+            age (float, optional): Seconds since the result was produced.
+        """
+        self._entries[key] = (time.monotonic() - age, record)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def store(self, key: tuple, record: RequestModel) -> None:
+        """Store a new result, in the shared backend too if any."""
+        self.set(key, record)
+        if self.shared is not None:
+            await self.shared.set(key, record)
+
+    def clear(self) -> None:
+        """Remove every entry and reset the counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the size and the hit/miss counters of the cache."""
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    async def get_or_fetch(
+                self,
+                key: tuple,
+                max_age: float,
+                fetch: Callable[[], Awaitable[RequestModel]]
+            ) -> tuple[RequestModel, bool]:
+        """Return the cached result, or fetch it sharing the fetch with concurrent callers.
+
+        Args:
+            key (tuple): The cache key, see ResultCache.key.
+            max_age (float): Maximum age in seconds of an acceptable cached result.
+            fetch (Callable[[], Awaitable[RequestModel]]): Coroutine function producing the result.
+
+        Returns:
+            tuple[RequestModel, bool]: The result and whether it was produced by another request.
+        """
+        record = self.get(key, max_age)
+        if record is not None:
+            self.hits += 1
+            return record, True
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.hits += 1
+            return await asyncio.shield(in_flight), True
+
+        in_flight = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = in_flight
+        try:
+            shared = None if self.shared is None else await self.shared.get(key, max_age)
+            if shared is not None:
+                # Produced by another worker process
+                self.hits += 1
+                record, age = shared
+                self.set(key, record, age)
+                in_flight.set_result(record)
+                return record, True
+            self.misses += 1
+            record = await fetch()
+        except Exception as exc:
+            in_flight.set_exception(exc)
+            # Mark the exception as retrieved when no other request is waiting for it
+            in_flight.exception()
+            raise
+        except BaseException:
+            in_flight.cancel()
+            raise
+        finally:
+            del self._in_flight[key]
+        self.set(key, record)
+        in_flight.set_result(record)
+        if self.shared is not None:
+            await self.shared.set(key, record)
+        return record, False
+
+
+class EncodedCache:
+    """LRU cache of encoded responses and their ETag, bounded by entries and total bytes.
+
+    An entry can expire at a given time, e.g. when the result it encodes may be compacted by
+    another process, see app/retention.py.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (body, etag, expiration time.time() or None)
+        self._entries: OrderedDict[str, tuple[bytes, str, float | None]] = OrderedDict()
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        """Return the strong ETag of the given body."""
+        return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        """Return the cached (body, etag) of the given key, if any."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            self.discard(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[:2]
+
+    def set(self, key: str, body: bytes, expires: float | None = None) -> tuple[bytes, str]:
+        """Store an encoded response, evicting the least recently used ones if the cache is full.
+
+        Bodies larger than the whole cache and already expired ones are not stored.
+
+        Args:
+            key (str): The key of the response.
+            body (bytes): The encoded response.
+            expires (float | None, optional): The time.time() after which the entry is not
+                                              served anymore, None to keep it until evicted.
+
+        Returns:
+            tuple[bytes, str]: The body and its ETag.
+        """
+        etag = self.etag(body)
+        self.discard(key)
+        if len(body) > self.max_bytes or (expires is not None and expires <= time.time()):
+            return body, etag
+        self._entries[key] = (body, etag, expires)
+        self.size_bytes += len(body)
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, (evicted, _, _) = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted)
+        return body, etag
+
+    def discard(self, key: str) -> None:
+        """Remove the given key from the cache, if present."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[0])
+
+    def clear(self) -> None:
+        """Remove every entry and reset the counters."""
+        self._entries.clear()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the size and the hit/miss counters of the cache."""
+        return {'size': len(self._entries), 'bytes': self.size_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Return True if the If-None-Match header matches the given ETag.
+
+    Args:
+        if_none_match (str | None): Value of the If-None-Match request header.
+        etag (str): The current ETag of the resource.
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    # Weak comparison, as required for If-None-Match
+    return '*' in candidates or etag in (candidate.removeprefix('W/') for candidate in candidates)
+
+
+# Results of the latest analyses
+result_cache = ResultCache(max_size=settings['RESULT_CACHE_MAX_SIZE'])
+
+# Encoded results served by GET /api/HTTP/{uid}
+view_cache = EncodedCache(
+    max_entries=settings['VIEW_CACHE_MAX_ENTRIES'],
+    max_bytes=settings['VIEW_CACHE_MAX_BYTES']
+)
@@ -0,0 +1,181 @@
+"""
+This module contains the deduplicated storage of the redirect chains, see RESULTS_DEDUP.
+
+The same URL checked again usually follows the same redirect chain: the same requests, and
+responses with the same versions, status codes, headers and bodies. Only the timings, the
+connection reuse and a few headers like Date change. The stable part of a chain is stored
+once in the chains collection, with the hash of its content as _id, and every result keeps
+a reference to it and the volatile part of its responses, with the positions of the volatile
+headers among all the headers so that they are rebuilt in the captured order:
+
+    results: {"_id": ..., "created_at": ..., "summary": {...}, "chain": "9f86...", "data": {
+              "url": {...}, "response": [{"timings": {...}, "headers": [2, "Mon, ..."],
+                                          "header_positions": [1]}]}}
+    chains:  {"_id": "9f86...", "last_seen": ..., "data": {"request": [...], "response": [
+              {"http_version": "HTTP/1.1", "status_code": 301, "headers": [4, "/home"]}]}}
+
+The URL stays in the results, it is filtered and indexed. The last_seen date of a chain is
+the creation date of its newest result: chains expire with the results referencing them.
+
+Functions:
+    store: Store the chains of the given result documents, return the documents to insert.
+    expand: Return the given result documents with their chains.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from app import headers, metrics
+from app.settings import settings
+
+# Headers changing at every request, kept in the results instead of the chains
+VOLATILE_HEADERS = frozenset(
+    headers.canonical_name(name) for name in settings['RESULTS_DEDUP_VOLATILE_HEADERS'])
+
+# Fields of a response changing at every request, kept in the results
+VOLATILE_FIELDS = ('timings', 'connection_reused')
+
+
+def _split_headers(stored: list) -> tuple[list, list, list[int]]:
+    """Split the stored headers of a response into the stable and the volatile ones, and
+    return the positions of the volatile ones among all the headers."""
+    stable, volatile, positions = [], [], []
+    for position, (name, value) in enumerate(zip(stored[::2], stored[1::2])):
+        canonical = headers.HEADER_NAMES[name] if isinstance(name, int) else name
+        if canonical in VOLATILE_HEADERS:
+            volatile.extend((name, value))
+            positions.append(position)
+        else:
+            stable.extend((name, value))
+    return stable, volatile, positions
+
+
+def _merge_headers(stable: list, volatile: list, positions: list[int] | None) -> list:
+    """Return the stored headers of a response in the captured order, see _split_headers.
+
+    The volatile headers of results stored without their positions come last.
+    """
+    if not positions:
+        return stable + volatile
+    volatile_at = dict(zip(positions, zip(volatile[::2], volatile[1::2])))
+    stable_pairs = zip(stable[::2], stable[1::2])
+    merged = []
+    for position in range((len(stable) + len(volatile)) // 2):
+        merged.extend(volatile_at[position] if position in volatile_at else next(stable_pairs))
+    return merged
+
+
+def _hash(chain: dict) -> str:
+    """Return the hash of the content of a chain, its _id."""
+    encoded = json.dumps(chain, sort_keys=True, separators=(',', ':'), default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def split(document: dict) -> tuple[dict, dict | None]:
+    """Split a result document into the result to store and its chain.
+
+    Args:
+        document (dict): The result document, see RequestModel.to_document.
+
+    Returns:
+        tuple[dict, dict | None]: The result referencing its chain and the content of the
+                                  chain, or the document as is and None if it has no chain.
+    """
+    data = document.get('data')
+    if not data or not data.get('response'):
+        return document, None
+    stable_responses, volatile_responses = [], []
+    for response in data['response']:
+        stable = {key: value for key, value in response.items() if key not in VOLATILE_FIELDS}
+        volatile = {key: response[key] for key in VOLATILE_FIELDS if key in response}
+        stable['headers'], volatile['headers'], positions = _split_headers(response['headers'])
+        if positions:
+            volatile['header_positions'] = positions
+        stable_responses.append(stable)
+        volatile_responses.append(volatile)
+    chain = {'request': data['request'], 'response': stable_responses}
+    result = document | {
+        'chain': _hash(chain),
+        'data': {'url': data['url'], 'response': volatile_responses},
+    }
+    return result, chain
+
+
+def _merge(document: dict, chain: dict | None) -> dict:
+    """Return the full result document from the result referencing its chain.
+
+    Results whose chain expired are returned as compacted, see app/retention.py.
+    """
+    document = {key: value for key, value in document.items() if key != 'chain'}
+    data = document['data']
+    if chain is None:
+        document['data'] = {'url': data['url']}
+        document['compacted'] = True
+        return document
+    responses = []
+    for stable, volatile in zip(chain['response'], data['response']):
+        volatile = dict(volatile)
+        merged = _merge_headers(stable['headers'], volatile['headers'],
+                                volatile.pop('header_positions', None))
+        responses.append(stable | volatile | {'headers': merged})
+    document['data'] = {'url': data['url'], 'response': responses, 'request': chain['request']}
+    return document
+
+
+async def store(db: AsyncIOMotorDatabase, documents: list[dict]) -> list[dict]:
+    """Store the chains of the given result documents, with one bulk write.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database of the results.
+        documents (list[dict]): The result documents, see RequestModel.to_document.
+
+    Returns:
+        list[dict]: The result documents to insert, referencing their chain.
+    """
+    results = []
+    # chain _id -> (chain, newest creation date)
+    chains: dict[str, tuple[dict, datetime]] = {}
+    for document in documents:
+        result, chain = split(document)
+        results.append(result)
+        if chain is None:
+            continue
+        seen = chains.get(result['chain'], (chain, result['created_at']))[1]
+        chains[result['chain']] = (chain, max(seen, result['created_at']))
+    if chains:
+        with metrics.PHASE_MONGO_INSERT.time():
+            await db.chains.bulk_write([
+                UpdateOne(
+                    {'_id': uid},
+                    {'$setOnInsert': {'data': chain}, '$max': {'last_seen': last_seen}},
+                    upsert=True
+                )
+                for uid, (chain, last_seen) in chains.items()
+            ], ordered=False)
+    return results
+
+
+async def expand(db: AsyncIOMotorDatabase, documents: list[dict]) -> list[dict]:
+    """Return the given result documents with their chains, read with one query.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database of the results.
+        documents (list[dict]): The stored result documents, referencing a chain or not.
+
+    Returns:
+        list[dict]: The full result documents, in the same order.
+    """
+    uids = list({document['chain'] for document in documents if 'chain' in document})
+    if not uids:
+        return documents
+    with metrics.PHASE_MONGO_FIND.time():
+        chains = {
+            chain['_id']: chain['data']
+            async for chain in db.chains.find({'_id': {'$in': uids}})
+        }
+    return [
+        _merge(document, chains.get(document['chain'])) if 'chain' in document else document
+        for document in documents
+    ]
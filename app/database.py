@@ -1,27 +1,492 @@
 """This module contains the database configuration and connection"""
 
+import asyncio
+import logging
 import os
-from pymongo import MongoClient
-
-# Configuration used to connect to MongoDB
-config = {
-    'host': os.environ['MONGO_HOST'],
-    'port': 27017,
-    'user': os.environ['MONGO_USERNAME'],
-    'password': os.environ['MONGO_PASSWORD'],
-    'database': os.environ['MONGO_DB_NAME']
+import time
+from typing import Awaitable, Callable
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, PyMongoError
+from app import chains, metrics, retention, stats
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Environment variables without a default value
+REQUIRED_VARIABLES = ('MONGO_HOST', 'MONGO_USERNAME', 'MONGO_PASSWORD', 'MONGO_DB_NAME')
+
+# Seconds between two attempts to create the indexes while MongoDb is unreachable
+INDEXES_RETRY_DELAY = 5
+
+
+class ConfigurationError(RuntimeError):
+    """Raised at startup when the configuration of the database is incomplete."""
+
+
+# Configuration used to connect to MongoDB, read from the environment by get_config()
+_config: dict | None = None
+
+
+def get_config() -> dict:
+    """Return the configuration used to connect to MongoDb, read on first use.
+
+    Raises:
+        ConfigurationError: If a required environment variable is missing.
+    """
+    global _config  # pylint: disable=global-statement
+    if _config is None:
+        missing = [variable for variable in REQUIRED_VARIABLES if not os.environ.get(variable)]
+        if missing:
+            raise ConfigurationError(
+                f'Missing required environment variables: {", ".join(missing)}')
+        _config = {
+            'host': os.environ['MONGO_HOST'],
+            'port': int(os.environ.get('MONGO_PORT', '27017')),
+            'user': os.environ['MONGO_USERNAME'],
+            'password': os.environ['MONGO_PASSWORD'],
+            'database': os.environ['MONGO_DB_NAME'],
+            'max_pool_size': int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+            # Seconds an operation waits for a reachable server before failing
+            'server_selection_timeout': float(
+                os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT', '5')),
+            # Write-behind buffer: inserts are flushed with insert_many when the buffer is
+            # full, or at most write_behind_max_delay seconds after they were added
+            'write_behind': os.environ.get('MONGO_WRITE_BEHIND', 'false').lower() == 'true',
+            'write_behind_max_size': int(os.environ.get('MONGO_WRITE_BEHIND_MAX_SIZE', '500')),
+            'write_behind_max_delay': float(
+                os.environ.get('MONGO_WRITE_BEHIND_MAX_DELAY', '1')),
+        }
+    return _config
+
+# Indexes of the collections, created at startup: (keys, options)
+INDEXES = {
+    # Every filter of GET /api/HTTP has an index ending with its sort order
+    'results': [
+        ([('created_at', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('data.url.domain', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('summary.status_code', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+         {}),
+        ([('data.url.domain', ASCENDING), ('summary.status_code', ASCENDING),
+          ('created_at', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('monitor', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+         {'partialFilterExpression': {'monitor': {'$exists': True}}}),
+    ],
+    # Monitors changed since the last sync, deleted ones are removed a day later,
+    # see app/monitors.py
+    'monitors': [
+        ([('updated_at', ASCENDING)], {}),
+        ([('deleted_at', ASCENDING)], {'expireAfterSeconds': 24 * 3600}),
+    ],
+    # Results cache shared by the workers, see app/cache.py
+    'result_cache': [
+        ([('stored_at', ASCENDING)], {'expireAfterSeconds': int(settings['RESULT_CACHE_MAX_AGE'])}),
+    ],
+    # Hourly statistics of the domains, see app/stats.py
+    'domain_stats_hourly': [
+        ([('domain', ASCENDING), ('hour', ASCENDING)], {}),
+        ([('hour', ASCENDING)], {'expireAfterSeconds': int(settings['STATS_HOURLY_TTL'])}),
+    ],
 }
 
-client = MongoClient(
-    config['host'],
-    config['port'],
-    username=config['user'],
-    password=config['password']
-)
+# Retention of the results: expiration, and the results not compacted yet, see app/retention.py
+if settings['RESULTS_TTL'] > 0:
+    INDEXES['results'].append(
+        ([('created_at', ASCENDING)], {'expireAfterSeconds': settings['RESULTS_TTL']}))
+if settings['RESULTS_COMPACT_AFTER'] > 0:
+    INDEXES['results'].append(
+        ([('created_at', ASCENDING), ('_id', ASCENDING)],
+         {'partialFilterExpression': retention.COMPACTABLE}))
+# Chains expire once their results are compacted or deleted, see app/chains.py
+if settings['RESULTS_COMPACT_AFTER'] > 0 or settings['RESULTS_TTL'] > 0:
+    INDEXES['chains'] = [
+        ([('last_seen', ASCENDING)],
+         {'expireAfterSeconds': settings['RESULTS_COMPACT_AFTER'] or settings['RESULTS_TTL']}),
+    ]
+
+# Fields of the results listed by GET /api/HTTP
+SUMMARY_PROJECTION = {'created_at': 1, 'state': 1, 'status': 1, 'data.url': 1, 'summary': 1,
+                      'compacted': 1}
+
+# Error code of create_index when the index exists with other options
+INDEX_OPTIONS_CONFLICT = 85
+
+# Error code of a write whose _id is already stored
+DUPLICATE_KEY = 11000
+
+# The client is bound to the event loop it is first used in, see connect()
+client: AsyncIOMotorClient | None = None
+
+
+class WriteBehindBuffer:  # pylint: disable=too-many-instance-attributes
+    """Buffer of documents to insert, flushed with insert_many on size or time triggers.
+
+    Buffered documents can be read back with get() until they are flushed.
+    """
+
+    def __init__(
+                self,
+                max_size: int,
+                max_delay: float,
+                on_insert: Callable[[AsyncIOMotorCollection, list[dict]], Awaitable[None]]
+                | None = None,
+                prepare: Callable[[AsyncIOMotorCollection, list[dict]], Awaitable[list[dict]]]
+                | None = None
+            ):
+        """
+        Args:
+            max_size (int): Number of buffered documents that triggers a flush.
+            max_delay (float): Maximum seconds a document stays in the buffer.
+            on_insert (Callable, optional): Called with the collection and the documents
+                                            inserted by every flush.
+            prepare (Callable, optional): Called with the collection and the documents to
+                                          insert, returns the documents actually inserted
+                                          in the same order.
+        """
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.on_insert = on_insert
+        self.prepare = prepare
+        # collection full name -> (collection, documents to insert)
+        self._pending: dict[str, tuple[AsyncIOMotorCollection, list[dict]]] = {}
+        self._size = 0
+        self._flushing: list[dict[str, tuple[AsyncIOMotorCollection, list[dict]]]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._timer_task: asyncio.Task | None = None
+        self._stopping: asyncio.Event | None = None
+
+    def start(self) -> None:
+        """Start the task that flushes the buffer every max_delay seconds."""
+        self._stopping = asyncio.Event()
+        self._timer_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Stop the periodic flush and flush the remaining documents."""
+        if self._timer_task is not None:
+            self._stopping.set()
+            await self._timer_task
+            self._timer_task = None
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
 
+    def add(self, collection: AsyncIOMotorCollection, documents: list[dict]) -> None:
+        """Add documents to insert, the buffer is flushed in background when it is full."""
+        self._pending.setdefault(collection.full_name, (collection, []))[1].extend(documents)
+        self._size += len(documents)
+        if self._size >= self.max_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
 
-def get_db():
+    def get(self, collection: AsyncIOMotorCollection, uid: str) -> dict | None:
+        """Return the buffered document with the given _id, if any."""
+        for pending in (self._pending, *self._flushing):
+            _, documents = pending.get(collection.full_name, (None, []))
+            for document in documents:
+                if document['_id'] == uid:
+                    return document
+        return None
+
+    async def flush(self) -> None:
+        """Insert every buffered document, one insert_many per collection.
+
+        Documents that could not be inserted because MongoDb is unreachable are buffered again.
+        Documents already stored, by a previous flush whose outcome was unknown, are skipped;
+        the documents refused for another reason are logged and dropped.
+        """
+        pending, self._pending, self._size = self._pending, {}, 0
+        # Flushing documents are still readable with get() until they are inserted
+        self._flushing.append(pending)
+        try:
+            for collection, documents in pending.values():
+                try:
+                    inserted = documents
+                    if self.prepare is not None:
+                        inserted = await self.prepare(collection, documents)
+                    with metrics.PHASE_MONGO_INSERT.time():
+                        await collection.insert_many(inserted, ordered=False)
+                except BulkWriteError as exc:
+                    # The other documents were inserted, the refused ones would be refused again
+                    failed = set()
+                    for error in exc.details.get('writeErrors', []):
+                        if error['code'] == DUPLICATE_KEY:
+                            continue
+                        failed.add(error['index'])
+                        logger.error('Write-behind insert of %s into %s failed: %s (code %s)',
+                                     documents[error['index']]['_id'], collection.full_name,
+                                     error.get('errmsg'), error['code'])
+                    documents = [document for index, document in enumerate(documents)
+                                 if index not in failed]
+                except PyMongoError:
+                    logger.exception('Write-behind flush of %s failed, retrying later',
+                                     collection.full_name)
+                    self.add(collection, documents)
+                    continue
+                if self.on_insert is not None:
+                    await self.on_insert(collection, documents)
+        finally:
+            self._flushing.remove(pending)
+
+    async def _flush_periodically(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+
+# Created at startup when MONGO_WRITE_BEHIND is enabled
+write_buffer: WriteBehindBuffer | None = None
+
+# Task creating the indexes at startup, see startup()
+_indexes_task: asyncio.Task | None = None
+
+# Initialization progress, reported by the readiness probe
+state = {'indexes': False}
+
+
+def connect() -> AsyncIOMotorClient:
+    """Create the MongoDb client, bound to the running event loop
+
+    Returns:
+        AsyncIOMotorClient: The client.
+    """
+    global client  # pylint: disable=global-statement
+    config = get_config()
+    client = AsyncIOMotorClient(
+        config['host'],
+        config['port'],
+        username=config['user'],
+        password=config['password'],
+        maxPoolSize=config['max_pool_size'],
+        serverSelectionTimeoutMS=int(config['server_selection_timeout'] * 1000),
+        tz_aware=True
+    )
+    return client
+
+
+def get_db() -> AsyncIOMotorDatabase:
     """Return the MongoDb database instance
     """
-    db = client[config['database']]
+    if client is None:
+        connect()
+    db = client[get_config()['database']]
     return db
+
+
+async def create_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the indexes of the collections.
+
+    Existing indexes are left untouched, except for the expiration of the TTL indexes
+    that is updated when its setting changes.
+    """
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection_name].create_index(keys, **options)
+            except OperationFailure as exc:
+                if exc.code != INDEX_OPTIONS_CONFLICT or 'expireAfterSeconds' not in options:
+                    raise
+                await db.command('collMod', collection_name, index={
+                    'keyPattern': dict(keys),
+                    'expireAfterSeconds': options['expireAfterSeconds']
+                })
+
+
+def _reset_after_fork() -> None:
+    """Forget the client and the buffer inherited from the parent process, MongoClient is not
+    fork-safe: every worker connects after the fork, see startup()."""
+    global client, write_buffer, _indexes_task  # pylint: disable=global-statement
+    client = None
+    write_buffer = None
+    _indexes_task = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def _create_indexes_when_reachable() -> None:
+    """Create the indexes, retrying until MongoDb is reachable."""
+    while True:
+        try:
+            await create_indexes(get_db())
+            state['indexes'] = True
+            return
+        except ConnectionFailure:
+            logger.warning('MongoDb is unreachable, indexes will be created when it is back')
+            await asyncio.sleep(INDEXES_RETRY_DELAY)
+        except PyMongoError:
+            logger.exception('Indexes could not be created')
+            return
+
+
+async def ping(timeout: float) -> float:
+    """Ping MongoDb and return the latency in milliseconds.
+
+    Raises:
+        PyMongoError: If MongoDb is unreachable.
+        asyncio.TimeoutError: If MongoDb did not respond within timeout seconds.
+    """
+    if client is None:
+        connect()
+    start = time.perf_counter()
+    await asyncio.wait_for(client.admin.command('ping'), timeout)
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+async def startup() -> None:
+    """Connect to MongoDb, create the indexes and start the write-behind buffer.
+
+    The server starts even if MongoDb is unreachable: the indexes are created in background
+    when it is back and the readiness probe reports it meanwhile.
+
+    Raises:
+        ConfigurationError: If a required environment variable is missing.
+    """
+    global write_buffer, _indexes_task  # pylint: disable=global-statement
+    config = get_config()
+    connect()
+    state['indexes'] = False
+    _indexes_task = asyncio.create_task(_create_indexes_when_reachable())
+    if config['write_behind']:
+        write_buffer = WriteBehindBuffer(
+            config['write_behind_max_size'], config['write_behind_max_delay'],
+            on_insert=_record_stats, prepare=_store_chains)
+        write_buffer.start()
+
+
+async def shutdown() -> None:
+    """Flush the write-behind buffer and close the MongoDb client"""
+    global client, write_buffer, _indexes_task  # pylint: disable=global-statement
+    if _indexes_task is not None:
+        _indexes_task.cancel()
+        _indexes_task = None
+    if write_buffer is not None:
+        await write_buffer.stop()
+        write_buffer = None
+    if client is not None:
+        client.close()
+        client = None
+
+
+async def _record_stats(collection: AsyncIOMotorCollection, documents: list[dict]) -> None:
+    """Roll up the statistics of the results inserted by the write-behind buffer"""
+    if collection.name == 'results':
+        await stats.record(collection.database, documents)
+
+
+async def _store_chains(collection: AsyncIOMotorCollection, documents: list[dict]) -> list[dict]:
+    """Store the chains of the results flushed by the write-behind buffer, see app/chains.py"""
+    if collection.name == 'results' and settings['RESULTS_DEDUP']:
+        return await chains.store(collection.database, documents)
+    return documents
+
+
+async def insert_results(db: AsyncIOMotorDatabase, documents: list[dict]) -> None:
+    """Insert result documents, through the write-behind buffer when it is enabled,
+    and roll up the statistics of their domains, see app/stats.py
+
+    With RESULTS_DEDUP, the redirect chains are stored once in the chains collection and the
+    results reference them, see app/chains.py.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to insert into.
+        documents (list[dict]): The documents to insert.
+    """
+    if not documents:
+        return
+    if write_buffer is not None:
+        write_buffer.add(db.results, documents)
+        return
+    stored = await _store_chains(db.results, documents)
+    with metrics.PHASE_MONGO_INSERT.time():
+        if len(stored) == 1:
+            await db.results.insert_one(stored[0])
+        else:
+            await db.results.insert_many(stored, ordered=False)
+    await stats.record(db, documents)
+
+
+async def save_result(db: AsyncIOMotorDatabase, document: dict) -> None:
+    """Store the result document, replacing the pending one of a background request,
+    and roll up the statistics of its domain
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to write to.
+        document (dict): The document to store.
+    """
+    stored, = await _store_chains(db.results, [document])
+    with metrics.PHASE_MONGO_INSERT.time():
+        await db.results.replace_one({'_id': document['_id']}, stored, upsert=True)
+    await stats.record(db, [document])
+
+
+async def insert_pending(db: AsyncIOMotorDatabase, document: dict) -> None:
+    """Store the pending document of a background request, unless its job already stored
+    the result
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to write to.
+        document (dict): The pending document.
+    """
+    with metrics.PHASE_MONGO_INSERT.time():
+        await db.results.update_one(
+            {'_id': document['_id']}, {'$setOnInsert': document}, upsert=True)
+
+
+async def set_state(db: AsyncIOMotorDatabase, uid: str, new_state: str) -> None:
+    """Update the state of a background request that is not done yet
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to write to.
+        uid (str): The _id of the result.
+        new_state (str): The new state.
+    """
+    await db.results.update_one(
+        {'_id': uid, 'state': {'$ne': 'done'}}, {'$set': {'state': new_state}})
+
+
+async def find_result(db: AsyncIOMotorDatabase, uid: str) -> dict | None:
+    """Return the result document with the given _id, including not yet flushed ones,
+    with its redirect chain when it is stored in the chains collection
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to read from.
+        uid (str): The _id of the result.
+
+    Returns:
+        dict | None: The document, None if it does not exist.
+    """
+    if write_buffer is not None:
+        document = write_buffer.get(db.results, uid)
+        if document is not None:
+            return document
+    with metrics.PHASE_MONGO_FIND.time():
+        document = await db.results.find_one({'_id': uid})
+    if document is None:
+        return None
+    return (await chains.expand(db, [document]))[0]
+
+
+async def find_summaries(db: AsyncIOMotorDatabase, query: dict, limit: int) -> list[dict]:
+    """Return the summary fields of the newest results matching the query
+
+    Results are sorted by created_at and _id, newest first, so that the query is served by
+    the indexes and the next page starts after the last result of the previous one.
+    Results still in the write-behind buffer are listed once they are flushed.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to read from.
+        query (dict): The query of the results.
+        limit (int): Maximum number of results.
+
+    Returns:
+        list[dict]: The documents, with the fields of SUMMARY_PROJECTION only.
+    """
+    with metrics.PHASE_MONGO_FIND.time():
+        cursor = db.results.find(
+            query,
+            SUMMARY_PROJECTION,
+            sort=[('created_at', DESCENDING), ('_id', DESCENDING)],
+            limit=limit
+        )
+        return [document async for document in cursor]
@@ -0,0 +1,36 @@
+"""
+Gunicorn configuration, runs the API in WEB_CONCURRENCY uvicorn worker processes.
+
+The app is imported by every worker after the fork (no preload): the MongoDb client, the
+HTTP client pool, the caches and the background workers are created by the lifespan of
+each worker, see app/main.py.
+
+The in-memory state is per worker: the caches, the host scheduler, the job queue and the
+metrics served by GET /metrics, see the README.
+
+Usage:
+    gunicorn app.main:app -c app/gunicorn_conf.py
+"""
+
+# Gunicorn reads its settings from lowercase module variables
+# pylint: disable=invalid-name
+
+import multiprocessing
+import os
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    """Uvicorn worker sending the same Server header of the single process mode."""
+
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, 'headers': [('server', 'Digitamo/1.2')]}
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '80')}"
+# One worker per core by default
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count())
+worker_class = 'app.gunicorn_conf.Worker'
+preload_app = False
+reload = os.environ.get('RELOAD', 'false').lower() == 'true'
+# Seconds given to the workers to finish the requests and flush the buffers when stopping
+graceful_timeout = 30
@@ -0,0 +1,166 @@
+"""
+This module contains the capture of the response headers and their stored representation.
+
+Header names are matched case-insensitively and shown with their canonical case, so that
+"content-type" sent by HTTP/2 servers and "Content-Type" sent by HTTP/1.1 servers are the
+same header. The captured headers are chosen by HEADERS_CAPTURE: the names listed in
+HEADERS_ALLOW ("allow"), every name but the ones listed in HEADERS_DENY ("deny") or every
+name ("all"). At most HEADERS_MAX_COUNT headers are captured for each response and their
+values are cut at HEADER_VALUE_MAX_LENGTH characters.
+
+Headers are stored as a flat list alternating names and values, and the well-known names
+are replaced by their position in HEADER_NAMES:
+
+    {"Content-Type": "text/html", "X-Cache": "HIT"} -> [0, "text/html", 33, "HIT"]
+
+Classes:
+    HeaderPolicy: Captures the response headers chosen by an allow-list, a deny-list or all.
+
+Functions:
+    canonical_name: Return the canonical case of a header name.
+    compact: Return the stored representation of the headers.
+    expand: Return the headers from their stored representation.
+"""
+
+from functools import lru_cache
+import sys
+from typing import Iterable
+from app.settings import settings
+
+# Well-known response header names, stored as their position in the tuple.
+# Stored documents depend on the positions: names can be appended but never moved or removed.
+HEADER_NAMES = (
+    'Content-Type', 'Content-Length', 'Date', 'Server', 'Location', 'Cache-Control',
+    'Connection', 'Content-Encoding', 'ETag', 'Expires', 'Last-Modified', 'Set-Cookie',
+    'Strict-Transport-Security', 'Vary', 'Accept-Ranges', 'Age', 'Access-Control-Allow-Origin',
+    'Alt-Svc', 'Content-Language', 'Content-Security-Policy', 'Content-Disposition',
+    'Keep-Alive', 'Link', 'Pragma', 'Referrer-Policy', 'Retry-After', 'Transfer-Encoding', 'Via',
+    'WWW-Authenticate', 'X-Content-Type-Options', 'X-Frame-Options', 'X-XSS-Protection',
+    'X-Powered-By', 'X-Cache', 'CF-RAY', 'CF-Cache-Status', 'Permissions-Policy', 'Report-To',
+    'NEL', 'P3P', 'Timing-Allow-Origin', 'X-Request-Id', 'Expect-CT',
+    'Cross-Origin-Opener-Policy', 'Cross-Origin-Embedder-Policy', 'Cross-Origin-Resource-Policy',
+    'Access-Control-Allow-Credentials', 'Access-Control-Allow-Headers',
+    'Access-Control-Allow-Methods', 'Access-Control-Expose-Headers', 'Access-Control-Max-Age',
+    'Content-Range', 'Refresh', 'Trailer', 'Upgrade', 'Warning', 'X-UA-Compatible',
+    'X-DNS-Prefetch-Control', 'X-Served-By', 'X-Cache-Hits', 'X-Timer', 'Server-Timing',
+    'Proxy-Authenticate', 'Content-Location',
+)
+
+# Lowercase name -> canonical name, and canonical name -> position, of the well-known names
+_CANONICAL_NAMES = {name.lower(): name for name in HEADER_NAMES}
+_CODES = {name: code for code, name in enumerate(HEADER_NAMES)}
+
+# Separator of the values of a header sent several times, see RFC 9110 section 5.3
+VALUES_SEPARATOR = ', '
+
+
+@lru_cache(maxsize=4096)
+def canonical_name(name: str) -> str:
+    """Return the canonical case of a header name, "content-type" -> "Content-Type".
+
+    Names that are not well-known are capitalized word by word. The returned names are
+    interned, so the records sharing a header share the same string.
+    """
+    lower = name.lower()
+    canonical = _CANONICAL_NAMES.get(lower)
+    if canonical is None:
+        canonical = sys.intern('-'.join(word.capitalize() for word in lower.split('-')))
+    return canonical
+
+
+class HeaderPolicy:
+    """Captures the response headers chosen by an allow-list, a deny-list or all."""
+
+    def __init__(
+                self,
+                mode: str,
+                allow: Iterable[str] = (),
+                deny: Iterable[str] = (),
+                max_count: int = 64,
+                max_length: int = 1024
+            ):
+        """
+        Args:
+            mode (str): "allow", "deny" or "all".
+            allow (Iterable[str]): Names captured in "allow" mode.
+            deny (Iterable[str]): Names not captured in "deny" mode.
+            max_count (int): Maximum number of headers captured for a response.
+            max_length (int): Maximum length of a captured value.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in ('allow', 'deny', 'all'):
+            raise ValueError(f'Unknown headers capture mode: {mode}')
+        self.mode = mode
+        self.allow = frozenset(canonical_name(name) for name in allow)
+        self.deny = frozenset(canonical_name(name) for name in deny)
+        self.max_count = max_count
+        self.max_length = max_length
+
+    def keeps(self, name: str) -> bool:
+        """Return True if the header with the given canonical name is captured."""
+        if self.mode == 'allow':
+            return name in self.allow
+        if self.mode == 'deny':
+            return name not in self.deny
+        return True
+
+    def capture(self, headers: Iterable[tuple[str, str]]) -> dict[str, str]:
+        """Return the captured headers of a response.
+
+        Args:
+            headers (Iterable[tuple[str, str]]): The (name, value) pairs of the response.
+
+        Returns:
+            dict[str, str]: The captured headers by canonical name, the values of a header
+                            sent several times are joined.
+        """
+        captured: dict[str, str] = {}
+        for name, value in headers:
+            name = canonical_name(name)
+            if not self.keeps(name):
+                continue
+            if name in captured:
+                value = captured[name] + VALUES_SEPARATOR + value
+            elif len(captured) >= self.max_count:
+                continue
+            captured[name] = value[:self.max_length]
+        return captured
+
+
+def compact(headers: dict[str, str]) -> list:
+    """Return the stored representation of the headers, see the module docstring."""
+    stored = []
+    for name, value in headers.items():
+        stored.append(_CODES.get(name, name))
+        stored.append(value)
+    return stored
+
+
+def expand(headers: list | dict) -> dict[str, str]:
+    """Return the headers from their stored representation, dicts are returned as is."""
+    if isinstance(headers, dict):
+        return headers
+    return {
+        HEADER_NAMES[name] if isinstance(name, int) else name: value
+        for name, value in zip(headers[::2], headers[1::2])
+    }
+
+
+# Headers captured by default
+default_policy = HeaderPolicy(
+    mode=settings['HEADERS_CAPTURE'],
+    allow=settings['HEADERS_ALLOW'],
+    deny=settings['HEADERS_DENY'],
+    max_count=settings['HEADERS_MAX_COUNT'],
+    max_length=settings['HEADER_VALUE_MAX_LENGTH']
+)
+
+# Headers captured when a request asks for every header
+all_headers_policy = HeaderPolicy(
+    mode='deny',
+    deny=settings['HEADERS_DENY'],
+    max_count=settings['HEADERS_MAX_COUNT'],
+    max_length=settings['HEADER_VALUE_MAX_LENGTH']
+)
@@ -0,0 +1,92 @@
+"""
+This module contains the in-process queue of the background jobs.
+
+Jobs are run by a fixed pool of worker tasks. The queue is bounded: when it is full new jobs
+are refused with a 429 error instead of piling up in memory, so clients know to back off.
+Jobs are kept in memory only: the jobs still queued when the server stops are lost.
+
+Classes:
+    JobQueue: Bounded queue of jobs run by a pool of worker tasks.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from app import metrics
+from app.models.shared import JSONException
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[None]]
+
+
+class JobQueue:
+    """Bounded queue of jobs run by a pool of worker tasks."""
+
+    def __init__(self, max_size: int, workers: int):
+        self.max_size = max_size
+        self.workers = workers
+        self._queue: asyncio.Queue[Job] | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Start the workers, bound to the running event loop."""
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Stop the workers, the running jobs are cancelled and the queued ones are dropped."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None:
+            metrics.JOBS_QUEUED.dec(self._queue.qsize())
+            self._queue = None
+
+    def submit(self, job: Job) -> None:
+        """Queue a job.
+
+        Raises:
+            JSONException: If the queue is full or the workers are not running.
+        """
+        if self._queue is None:
+            raise JSONException(id='QUEUE_UNAVAILABLE', detail='Background jobs are not running')
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull as exc:
+            raise JSONException(
+                id='QUEUE_FULL',
+                detail='Too many background jobs, retry later',
+                status_code=429
+            ) from exc
+        metrics.JOBS_QUEUED.inc()
+
+    def stats(self) -> dict[str, int]:
+        """Return the queued jobs and the maximum size of the queue."""
+        return {
+            'queued': 0 if self._queue is None else self._queue.qsize(),
+            'max_size': self.max_size,
+            'workers': len(self._tasks)
+        }
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            metrics.JOBS_QUEUED.dec()
+            try:
+                with metrics.JOBS_RUNNING.track():
+                    await job()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # A failing job must not stop the worker
+                logger.exception('Background job failed')
+            finally:
+                self._queue.task_done()
+
+
+# Jobs of POST /api/HTTP/{method} with "background": true
+job_queue = JobQueue(
+    max_size=settings['JOB_QUEUE_MAX_SIZE'],
+    workers=settings['JOB_WORKERS']
+)
@@ -2,14 +2,49 @@
     The starting point of the application.
 """
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
-from .routers import http
+from pymongo.errors import ConnectionFailure
+from .routers import http, health, monitors, stats, metrics as metrics_router
 from .models.shared import JSONException
 from .models.api import HTTPResponse
+from .utils import close_http_client
+from .jobs import job_queue
+from .retention import compactor
+from .monitors import monitor_scheduler
+from .cache import result_cache, MongoCacheBackend
+from .settings import settings
+from . import database, metrics
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Connect to the database and start the background workers when the server starts,
+    release the resources shared by the requests when it stops.
+
+    Every worker process runs its own lifespan: clients and pools are never shared
+    between processes."""
+    await database.startup()
+    if settings['RESULT_CACHE_BACKEND'] == 'mongo':
+        result_cache.shared = MongoCacheBackend(database.get_db().result_cache)
+    job_queue.start()
+    if settings['RESULTS_COMPACT_AFTER'] > 0:
+        compactor.start(database.get_db())
+    if settings['MONITORS_ENABLED']:
+        monitor_scheduler.start(database.get_db())
+    yield
+    await monitor_scheduler.stop()
+    await compactor.stop()
+    await job_queue.stop()
+    result_cache.shared = None
+    await database.shutdown()
+    await close_http_client()
+
 
 # Webserver
 app = FastAPI(
+    lifespan=lifespan,
     title="Digitiamo Curl-as-a-Service Test",
     description="Evaluation test for Digitiamo S.r.l",
     version="1.0.0",
@@ -20,6 +55,11 @@ app = FastAPI(
 )
 
 app.include_router(http.router)
+app.include_router(monitors.router)
+app.include_router(stats.router)
+app.include_router(health.router)
+app.include_router(metrics_router.router)
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.exception_handler(JSONException)
@@ -33,12 +73,31 @@ async def custom_exception_handler(_: Request, exc: JSONException) -> JSONRespon
     Returns:
         JSONResponse: JSON response with the exception details.
     """
+    metrics.ERRORS.labels(exc.id).inc()
     ret = HTTPResponse(
-        status = 500,
+        status = exc.status_code,
         errors = {
             "id": exc.id,
             "detail": exc.detail
         },
         data = None
     )
-    return JSONResponse(status_code=500, content=ret.model_dump(by_alias=True))
+    return JSONResponse(status_code=exc.status_code, content=ret.model_dump(by_alias=True))
+
+
+@app.exception_handler(ConnectionFailure)
+async def database_unavailable_handler(request: Request, exc: ConnectionFailure) -> JSONResponse:
+    """Handle the requests that need MongoDb while it is unreachable
+
+    Args:
+        request (Request): The request object.
+        exc (ConnectionFailure): The exception to handle.
+
+    Returns:
+        JSONResponse: JSON response with status 503.
+    """
+    return await custom_exception_handler(request, JSONException(
+        id='DATABASE_UNAVAILABLE',
+        detail=f'The database is unreachable, retry later: {exc}',
+        status_code=503
+    ))
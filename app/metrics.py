@@ -0,0 +1,361 @@
+"""
+This module contains the metrics of the API, exposed in the Prometheus text format by GET /metrics.
+
+Metrics are kept in process memory: with several gunicorn workers every worker has its own,
+and GET /metrics reports those of the worker serving it. Label values are resolved once with
+labels() and recording a value is then a few additions, cheap enough to stay enabled in
+production.
+
+Classes:
+    Counter: Value that only goes up, e.g. the number of errors.
+    Gauge: Value that goes up and down, e.g. the requests in flight.
+    Histogram: Distribution of observed values in cumulative buckets, e.g. latencies.
+    Registry: Set of metrics rendered together.
+    MetricsMiddleware: ASGI middleware measuring the requests served by the API.
+
+Functions:
+    render: Render the metrics of the default registry in the Prometheus text format.
+"""
+
+from abc import ABC, abstractmethod
+import bisect
+import time
+from typing import Iterator
+from app.settings import settings
+
+# Latency buckets in seconds, from a cached DNS resolution to a full redirect chain
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs: list[tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: list['_Metric'] = []
+
+    def register(self, metric: '_Metric') -> None:
+        """Add a metric to the registry."""
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self) -> None:
+        """Reset the value of every metric."""
+        for metric in self._metrics:
+            metric.reset()
+
+
+# Metrics of the API
+REGISTRY = Registry()
+
+
+class _Metric(ABC):
+    """Base class of the metrics: a family of children, one per combination of label values."""
+
+    kind = ''
+
+    def __init__(
+                self,
+                name: str,
+                documentation: str,
+                labelnames: tuple[str, ...] = (),
+                registry: Registry | None = REGISTRY
+            ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        if registry is not None:
+            registry.register(self)
+
+    @abstractmethod
+    def _new_child(self):
+        """Return a new child of the metric, for a new combination of label values."""
+
+    def labels(self, *values: str):
+        """Return the child of the given label values, to record values in the hot path.
+
+        Raises:
+            ValueError: If the number of values does not match the label names.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {self.labelnames}')
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def reset(self) -> None:
+        """Reset the value of every child, children already resolved stay valid."""
+        for child in self._children.values():
+            child.reset()
+
+    def collect(self) -> Iterator[str]:
+        """Yield the lines of the metric in the Prometheus text format."""
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        children = self._children
+        if not self.labelnames and not children:
+            # Unlabelled metrics are always rendered, even if nothing was recorded yet
+            children = {(): self.labels()}
+        for values, child in children.items():
+            yield from child.samples(self.name, list(zip(self.labelnames, values)))
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the counter by the given amount."""
+        self.value += amount
+
+    def reset(self) -> None:
+        """Reset the counter to 0."""
+        self.value = 0
+
+    def samples(self, name: str, labels: list[tuple[str, str]]) -> Iterator[str]:
+        """Yield the sample line of the counter in the Prometheus text format."""
+        yield f'{name}{_format_labels(labels)} {_format_value(self.value)}'
+
+
+class Counter(_Metric):
+    """Value that only goes up, e.g. the number of errors."""
+
+    kind = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase an unlabelled counter by the given amount."""
+        self.labels().inc(amount)
+
+
+class _GaugeTracker:
+    def __init__(self, gauge: '_GaugeChild'):
+        self.gauge = gauge
+
+    def __enter__(self):
+        self.gauge.value += 1
+
+    def __exit__(self, *_):
+        self.gauge.value -= 1
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount: float = 1) -> None:
+        """Decrease the gauge by the given amount."""
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        """Set the gauge to the given value."""
+        self.value = value
+
+    def track(self) -> _GaugeTracker:
+        """Return a context manager increasing the gauge while the block is running."""
+        return _GaugeTracker(self)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. the requests in flight."""
+
+    kind = 'gauge'
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase an unlabelled gauge by the given amount."""
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrease an unlabelled gauge by the given amount."""
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        """Set an unlabelled gauge to the given value."""
+        self.labels().set(value)
+
+    def track(self) -> _GaugeTracker:
+        """Return a context manager increasing an unlabelled gauge while the block is running."""
+        return self.labels().track()
+
+
+class _HistogramTimer:
+    def __init__(self, histogram: '_HistogramChild'):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # Observations of every bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record an observed value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> _HistogramTimer:
+        """Return a context manager observing the seconds spent in the block."""
+        return _HistogramTimer(self)
+
+    def reset(self) -> None:
+        """Reset the counts of the buckets and the sum."""
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def samples(self, name: str, labels: list[tuple[str, str]]) -> Iterator[str]:
+        """Yield the cumulative buckets, the sum and the count in the Prometheus text format."""
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            cumulative += count
+            bucket_labels = _format_labels(labels + [('le', _format_value(bound))])
+            yield f'{name}_bucket{bucket_labels} {cumulative}'
+        yield f'{name}_sum{_format_labels(labels)} {_format_value(self.sum)}'
+        yield f'{name}_count{_format_labels(labels)} {cumulative}'
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, e.g. latencies."""
+
+    kind = 'histogram'
+
+    def __init__(
+                self,
+                name: str,
+                documentation: str,
+                labelnames: tuple[str, ...] = (),
+                buckets: tuple[float, ...] = LATENCY_BUCKETS,
+                registry: Registry | None = REGISTRY
+            ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Record an observed value in an unlabelled histogram."""
+        self.labels().observe(value)
+
+    def time(self) -> _HistogramTimer:
+        """Return a context manager observing the seconds spent in the block."""
+        return self.labels().time()
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring the duration and the number in flight of the API requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        API_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            API_IN_FLIGHT.dec()
+            API_DURATION.observe(time.perf_counter() - start)
+
+
+def render() -> str:
+    """Render the metrics of the default registry in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+API_IN_FLIGHT = Gauge(
+    'caas_http_requests_in_flight', 'API requests being served')
+API_DURATION = Histogram(
+    'caas_http_request_duration_seconds', 'Duration of the API requests, streaming included')
+CHAINS_IN_FLIGHT = Gauge(
+    'caas_chains_in_flight', 'Redirect chains being followed')
+JOBS_QUEUED = Gauge(
+    'caas_jobs_queued', 'Background jobs waiting for a worker')
+JOBS_RUNNING = Gauge(
+    'caas_jobs_running', 'Background jobs being run')
+HOST_QUEUE_WAITING = Gauge(
+    'caas_host_queue_waiting', 'Requests waiting for a slot of their target host')
+PHASE_SECONDS = Histogram(
+    'caas_phase_seconds',
+    'Time spent in every phase: queue, dns, connect, tls and fetch per hop, the whole chain, '
+    'MongoDb inserts and reads, serialization of the results',
+    labelnames=('phase',))
+ERRORS = Counter(
+    'caas_errors_total', 'Errors returned by the API, per error id', labelnames=('id',))
+REDIRECT_DEPTH = Histogram(
+    'caas_redirect_depth', 'Number of redirects followed by the completed chains',
+    buckets=tuple(range(settings['MAX_REDIRECTS'] + 1)))
+MONITORS_SCHEDULED = Gauge(
+    'caas_monitors_scheduled', 'Monitors scheduled by this process, 0 unless it holds the lease')
+MONITOR_CHECKS = Counter(
+    'caas_monitor_checks_total',
+    'Checks of the monitors: result stored, unchanged in diff mode, or skipped because the '
+    'previous check was still running',
+    labelnames=('outcome',))
+RESULTS_COMPACTED = Counter(
+    'caas_results_compacted_total', 'Results whose responses and requests were dropped')
+HOP_CONNECTIONS = Counter(
+    'caas_hop_connections_total', 'Hops sent on a new or a pooled connection',
+    labelnames=('reused',))
+
+# Children of the phases, resolved once for the hot path
+PHASE_QUEUE = PHASE_SECONDS.labels('queue')
+PHASE_DNS = PHASE_SECONDS.labels('dns')
+PHASE_CONNECT = PHASE_SECONDS.labels('connect')
+PHASE_TLS = PHASE_SECONDS.labels('tls')
+PHASE_FETCH = PHASE_SECONDS.labels('fetch')
+PHASE_CHAIN = PHASE_SECONDS.labels('chain')
+PHASE_MONGO_INSERT = PHASE_SECONDS.labels('mongo_insert')
+PHASE_MONGO_FIND = PHASE_SECONDS.labels('mongo_find')
+PHASE_SERIALIZATION = PHASE_SECONDS.labels('serialization')
+
+# Children of the monitor checks, resolved once for the hot path
+MONITOR_CHECKS_STORED = MONITOR_CHECKS.labels('stored')
+MONITOR_CHECKS_UNCHANGED = MONITOR_CHECKS.labels('unchanged')
+MONITOR_CHECKS_SKIPPED = MONITOR_CHECKS.labels('skipped')
+
+# Children of the hop connections, resolved once for the hot path
+HOP_CONNECTIONS_NEW = HOP_CONNECTIONS.labels('false')
+HOP_CONNECTIONS_REUSED = HOP_CONNECTIONS.labels('true')
@@ -1,9 +1,61 @@
+from datetime import datetime
 from typing import Dict, List, Optional, Any
-from pydantic import BaseModel, Field, constr
+from pydantic import BaseModel, Field, constr, field_validator
+from app import headers as response_headers
 
 class ServerSideURL(BaseModel):
     url: str = Field(examples=["https://www.google.com/"])
 
+class HTTPRequestOptions(ServerSideURL):
+    timeout: Optional[float] = Field(
+        default=None, gt=0, examples=[10],
+        description="Time budget in seconds for the whole redirect chain"
+    )
+    capture_body: bool = Field(
+        default=False,
+        description="Capture the SHA-256, the length and a preview of every response body"
+    )
+    max_body_bytes: Optional[int] = Field(
+        default=None, gt=0, examples=[1048576],
+        description="Maximum bytes of a body read when capturing, the rest is not downloaded"
+    )
+    tenant: Optional[str] = Field(
+        default=None, examples=["acme"],
+        description="Tenant whose SSRF policy is applied on top of the default one"
+    )
+    all_headers: bool = Field(
+        default=False,
+        description="Capture every response header instead of the configured ones"
+    )
+
+class HTTPCachedRequestOptions(HTTPRequestOptions):
+    cache_max_age: Optional[float] = Field(
+        default=None, ge=0, examples=[300],
+        description="Accept a cached result up to this many seconds old instead of a new request"
+    )
+    background: bool = Field(
+        default=False,
+        description="Return a pending result at once and follow the redirect chain in background"
+    )
+
+class BatchItem(HTTPRequestOptions):
+    method: str = Field(examples=["GET"])
+
+class MonitorOptions(HTTPRequestOptions):
+    method: str = Field(examples=["GET"])
+    interval: float = Field(gt=0, examples=[300], description="Seconds between two checks")
+    diff: bool = Field(
+        default=False,
+        description="Store a result only when the redirect chain changed since the last check"
+    )
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem] = Field(min_length=1)
+    concurrency: Optional[int] = Field(
+        default=None, gt=0, examples=[20],
+        description="Maximum number of requests performed at the same time"
+    )
+
 class ServerSideURLDecomposed(ServerSideURL):
     protocol: str = Field(examples=["https"])
     domain: str = Field(examples=["www.google.com"])
@@ -13,10 +65,40 @@ class Header(BaseModel):
     name: str = Field(examples=["Content-Type"])
     value: str = Field(examples=["application/json"])
 
+class HopTimings(BaseModel):
+    """Timings of a single hop of the redirect chain, in milliseconds."""
+    queue: Optional[float] = Field(default=None, examples=[0.1],
+                                   description="Time waiting for a slot of the target host")
+    dns: Optional[float] = Field(default=None, examples=[1.2])
+    connect: Optional[float] = Field(default=None, examples=[12.5])
+    tls: Optional[float] = Field(default=None, examples=[25.1])
+    ttfb: Optional[float] = Field(default=None, examples=[80.4])
+    total: Optional[float] = Field(default=None, examples=[95.7])
+
+class ResponseBody(BaseModel):
+    """Digest and preview of a response body, read up to a maximum number of bytes."""
+    sha256: str = Field(examples=[
+        "e3b0c44298fc1c149afbf4c8996fb924"
+        "27ae41e4649b934ca495991b7852b855"
+    ])
+    length: int = Field(examples=[1256], description="Bytes read, the whole body unless truncated")
+    truncated: bool = Field(examples=[False], description="True if the body exceeded the maximum")
+    preview: str = Field(examples=["<!doctype html>"])
+
 class ServerSideResponse(BaseModel):
     http_version: str = Field(examples=["HTTP/1.1"])
     status_code: int = Field(examples=[200])
     headers: dict # List[Header]
+    timings: Optional[HopTimings] = None
+    # Whether the hop was sent on a pooled connection, None when it is not known
+    connection_reused: Optional[bool] = None
+    body: Optional[ResponseBody] = None
+
+    @field_validator('headers', mode='before')
+    @classmethod
+    def expand_headers(cls, headers):
+        """Headers are stored as a compact list, see app/headers.py."""
+        return response_headers.expand(headers)
 
 class ServerSideRequest(BaseModel):
     method: str = Field(examples=["GET"])
@@ -24,8 +106,27 @@ class ServerSideRequest(BaseModel):
 
 class HTTPResponseData(BaseModel):
     url: ServerSideURLDecomposed
-    response: List[ServerSideResponse]
-    request: List[ServerSideRequest]
+    # Dropped from the compacted results, see app/retention.py
+    response: List[ServerSideResponse] = []
+    request: List[ServerSideRequest] = []
+
+class StatsCounters(BaseModel):
+    """Counters of the completed redirect chains of a domain."""
+    requests: int = Field(examples=[42])
+    hops: Dict[str, int] = Field(examples=[{"1": 30, "2": 12}],
+                                 description="Results by number of responses in the chain")
+    status: Dict[str, int] = Field(examples=[{"200": 40, "404": 2}],
+                                   description="Results by status code of the last response")
+    servers: Dict[str, int] = Field(examples=[{"nginx/1.25.3": 42}],
+                                    description="Results by Server header of the last response")
+
+class HourlyStatsCounters(StatsCounters):
+    hour: datetime = Field(examples=["2023-11-20T10:00:00Z"], description="Start of the UTC hour")
+
+class DomainStats(BaseModel):
+    domain: str = Field(examples=["www.google.com"])
+    total: StatsCounters
+    hourly: List[HourlyStatsCounters] = Field(description="Hours with results, oldest first")
 
 class HTTPResponseErrors(BaseModel):
     id: str = Field(examples=["TOO_MANY_REDIRECTS"])
@@ -1,8 +1,10 @@
 """Database models for the application."""
 
-from typing import Optional
+from datetime import datetime
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
-from app.models.api import HTTPResponse
+from app import headers
+from app.models.api import HTTPResponse, MonitorOptions, ServerSideURLDecomposed
 
 class MongoBaseModel(BaseModel):
     """Base model for all models that are stored in mongodb."""
@@ -16,8 +18,112 @@ class MongoBaseModel(BaseModel):
         populate_by_name = True
         arbitrary_types_allowed = True
 
+class ResultSummary(BaseModel):
+    """Summary of a result, stored with it so that results can be filtered and listed
+    without reading their responses.
+    status_code: Status code of the last response of the chain
+    hops: Number of responses in the chain
+    error: Id of the error, if any
+    """
+    status_code: Optional[int] = Field(default=None, examples=[200])
+    hops: int = Field(default=0, examples=[2])
+    error: Optional[str] = Field(default=None, examples=["SSRF_DETECTED"])
+
 class RequestModel(MongoBaseModel, HTTPResponse):
     """Model for the HTTP request object.
     Based on models/api HTTPResponse model +
     id: Unique identifier for the object when stored in mongodb
+    created_at: When the request was performed
+    cached: True if the object was served from the results cache, never stored
+    state: Progress of a background request, "done" for the others
+    compacted: True if the responses and the requests were dropped by the retention
+    """
+    created_at: Optional[datetime] = Field(
+        default=None,
+        examples=["2023-11-20T10:00:00Z"],
+        description="When the request was performed"
+    )
+    cached: bool = Field(
+        default=False,
+        description="True if the result was served from the cache instead of a new request"
+    )
+    state: Literal['pending', 'running', 'done'] = Field(
+        default='done',
+        description="Progress of a background request, status, errors and data are set when done"
+    )
+    compacted: bool = Field(
+        default=False,
+        description="True if the responses and the requests were dropped, the summary is kept"
+    )
+
+    def summary(self) -> ResultSummary:
+        """Return the summary stored with the result, see ResultSummary."""
+        responses = self.data.response if self.data is not None else []
+        return ResultSummary(
+            status_code=responses[-1].status_code if responses else None,
+            hops=len(responses),
+            error=self.errors.id if self.errors is not None else None
+        )
+
+    def to_document(self) -> dict:
+        """Return the document stored in mongodb, with its summary and compact headers."""
+        document = self.model_dump(by_alias=True, exclude={'cached', 'compacted'})
+        document['summary'] = self.summary().model_dump()
+        for response in (document['data'] or {}).get('response', []):
+            response['headers'] = headers.compact(response['headers'])
+        return document
+
+class RequestSummaryModel(MongoBaseModel):
+    """Model of a result listed by GET /api/HTTP, without its responses.
+    url: The requested URL, None for the pending background requests
+    summary: See ResultSummary, None for the results stored before summaries existed
+    compacted: True if the responses and the requests were dropped by the retention
+    """
+    created_at: Optional[datetime] = None
+    state: Literal['pending', 'running', 'done'] = 'done'
+    status: int
+    url: Optional[ServerSideURLDecomposed] = None
+    summary: Optional[ResultSummary] = None
+    compacted: bool = False
+
+class ResultPageModel(BaseModel):
+    """Model of a page of results listed by GET /api/HTTP.
+    results: The results, newest first
+    next_cursor: Cursor of the next page, None on the last page
+    """
+    results: List[RequestSummaryModel]
+    next_cursor: Optional[str] = None
+
+class BatchResultModel(BaseModel):
+    """Model for the result of a batch of HTTP requests.
+    ids: Unique identifiers of the stored records, in the same order as the batch
+    results: The stored records
+    """
+    ids: List[str]
+    results: List[RequestModel]
+
+class MonitorModel(MongoBaseModel, MonitorOptions):
+    """Model of a monitor, a request checked every interval seconds, see app/monitors.py.
+    Based on models/api MonitorOptions model +
+    created_at: When the monitor was registered
+    last_run: When the last check was performed, None before the first one
+    last_status: Status code of the last response of the last check, None if it failed
+                 before a response
+    last_error: Id of the error of the last check, if any
+    last_result: Id of the last stored result
+    changed_at: When the redirect chain last changed
+    """
+    created_at: Optional[datetime] = None
+    last_run: Optional[datetime] = None
+    last_status: Optional[int] = None
+    last_error: Optional[str] = None
+    last_result: Optional[str] = None
+    changed_at: Optional[datetime] = None
+
+class MonitorPageModel(BaseModel):
+    """Model of a page of monitors listed by GET /api/monitors.
+    monitors: The monitors, by id
+    next_cursor: Cursor of the next page, None on the last page
     """
+    monitors: List[MonitorModel]
+    next_cursor: Optional[str] = None
@@ -1,5 +1,6 @@
 
 class JSONException(Exception):
-    def __init__(self, id, detail):
+    def __init__(self, id, detail, status_code=500):
         self.id = id
         self.detail = detail
+        self.status_code = status_code
@@ -0,0 +1,299 @@
+"""
+This module contains the scheduler of the monitors: requests checked every interval seconds.
+
+Monitors are stored in the monitors collection by the monitors router. One server process
+of the deployment runs them: the one holding the lease document "monitors" of the leases
+collection, renewed every MONITORS_SYNC_INTERVAL seconds and taken over by another process
+when it is not renewed for MONITORS_LEASE_TTL seconds.
+
+The leader keeps every monitor in memory and their next checks in a heap: the run loop
+sleeps until the earliest check is due, so idle monitors cost no task and no timer. The
+monitors changed by the API are read every MONITORS_SYNC_INTERVAL seconds, with the index
+on updated_at; deleted monitors are marked and removed from the heap when they are read.
+
+Checks follow the redirect chain with analyse, like POST /api/HTTP/{method}, at most
+MONITORS_CONCURRENCY at once on top of the politeness of app/scheduler.py. A check whose
+previous one is still running is skipped. Results are stored with the id of their monitor;
+in diff mode only when the redirect chain changed: its fingerprint is the hash of its stable
+part, see app/chains.py. The state of the monitors is written with one bulk write per sync.
+
+Classes:
+    MonitorScheduler: Runs the due monitors, when this process holds the lease.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import logging
+import os
+import socket
+import time
+from uuid import uuid4
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from app import chains, metrics
+from app.database import insert_results
+from app.settings import settings
+from app.utils import analyse_or_error
+
+logger = logging.getLogger(__name__)
+
+# Fields of a monitor written by the checks, the API never changes them
+STATE_FIELDS = ('last_run', 'last_status', 'last_error', 'last_result', 'changed_at',
+                'fingerprint')
+
+
+def fingerprint(document: dict) -> str | None:
+    """Return the fingerprint of a result document: the hash of the stable part of its
+    redirect chain, or the id of its error."""
+    result, chain = chains.split(document)
+    if chain is not None:
+        return result['chain']
+    return (document.get('errors') or {}).get('id')
+
+
+class MonitorScheduler:
+    """Runs the due monitors, when this process holds the lease."""
+
+    def __init__(self, concurrency: int, sync_interval: float, lease_ttl: float):
+        """
+        Args:
+            concurrency (int): Maximum checks in flight.
+            sync_interval (float): Seconds between two renewals of the lease and reads of the
+                                   changed monitors.
+            lease_ttl (float): Seconds the lease is held without being renewed.
+        """
+        self.concurrency = concurrency
+        self.sync_interval = sync_interval
+        self.lease_ttl = lease_ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.leader = False
+        # monitor _id -> monitor, with its generation and its state
+        self._monitors: dict[str, dict] = {}
+        # (due time, generation, monitor _id), entries of outdated generations are skipped
+        self._heap: list[tuple[float, int, str]] = []
+        self._generations = itertools.count()
+        self._running: set[str] = set()
+        # monitor _id -> state fields to write, see flush()
+        self._updates: dict[str, dict] = {}
+        self._synced_at: datetime | None = None
+        self._limit: asyncio.Semaphore | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._lead_task: asyncio.Task | None = None
+        self._run_task: asyncio.Task | None = None
+        self._checks: set[asyncio.Task] = set()
+
+    def start(self, db: AsyncIOMotorDatabase) -> None:
+        """Start competing for the lease, bound to the running event loop."""
+        self._limit = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        self._lead_task = asyncio.create_task(self._lead(db))
+
+    async def stop(self) -> None:
+        """Stop running the monitors, the running checks are cancelled."""
+        if self._lead_task is not None:
+            self._lead_task.cancel()
+            await asyncio.gather(self._lead_task, return_exceptions=True)
+            self._lead_task = None
+        await self._step_down()
+
+    def apply(self, document: dict) -> None:
+        """Add, update or remove a monitor read from the database, and schedule it.
+
+        The first check of a monitor is due at once, the next ones interval seconds after
+        the previous one.
+        """
+        uid = document['_id']
+        current = self._monitors.get(uid)
+        if document.get('deleted'):
+            if self._monitors.pop(uid, None) is not None:
+                metrics.MONITORS_SCHEDULED.dec()
+            return
+        if current is not None and current['updated_at'] == document['updated_at']:
+            return
+        monitor = dict(document, generation=next(self._generations))
+        if current is None:
+            metrics.MONITORS_SCHEDULED.inc()
+        else:
+            # The state known by this process is newer than the stored one
+            monitor.update({field: current.get(field) for field in STATE_FIELDS})
+        self._monitors[uid] = monitor
+        last_run = monitor.get('last_run')
+        due = time.time() if last_run is None else last_run.timestamp() + monitor['interval']
+        heapq.heappush(self._heap, (due, monitor['generation'], uid))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pop_due(self, now: float) -> tuple[dict | None, float | None]:
+        """Return the next due monitor and schedule its next check.
+
+        Args:
+            now (float): The current time.time().
+
+        Returns:
+            tuple[dict | None, float | None]: The due monitor, or None and the seconds until
+                                              the next one is due, None without monitors.
+        """
+        while self._heap:
+            due, generation, uid = self._heap[0]
+            monitor = self._monitors.get(uid)
+            if monitor is None or monitor['generation'] != generation:
+                heapq.heappop(self._heap)
+                continue
+            if due > now:
+                return None, due - now
+            # Late checks are not caught up: the next one is an interval after this one
+            next_due = due + monitor['interval']
+            if next_due <= now:
+                next_due = now + monitor['interval']
+            heapq.heapreplace(self._heap, (next_due, generation, uid))
+            return monitor, None
+        return None, None
+
+    def stats(self) -> dict:
+        """Return whether this process runs the monitors, their number and the running checks."""
+        return {'leader': self.leader, 'monitors': len(self._monitors),
+                'running': len(self._running)}
+
+    async def check(self, db: AsyncIOMotorDatabase, monitor: dict) -> None:
+        """Check a monitor and store its result, in diff mode only if its chain changed."""
+        record = await analyse_or_error(
+            monitor['url'], monitor['method'], monitor.get('timeout'),
+            monitor.get('capture_body', False), monitor.get('max_body_bytes'),
+            monitor.get('tenant'), monitor.get('all_headers', False))
+        document = record.to_document() | {'monitor': monitor['_id']}
+        current_fingerprint = fingerprint(document)
+        changed = current_fingerprint != monitor.get('fingerprint')
+        summary = record.summary()
+        state = {'last_run': record.created_at, 'last_status': summary.status_code,
+                 'last_error': summary.error, 'fingerprint': current_fingerprint}
+        if changed or not monitor.get('diff'):
+            await insert_results(db, [document])
+            state['last_result'] = record.id
+            metrics.MONITOR_CHECKS_STORED.inc()
+        else:
+            metrics.MONITOR_CHECKS_UNCHANGED.inc()
+        if changed:
+            state['changed_at'] = record.created_at
+        monitor.update(state)
+        # The monitor may have been replaced by a newer version during the check
+        current = self._monitors.get(monitor['_id'])
+        if current is not None and current is not monitor:
+            current.update(state)
+        self._updates.setdefault(monitor['_id'], {}).update(state)
+
+    async def flush(self, db: AsyncIOMotorDatabase) -> None:
+        """Write the state of the checked monitors with one bulk write."""
+        updates, self._updates = self._updates, {}
+        if not updates:
+            return
+        try:
+            with metrics.PHASE_MONGO_INSERT.time():
+                await db.monitors.bulk_write([
+                    UpdateOne({'_id': uid, 'deleted': {'$ne': True}}, {'$set': state})
+                    for uid, state in updates.items()
+                ], ordered=False)
+        except PyMongoError:
+            logger.exception('State of %d monitors could not be written', len(updates))
+            for uid, state in updates.items():
+                self._updates[uid] = state | self._updates.get(uid, {})
+
+    async def _acquire_lease(self, db: AsyncIOMotorDatabase) -> bool:
+        """Take or renew the lease, return True if this process holds it."""
+        now = datetime.now(timezone.utc)
+        try:
+            await db.leases.update_one(
+                {'_id': 'monitors', '$or': [{'owner': self.owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner,
+                          'expires': now + timedelta(seconds=self.lease_ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another process holds the lease
+            return False
+        return True
+
+    async def _sync(self, db: AsyncIOMotorDatabase) -> None:
+        """Read the monitors changed since the last sync, every monitor the first time."""
+        synced_at = datetime.now(timezone.utc)
+        if self._synced_at is None:
+            query = {'deleted': {'$ne': True}}
+        else:
+            # The clocks of the servers writing the monitors may be a little late
+            query = {'updated_at': {'$gte': self._synced_at - timedelta(
+                seconds=self.sync_interval)}}
+        with metrics.PHASE_MONGO_FIND.time():
+            async for document in db.monitors.find(query):
+                self.apply(document)
+        self._synced_at = synced_at
+
+    async def _lead(self, db: AsyncIOMotorDatabase) -> None:
+        while True:
+            try:
+                if await self._acquire_lease(db):
+                    if not self.leader:
+                        logger.info('Running the monitors as %s', self.owner)
+                        self.leader = True
+                    await self._sync(db)
+                    await self.flush(db)
+                    if self._run_task is None:
+                        self._run_task = asyncio.create_task(self._run(db))
+                elif self.leader:
+                    logger.warning('Lease of the monitors lost by %s', self.owner)
+                    await self._step_down()
+            except PyMongoError:
+                logger.exception('Monitors could not be synchronized')
+            await asyncio.sleep(self.sync_interval)
+
+    async def _step_down(self) -> None:
+        """Stop the run loop and the checks, forget the monitors."""
+        tasks = [task for task in (self._run_task, *self._checks) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._run_task = None
+        self.leader = False
+        metrics.MONITORS_SCHEDULED.dec(len(self._monitors))
+        self._monitors.clear()
+        self._heap.clear()
+        self._updates.clear()
+        self._synced_at = None
+
+    async def _run(self, db: AsyncIOMotorDatabase) -> None:
+        while True:
+            monitor, delay = self.pop_due(time.time())
+            if monitor is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if monitor['_id'] in self._running:
+                metrics.MONITOR_CHECKS_SKIPPED.inc()
+                continue
+            # Due checks wait for a free slot: late checks are run as soon as possible
+            await self._limit.acquire()
+            self._running.add(monitor['_id'])
+            task = asyncio.create_task(self._run_check(db, monitor))
+            self._checks.add(task)
+            task.add_done_callback(self._checks.discard)
+
+    async def _run_check(self, db: AsyncIOMotorDatabase, monitor: dict) -> None:
+        try:
+            await self.check(db, monitor)
+        except PyMongoError:
+            logger.exception('Result of the monitor %s could not be stored', monitor['_id'])
+        finally:
+            self._running.discard(monitor['_id'])
+            self._limit.release()
+
+
+# Monitors of the deployment, run by the process holding the lease
+monitor_scheduler = MonitorScheduler(
+    concurrency=settings['MONITORS_CONCURRENCY'],
+    sync_interval=settings['MONITORS_SYNC_INTERVAL'],
+    lease_ttl=settings['MONITORS_LEASE_TTL']
+)
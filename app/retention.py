@@ -0,0 +1,152 @@
+"""
+This module contains the compaction of the old results.
+
+Results older than RESULTS_COMPACT_AFTER seconds are compacted: they keep their URL, state,
+status, errors and summary, and lose the responses and the requests of their redirect chain,
+which make most of their size, and their reference to a deduplicated chain, see app/chains.py.
+Results older than RESULTS_TTL seconds are deleted by MongoDb with a TTL index on created_at,
+see app/database.py.
+
+The results to compact are found with a partial index on created_at that only contains the
+results not compacted yet: the index shrinks as results are compacted, and a pass reads the
+results it compacts only.
+
+Every worker process runs the compaction: the updates are idempotent, concurrent passes
+compact different batches or nothing. The views of GET /api/HTTP/{uid} are cached by every
+worker until their result may be compacted or deleted, see view_expiration, so no worker
+serves the full view of a compacted result.
+
+Classes:
+    Compactor: Compacts the old results periodically, in background.
+
+Functions:
+    compact: Compact the results created before the given date.
+    view_expiration: Return when the cached view of a result stops being served.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+import logging
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+from app import metrics
+from app.cache import view_cache
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Query of the results not compacted yet, also the partial filter of their index
+COMPACTABLE = {'data.response': {'$exists': True}}
+
+
+def view_expiration(created_at: datetime | None, compacted: bool = False) -> float | None:
+    """Return when the cached view of a result stops being served: when the result may be
+    compacted or deleted by any process.
+
+    Args:
+        created_at (datetime | None): The creation date of the result.
+        compacted (bool, optional): Whether the result is already compacted.
+
+    Returns:
+        float | None: The time.time() of the expiration, None if the result never changes.
+    """
+    ages = [settings['RESULTS_TTL']]
+    if not compacted:
+        ages.append(settings['RESULTS_COMPACT_AFTER'])
+    ages = [age for age in ages if age > 0]
+    # Results without created_at are never compacted nor deleted
+    if created_at is None or not ages:
+        return None
+    return created_at.timestamp() + min(ages)
+
+
+async def compact(db: AsyncIOMotorDatabase, before: datetime, batch_size: int) -> int:
+    """Compact the results created before the given date, oldest first.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database of the results.
+        before (datetime): Results created before this date are compacted.
+        batch_size (int): Results compacted by every update.
+
+    Returns:
+        int: Number of results compacted.
+    """
+    count = 0
+    while True:
+        with metrics.PHASE_MONGO_FIND.time():
+            cursor = db.results.find(
+                {'created_at': {'$lt': before}, **COMPACTABLE},
+                {'_id': 1},
+                sort=[('created_at', ASCENDING), ('_id', ASCENDING)],
+                limit=batch_size
+            )
+            ids = [document['_id'] async for document in cursor]
+        if not ids:
+            return count
+        await db.results.update_many(
+            {'_id': {'$in': ids}, **COMPACTABLE},
+            {'$unset': {'data.response': '', 'data.request': '', 'chain': ''},
+             '$set': {'compacted': True}}
+        )
+        # The views encoded before the compaction are not served anymore by this process
+        for uid in ids:
+            view_cache.discard(uid)
+        count += len(ids)
+        metrics.RESULTS_COMPACTED.inc(len(ids))
+        if len(ids) < batch_size:
+            return count
+
+
+class Compactor:
+    """Compacts the results older than max_age seconds every interval seconds, in background."""
+
+    def __init__(self, max_age: float, interval: float, batch_size: int):
+        """
+        Args:
+            max_age (float): Age in seconds of the results to compact.
+            interval (float): Seconds between two compaction passes.
+            batch_size (int): Results compacted by every update.
+        """
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+        self._stopping: asyncio.Event | None = None
+
+    def start(self, db: AsyncIOMotorDatabase) -> None:
+        """Start the task compacting the results of the given database, bound to the running
+        event loop. The first pass runs at once."""
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._compact_periodically(db))
+
+    async def stop(self) -> None:
+        """Stop the compaction, the running pass is cancelled."""
+        if self._task is not None:
+            self._stopping.set()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _compact_periodically(self, db: AsyncIOMotorDatabase) -> None:
+        while not self._stopping.is_set():
+            before = datetime.now(timezone.utc) - timedelta(seconds=self.max_age)
+            try:
+                count = await compact(db, before, self.batch_size)
+                if count:
+                    logger.info('Compacted %d results created before %s', count, before)
+            except PyMongoError:
+                logger.exception('Results could not be compacted, retrying in %s seconds',
+                                 self.interval)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Compaction of the results, started by the server when RESULTS_COMPACT_AFTER is set
+compactor = Compactor(
+    max_age=settings['RESULTS_COMPACT_AFTER'],
+    interval=settings['RESULTS_COMPACT_INTERVAL'],
+    batch_size=settings['RESULTS_COMPACT_BATCH']
+)
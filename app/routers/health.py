@@ -0,0 +1,89 @@
+"""Health router, serves the probes used by Docker and the load balancers."""
+
+import asyncio
+import socket
+import time
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
+from app import database
+from app.cache import result_cache, view_cache
+from app.jobs import job_queue
+from app.scheduler import host_scheduler
+from app.settings import settings
+from app.utils import dns_cache, http_pool_stats
+
+
+router = APIRouter(tags=["health"])
+
+
+async def _check_mongo() -> dict:
+    """Ping MongoDb, report the latency and whether the indexes are created."""
+    try:
+        latency = await database.ping(settings['READY_TIMEOUT'])
+    except (PyMongoError, asyncio.TimeoutError) as exc:
+        return {'ok': False, 'error': str(exc) or type(exc).__name__}
+    return {'ok': True, 'latency_ms': latency, 'indexes': database.state['indexes']}
+
+
+async def _check_dns() -> dict:
+    """Resolve the MongoDb host without the cache, report the latency and the cache stats."""
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(socket.getaddrinfo, database.get_config()['host'], None),
+            settings['READY_TIMEOUT']
+        )
+    except (OSError, asyncio.TimeoutError) as exc:
+        return {'ok': False, 'error': str(exc) or type(exc).__name__, 'cache': dns_cache.stats()}
+    latency = round((time.perf_counter() - start) * 1000, 3)
+    return {'ok': True, 'latency_ms': latency, 'cache': dns_cache.stats()}
+
+
+def _saturation() -> dict:
+    """Report the usage of the bounded resources, saturated above READY_SATURATION."""
+    jobs = job_queue.stats()
+    scheduler = host_scheduler.stats()
+    pool = http_pool_stats()
+    usage = {
+        'jobs': jobs['queued'] / jobs['max_size'],
+        'requests': scheduler['active'] / host_scheduler.max_active,
+        'http_pool': (pool['connections'] - pool['idle']) / pool['max_connections'],
+    }
+    return {
+        'saturated': [name for name, used in usage.items() if used >= settings['READY_SATURATION']],
+        'jobs': jobs,
+        'requests': scheduler,
+        'http_pool': pool,
+    }
+
+
+@router.get("/healthz")
+async def liveness():
+    """Return 200 while the server is running and its event loop responds."""
+    return {'status': 'ok'}
+
+
+@router.get("/readyz")
+async def readiness():
+    """Return 200 when the server can handle more requests.
+
+    Returns 503 when MongoDb or the DNS resolver are not working, or when the job queue,
+    the outgoing requests or the connection pool are saturated, so that load balancers
+    send the traffic to other instances.
+    """
+    mongo, dns = await asyncio.gather(_check_mongo(), _check_dns())
+    saturation = _saturation()
+    if not (mongo['ok'] and dns['ok']):
+        status = 'degraded'
+    elif saturation['saturated']:
+        status = 'saturated'
+    else:
+        status = 'ready'
+    return JSONResponse(status_code=200 if status == 'ready' else 503, content={
+        'status': status,
+        'mongo': mongo,
+        'dns': dns,
+        'caches': {'results': result_cache.stats(), 'views': view_cache.stats()},
+        'saturation': saturation,
+    })
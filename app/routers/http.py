@@ -1,44 +1,361 @@
 """HTTP router for the API. This is where the API endpoints are defined for the HTTP module."""
 
-from uuid import uuid4
+import asyncio
+import base64
+from datetime import datetime, timezone
+import json
+from typing import AsyncIterator
+from urllib.parse import urlparse
 from pydantic import UUID4
-from fastapi import APIRouter, Depends
-from pymongo.collection import Collection
-from app.models.api import ServerSideURL
-from app.models.database import RequestModel
+from fastapi import APIRouter, Depends, Header, Query
+from fastapi.responses import Response, StreamingResponse
+from app import chains, metrics, retention
+from app.models.api import HTTPCachedRequestOptions, BatchItem, BatchRequest
+from app.models.database import RequestModel, BatchResultModel, RequestSummaryModel, \
+    ResultPageModel
 from app.models.shared import JSONException
-from app.utils import url_info, make_request
-from app.database import get_db
+from app.utils import analyse, analyse_or_error, pending_record
+from app.cache import result_cache, view_cache, etag_matches
+from app.database import get_db, insert_results, find_result, insert_pending, save_result, \
+    set_state, find_summaries
+from app.jobs import job_queue
+from app.settings import settings
 
 
 router = APIRouter(prefix="/api/HTTP", tags=["http"])
 
+# Media type of the streamed results, one JSON document per line
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+# Ask nginx to forward every chunk of the streamed results as soon as it is produced
+NDJSON_HEADERS = {'X-Accel-Buffering': 'no'}
 
-@router.post("/{method}", response_model=RequestModel)
-def perform_a_request(url: ServerSideURL, method: str, db = Depends(get_db)):
-    """Perform a HTTP request to the given URL using the given method."""
-    # Make the request, see utils.py
-    response_and_request = make_request(url.url, method, [], [], 0)
-    # Decompose the URL, see models/api.py
-    url_analysis = {'url': url_info(url.url)}
-    # If there are no errors, merge the URL analysis with the response and request data
-    if response_and_request['errors'] is None:
-        response_and_request['data'] = url_analysis | response_and_request['data']
-    # Insert the response and request data into the database
-    new_record = RequestModel(**response_and_request | {'_id': str(uuid4())})
-    result_collection: Collection[RequestModel] = db.results
-    result_collection.insert_one(new_record.model_dump(by_alias=True))
-    return new_record
-
-@router.get("/{uid}", response_model=RequestModel)
-def view_a_request(uid: UUID4, db = Depends(get_db)):
-    """View a request by its UUID."""
-    result_collection: Collection[RequestModel] = db.results
-    result = result_collection.find_one({'_id': str(uid)})
-    if result is None:
-        #raise HTTPException(status_code=404, detail="Request not found")
+
+def _check_batch_size(batch: BatchRequest) -> None:
+    """Raise an exception if the batch contains too many requests."""
+    if len(batch.requests) > settings['BATCH_MAX_SIZE']:
         raise JSONException(
-                id='ID_NOT_FOUND',
-                detail='The requested UUID was not found in the database'
-            )
-    return RequestModel(**result)
+            id='BATCH_TOO_LARGE',
+            detail=f'A batch can contain at most {settings["BATCH_MAX_SIZE"]} requests',
+            status_code=413
+        )
+
+
+async def _batch_records(batch: BatchRequest) -> AsyncIterator[tuple[int, RequestModel]]:
+    """Perform the requests of a batch concurrently.
+
+    Args:
+        batch (BatchRequest): The batch to perform.
+
+    Yields:
+        tuple[int, RequestModel]: The position in the batch and the record of every request,
+                                  as soon as its redirect chain is completed.
+    """
+    # The requested concurrency can only lower the configured one
+    concurrency = min(batch.concurrency or settings['BATCH_CONCURRENCY'],
+                      settings['BATCH_CONCURRENCY'])
+    batch_limit = asyncio.Semaphore(concurrency)
+    host_limits: dict[str, asyncio.Semaphore] = {}
+
+    async def run(index: int, item: BatchItem) -> tuple[int, RequestModel]:
+        host = urlparse(item.url).hostname or ''
+        host_limit = host_limits.setdefault(
+            host, asyncio.Semaphore(settings['BATCH_HOST_CONCURRENCY']))
+        async with batch_limit, host_limit:
+            return index, await analyse_or_error(
+                item.url, item.method, item.timeout, item.capture_body, item.max_body_bytes,
+                item.tenant, item.all_headers)
+
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(batch.requests)]
+    try:
+        for next_record in asyncio.as_completed(tasks):
+            yield await next_record
+    finally:
+        # Stop the pending requests if the consumer goes away
+        for task in tasks:
+            task.cancel()
+
+
+@router.post("/batch", response_model=BatchResultModel)
+async def perform_a_batch(batch: BatchRequest, db = Depends(get_db)):
+    """Perform many HTTP requests concurrently and store all the results at once.
+
+    Failed requests are returned and stored with their errors, like a single request would be.
+    """
+    _check_batch_size(batch)
+    records: list[RequestModel | None] = [None] * len(batch.requests)
+    async for index, record in _batch_records(batch):
+        records[index] = record
+    # Insert all the results with a single round-trip
+    await insert_results(db, [record.to_document() for record in records])
+    return BatchResultModel(ids=[record.id for record in records], results=records)
+
+
+@router.post("/batch/stream", response_class=StreamingResponse, responses={
+    200: {'content': {NDJSON_MEDIA_TYPE: {}}, 'description': 'One RequestModel per line'}
+})
+async def perform_a_batch_stream(batch: BatchRequest, db = Depends(get_db)):
+    """Perform many HTTP requests concurrently and stream the results as NDJSON.
+
+    Results are sent in the order their redirect chains are completed, so not in the same
+    order as the batch. They are stored in groups of STREAM_CHUNK_SIZE, every group before
+    it is sent: the results a client received are stored even if it disconnects, and so are
+    the completed results it did not receive yet.
+    """
+    _check_batch_size(batch)
+
+    async def lines() -> AsyncIterator[str]:
+        records = _batch_records(batch)
+        pending: list[RequestModel] = []
+        try:
+            async for _, record in records:
+                pending.append(record)
+                if len(pending) >= settings['STREAM_CHUNK_SIZE']:
+                    chunk, pending = pending, []
+                    await insert_results(db, [item.to_document() for item in chunk])
+                    for record in chunk:
+                        yield record.model_dump_json(by_alias=True) + '\n'
+            chunk, pending = pending, []
+            await insert_results(db, [item.to_document() for item in chunk])
+            for record in chunk:
+                yield record.model_dump_json(by_alias=True) + '\n'
+        finally:
+            # Cancel the remaining requests and store the completed ones on disconnect
+            await records.aclose()
+            if pending:
+                await insert_results(db, [item.to_document() for item in pending])
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=NDJSON_HEADERS)
+
+
+@router.get("/export", response_class=StreamingResponse, responses={
+    200: {'content': {NDJSON_MEDIA_TYPE: {}}, 'description': 'One RequestModel per line'}
+})
+async def export_requests(domain: str | None = None, db = Depends(get_db)):
+    """Stream the stored requests as NDJSON, optionally only the ones of the given domain."""
+    query = {} if domain is None else {'data.url.domain': domain}
+    cursor = db.results.find(query, batch_size=settings['STREAM_CHUNK_SIZE'])
+
+    async def chunks() -> AsyncIterator[bytes]:
+        # One chunk of documents is sent for every batch read from the cursor,
+        # the deduplicated chains of a batch are read with one query, see app/chains.py
+        def encode(results: list[dict]) -> bytes:
+            return ''.join(
+                RequestModel(**result).model_dump_json(by_alias=True) + '\n' for result in results
+            ).encode()
+
+        try:
+            results = []
+            async for result in cursor:
+                results.append(result)
+                if len(results) >= settings['STREAM_CHUNK_SIZE']:
+                    yield encode(await chains.expand(db, results))
+                    results = []
+            if results:
+                yield encode(await chains.expand(db, results))
+        finally:
+            await cursor.close()
+
+    return StreamingResponse(chunks(), media_type=NDJSON_MEDIA_TYPE, headers=NDJSON_HEADERS)
+
+
+def _encode_cursor(document: dict) -> str:
+    """Return the cursor of the page following the given result.
+
+    Results stored before created_at existed have a null date, sorted after the others.
+    """
+    created_at = document.get('created_at')
+    position = [None if created_at is None else created_at.isoformat(), document['_id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime | None, str]:
+    """Return the created_at and the _id of the last result of the previous page.
+
+    Raises:
+        JSONException: With status 400 if the cursor is invalid.
+    """
+    try:
+        created_at, uid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if created_at is not None:
+            created_at = datetime.fromisoformat(created_at)
+        return created_at, str(uid)
+    except (ValueError, TypeError) as exc:
+        raise JSONException(
+            id='INVALID_CURSOR',
+            detail='The cursor is invalid, use the next_cursor of the previous page',
+            status_code=400
+        ) from exc
+
+
+def _after_cursor(created_at: datetime | None, uid: str) -> list[dict]:
+    """Return the "$or" conditions of the results after the given one, in the (created_at,
+    _id) descending order where the results without created_at come last."""
+    if created_at is None:
+        return [{'created_at': None, '_id': {'$lt': uid}}]
+    return [
+        {'created_at': {'$lt': created_at}},
+        {'created_at': created_at, '_id': {'$lt': uid}},
+        {'created_at': None}
+    ]
+
+
+@router.get("", response_model=ResultPageModel)
+async def list_requests(
+            domain: str | None = None,
+            status: int | None = None,
+            since: datetime | None = None,
+            monitor: str | None = None,
+            limit: int = Query(default=settings['HISTORY_PAGE_SIZE'], ge=1,
+                               le=settings['HISTORY_MAX_PAGE_SIZE']),
+            cursor: str | None = None,
+            db = Depends(get_db)
+        ):
+    """List the stored requests, newest first, with their summary only.
+
+    Requests can be filtered by domain, by status code of the last response, by date and by
+    the monitor that checked them.
+    Pages are chained with next_cursor instead of an offset, so every page is read from
+    the indexes in the same time however deep it is.
+    """
+    query = {}
+    if domain is not None:
+        query['data.url.domain'] = domain
+    if status is not None:
+        query['summary.status_code'] = status
+    if monitor is not None:
+        query['monitor'] = monitor
+    if since is not None:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        query['created_at'] = {'$gte': since}
+    if cursor is not None:
+        # Results after the last one of the previous page, in the (created_at, _id) order
+        query['$or'] = _after_cursor(*_decode_cursor(cursor))
+    # One more result tells if there is a next page
+    documents = await find_summaries(db, query, limit + 1)
+    next_cursor = _encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+    return ResultPageModel(
+        results=[
+            RequestSummaryModel(**document, url=(document.get('data') or {}).get('url'))
+            for document in documents[:limit]
+        ],
+        next_cursor=next_cursor
+    )
+
+
+async def _perform_in_background(
+            url: HTTPCachedRequestOptions,
+            method: str,
+            cache_key: tuple,
+            db
+        ) -> Response:
+    """Queue the request and return its pending record.
+
+    The record is stored as "pending", it becomes "running" when a worker starts the redirect
+    chain and is replaced by the result when it is done.
+
+    Raises:
+        JSONException: With status 429 if the queue of the background jobs is full.
+    """
+    pending = pending_record()
+
+    async def job() -> None:
+        await set_state(db, pending.id, 'running')
+        record = await analyse_or_error(
+            url.url, method, url.timeout, url.capture_body, url.max_body_bytes, url.tenant,
+            url.all_headers)
+        record = record.model_copy(update={'id': pending.id})
+        await save_result(db, record.to_document())
+        if record.errors is None:
+            await result_cache.store(cache_key, record)
+
+    # The pending record may be stored after the result: it never replaces it, see insert_pending
+    job_queue.submit(job)
+    await insert_pending(db, pending.to_document())
+    return Response(pending.model_dump_json(by_alias=True), status_code=202,
+                    media_type='application/json')
+
+
+@router.post("/{method}", response_model=RequestModel, responses={
+    202: {'model': RequestModel, 'description': 'The pending record of a background request'},
+    429: {'description': 'The queue of the background requests is full, retry later'}
+})
+async def perform_a_request(url: HTTPCachedRequestOptions, method: str, db = Depends(get_db)):
+    """Perform a HTTP request to the given URL using the given method.
+
+    With cache_max_age a recent result of the same request is returned instead, if any.
+    With background the request is queued and its pending record is returned at once,
+    poll GET /api/HTTP/{uid} until its state is "done".
+    The record is validated once: the same encoded bytes are sent and cached for later views.
+    """
+    cache_key = result_cache.key(
+        method, url.url, url.capture_body, url.max_body_bytes, url.tenant, url.all_headers)
+
+    if url.background:
+        cached = None if url.cache_max_age is None else result_cache.get(
+            cache_key, min(url.cache_max_age, settings['RESULT_CACHE_MAX_AGE']))
+        if cached is None:
+            return await _perform_in_background(url, method, cache_key, db)
+        body = cached.model_copy(update={'cached': True}).model_dump_json(by_alias=True)
+        return Response(body, media_type='application/json')
+
+    async def analyse_and_store() -> RequestModel:
+        new_record = await analyse(
+            url.url, method, url.timeout, url.capture_body, url.max_body_bytes, url.tenant,
+            url.all_headers)
+        # Insert the response and request data into the database
+        await insert_results(db, [new_record.to_document()])
+        return new_record
+
+    if url.cache_max_age is None:
+        new_record = await analyse_and_store()
+        await result_cache.store(cache_key, new_record)
+    else:
+        max_age = min(url.cache_max_age, settings['RESULT_CACHE_MAX_AGE'])
+        new_record, cached = await result_cache.get_or_fetch(cache_key, max_age, analyse_and_store)
+        if cached:
+            body = new_record.model_copy(update={'cached': True}).model_dump_json(by_alias=True)
+            return Response(body, media_type='application/json')
+
+    with metrics.PHASE_SERIALIZATION.time():
+        body = new_record.model_dump_json(by_alias=True).encode()
+    view_cache.set(new_record.id, body, retention.view_expiration(new_record.created_at))
+    return Response(body, media_type='application/json')
+
+@router.get("/{uid}", response_model=RequestModel, responses={
+    304: {'description': 'The result did not change since the ETag sent with If-None-Match'}
+})
+async def view_a_request(
+            uid: UUID4,
+            db = Depends(get_db),
+            if_none_match: str | None = Header(default=None)
+        ):
+    """View a request by its UUID.
+
+    Results never change once stored, so the encoded result is cached and served with an ETag
+    until the result may be compacted or deleted, see app/retention.py.
+    Background requests that are not done yet are never cached.
+    """
+    key = str(uid)
+    cached = view_cache.get(key)
+    if cached is None:
+        result = await find_result(db, key)
+        if result is None:
+            #raise HTTPException(status_code=404, detail="Request not found")
+            raise JSONException(
+                    id='ID_NOT_FOUND',
+                    detail='The requested UUID was not found in the database'
+                )
+        record = RequestModel(**result)
+        with metrics.PHASE_SERIALIZATION.time():
+            body = record.model_dump_json(by_alias=True).encode()
+        if record.state != 'done':
+            return Response(body, media_type='application/json',
+                            headers={'Cache-Control': 'no-store'})
+        cached = view_cache.set(
+            key, body, retention.view_expiration(record.created_at, record.compacted))
+    body, etag = cached
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
@@ -0,0 +1,14 @@
+"""Metrics router, serves the metrics of the API to Prometheus."""
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from app import metrics
+
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=Response, include_in_schema=False)
+async def get_metrics():
+    """Return the metrics of the API in the Prometheus text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
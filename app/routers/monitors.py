@@ -0,0 +1,99 @@
+"""Monitors router, registers the requests checked every interval seconds, see app/monitors.py."""
+
+from datetime import datetime, timezone
+from uuid import uuid4
+from pydantic import UUID4
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import Response
+from app import ssrf
+from app.database import get_db
+from app.models.api import MonitorOptions
+from app.models.database import MonitorModel, MonitorPageModel
+from app.models.shared import JSONException
+from app.settings import settings
+from app.utils import url_info
+
+
+router = APIRouter(prefix="/api/monitors", tags=["monitors"])
+
+
+def _monitor_not_found() -> JSONException:
+    """Return the exception raised when a monitor does not exist."""
+    return JSONException(
+        id='ID_NOT_FOUND',
+        detail='The requested monitor was not found in the database',
+        status_code=404
+    )
+
+
+@router.post("", response_model=MonitorModel, status_code=201)
+async def create_monitor(options: MonitorOptions, db = Depends(get_db)):
+    """Register a request checked every interval seconds.
+
+    The first check runs within MONITORS_SYNC_INTERVAL seconds. Results are listed by
+    GET /api/HTTP?monitor={id}; with diff only when the redirect chain changed.
+    """
+    if options.interval < settings['MONITORS_MIN_INTERVAL']:
+        raise JSONException(
+            id='INTERVAL_TOO_SHORT',
+            detail=f'The interval must be at least {settings["MONITORS_MIN_INTERVAL"]} seconds',
+            status_code=400
+        )
+    url_info(options.url)
+    if options.tenant is not None and options.tenant not in ssrf.tenant_policies:
+        raise JSONException(
+            id='UNKNOWN_TENANT',
+            detail=f'No SSRF policy is configured for the tenant {options.tenant}',
+            status_code=400
+        )
+    now = datetime.now(timezone.utc)
+    monitor = MonitorModel(**options.model_dump(), _id=str(uuid4()), created_at=now)
+    await db.monitors.insert_one(monitor.model_dump(by_alias=True) | {'updated_at': now})
+    return monitor
+
+
+@router.get("", response_model=MonitorPageModel)
+async def list_monitors(
+            limit: int = Query(default=settings['MONITORS_PAGE_SIZE'], ge=1,
+                               le=settings['MONITORS_PAGE_SIZE']),
+            cursor: str | None = None,
+            db = Depends(get_db)
+        ):
+    """List the monitors by id, pages are chained with next_cursor."""
+    query = {'deleted': {'$ne': True}}
+    if cursor is not None:
+        query['_id'] = {'$gt': cursor}
+    documents = [
+        document async for document in db.monitors.find(query, sort=[('_id', 1)], limit=limit + 1)
+    ]
+    next_cursor = documents[limit - 1]['_id'] if len(documents) > limit else None
+    return MonitorPageModel(
+        monitors=[MonitorModel(**document) for document in documents[:limit]],
+        next_cursor=next_cursor
+    )
+
+
+@router.get("/{uid}", response_model=MonitorModel)
+async def view_monitor(uid: UUID4, db = Depends(get_db)):
+    """View a monitor and the state of its last check."""
+    document = await db.monitors.find_one({'_id': str(uid), 'deleted': {'$ne': True}})
+    if document is None:
+        raise _monitor_not_found()
+    return MonitorModel(**document)
+
+
+@router.delete("/{uid}", status_code=204)
+async def delete_monitor(uid: UUID4, db = Depends(get_db)):
+    """Stop checking a monitor, its stored results are kept.
+
+    The monitor is marked as deleted so that the server running it stops at its next sync,
+    and is removed from the database a day later.
+    """
+    now = datetime.now(timezone.utc)
+    result = await db.monitors.update_one(
+        {'_id': str(uid), 'deleted': {'$ne': True}},
+        {'$set': {'deleted': True, 'deleted_at': now, 'updated_at': now}}
+    )
+    if result.matched_count == 0:
+        raise _monitor_not_found()
+    return Response(status_code=204)
@@ -0,0 +1,24 @@
+"""Stats router, serves the statistics of the requested domains."""
+
+from fastapi import APIRouter, Depends, Query
+from app import stats
+from app.database import get_db
+from app.models.api import DomainStats
+from app.settings import settings
+
+
+router = APIRouter(prefix="/api/stats", tags=["stats"])
+
+
+@router.get("/{domain}", response_model=DomainStats)
+async def domain_stats(
+            domain: str,
+            hours: int = Query(default=24, ge=0, le=settings['STATS_MAX_HOURS']),
+            db = Depends(get_db)
+        ):
+    """Return the statistics of a domain: all-time and for each of the last hours.
+
+    The counters are rolled up when the results are stored, see app/stats.py, so reading
+    them costs the same whatever the number of results of the domain.
+    """
+    return await stats.read(db, domain, hours)
@@ -0,0 +1,213 @@
+"""
+This module contains the scheduler of the outgoing requests, polite with the target hosts.
+
+Every hop of a redirect chain waits for a slot of its host before being sent. A host gets
+a slot when it has fewer than HOST_CONCURRENCY requests in flight and a token in its bucket,
+refilled at HOST_RATE tokens per second up to HOST_BURST. At most SCHEDULER_MAX_ACTIVE
+requests are in flight overall, and free slots are given to the waiting hosts in turn
+so that a busy host does not delay the others.
+
+Classes:
+    HostScheduler: Per-host token buckets and concurrency caps, with a fair queue across hosts.
+"""
+
+import asyncio
+from collections import deque
+import time
+from app import metrics
+from app.models.shared import JSONException
+from app.settings import settings
+
+# Idle hosts are forgotten once there are more than this many known hosts
+MAX_IDLE_HOSTS = 10000
+
+
+class _HostState:
+    """Token bucket, requests in flight and queue of a host."""
+
+    __slots__ = ('tokens', 'updated', 'active', 'waiters')
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+
+class _Slot:
+    """Async context manager holding a slot of a host."""
+
+    def __init__(self, scheduler: 'HostScheduler', host: str, timeout: float):
+        self.scheduler = scheduler
+        self.host = host
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.host, self.timeout)
+
+    async def __aexit__(self, *_):
+        self.scheduler.release(self.host)
+
+
+class HostScheduler:
+    """Per-host token buckets and concurrency caps, with a fair queue across hosts."""
+
+    def __init__(self, rate: float, burst: float, host_concurrency: int, max_active: int):
+        """
+        Args:
+            rate (float): Tokens added to the bucket of a host every second, 0 for no rate limit.
+            burst (float): Size of the bucket, the number of requests sent at once to an idle host.
+            host_concurrency (int): Maximum requests in flight to the same host.
+            max_active (int): Maximum requests in flight overall.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.host_concurrency = host_concurrency
+        self.max_active = max_active
+        self.active = 0
+        self._hosts: dict[str, _HostState] = {}
+        # Hosts with waiting requests, in the order they get the next free slot
+        self._turns: deque[str] = deque()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def slot(self, host: str, timeout: float) -> _Slot:
+        """Return an async context manager holding a slot of the host while the block runs.
+
+        Args:
+            host (str): The target host.
+            timeout (float): Maximum seconds to wait in the queue.
+        """
+        return _Slot(self, host, timeout)
+
+    async def acquire(self, host: str, timeout: float) -> None:
+        """Wait for a slot of the given host, it must be released with release().
+
+        Raises:
+            JSONException: If no slot was given within timeout seconds.
+        """
+        state = self._hosts.get(host)
+        if state is None:
+            if len(self._hosts) >= MAX_IDLE_HOSTS:
+                self._forget_idle_hosts()
+            state = self._hosts[host] = _HostState(self.burst)
+        # Fast path: nobody is waiting for the host nor for a global slot, and a slot is free
+        if not state.waiters and (not self._turns or self.active < self.max_active) \
+                and self._try_grant(state):
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        if len(state.waiters) == 1:
+            self._turns.append(host)
+        metrics.HOST_QUEUE_WAITING.inc()
+        try:
+            self._dispatch()
+            await asyncio.wait((waiter,), timeout=timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was given while the request was being cancelled
+                self.release(host)
+            raise
+        finally:
+            metrics.HOST_QUEUE_WAITING.dec()
+            if not waiter.done():
+                waiter.cancel()
+                state.waiters.remove(waiter)
+                if not state.waiters and host in self._turns:
+                    self._turns.remove(host)
+        if waiter.cancelled():
+            raise JSONException(
+                id='HOST_QUEUE_TIMEOUT',
+                detail=f'Too many requests to {host}, the request waited too long in the queue',
+                status_code=429
+            )
+
+    def release(self, host: str) -> None:
+        """Release a slot of the given host and give the free slots to the waiting requests."""
+        state = self._hosts[host]
+        state.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def clear(self) -> None:
+        """Forget every host, the requests in flight must be released before."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._hosts.clear()
+        self._turns.clear()
+        self.active = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the known hosts, the requests in flight and the waiting requests."""
+        return {
+            'hosts': len(self._hosts),
+            'active': self.active,
+            'waiting': sum(len(state.waiters) for state in self._hosts.values())
+        }
+
+    def _refill(self, state: _HostState, now: float) -> None:
+        if self.rate > 0:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        else:
+            state.tokens = self.burst
+        state.updated = now
+
+    def _try_grant(self, state: _HostState) -> bool:
+        """Take a slot of the host if one is free, True on success."""
+        if self.active >= self.max_active or state.active >= self.host_concurrency:
+            return False
+        self._refill(state, time.monotonic())
+        if state.tokens < 1:
+            return False
+        state.tokens -= 1
+        state.active += 1
+        self.active += 1
+        return True
+
+    def _dispatch(self) -> None:
+        """Give the free slots to the waiting hosts, one slot per host in turn."""
+        refill_in = None
+        # Every host is visited at most once per round, the round ends when no slot is given
+        granted = True
+        while granted and self._turns and self.active < self.max_active:
+            granted = False
+            for _ in range(len(self._turns)):
+                host = self._turns.popleft()
+                state = self._hosts[host]
+                while state.waiters and state.waiters[0].done():
+                    state.waiters.popleft()
+                if not state.waiters:
+                    continue
+                if self._try_grant(state):
+                    state.waiters.popleft().set_result(None)
+                    granted = True
+                elif self.rate > 0 and state.tokens < 1 and state.active < self.host_concurrency:
+                    wait = (1 - state.tokens) / self.rate
+                    refill_in = wait if refill_in is None else min(refill_in, wait)
+                if state.waiters:
+                    self._turns.append(host)
+                if self.active >= self.max_active:
+                    break
+        # Wake up when the next bucket has a token again
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if refill_in is not None:
+            self._timer = asyncio.get_running_loop().call_later(refill_in, self._dispatch)
+
+    def _forget_idle_hosts(self) -> None:
+        now = time.monotonic()
+        for host, state in list(self._hosts.items()):
+            self._refill(state, now)
+            if not state.active and not state.waiters and state.tokens >= self.burst:
+                del self._hosts[host]
+
+
+# Scheduler of the requests of the async engine
+host_scheduler = HostScheduler(
+    rate=settings['HOST_RATE'],
+    burst=settings['HOST_BURST'],
+    host_concurrency=settings['HOST_CONCURRENCY'],
+    max_active=settings['SCHEDULER_MAX_ACTIVE']
+)
@@ -0,0 +1,118 @@
+"""This module contains the runtime settings of the application.
+
+Every setting can be overridden with an environment variable of the same name.
+"""
+
+import os
+
+# Ranges that are not reachable on the public Internet: "this" network, private, shared (CGNAT),
+# loopback, link-local, documentation, benchmarking, multicast and reserved addresses
+SSRF_DENY_DEFAULT = ','.join((
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16',
+    '172.16.0.0/12', '192.0.0.0/24', '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15',
+    '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4',
+    '::/96', '64:ff9b:1::/48', '100::/64', '2001:db8::/32', 'fc00::/7', 'fe80::/10',
+    'fec0::/10', 'ff00::/8',
+))
+
+
+def _list(name: str, default: str) -> list[str]:
+    """Return the comma separated values of an environment variable."""
+    return [value.strip() for value in os.environ.get(name, default).split(',') if value.strip()]
+
+# Settings used by the request engine
+settings = {
+    # Engine used to follow the redirect chain: "async" (httpx) or "sync" (requests)
+    'REQUEST_ENGINE': os.environ.get('REQUEST_ENGINE', 'async'),
+    # Time budget in seconds for a whole redirect chain, and the maximum a caller can ask for
+    'REQUEST_TIMEOUT': float(os.environ.get('REQUEST_TIMEOUT', '30')),
+    'REQUEST_TIMEOUT_MAX': float(os.environ.get('REQUEST_TIMEOUT_MAX', '60')),
+    # Maximum number of redirects followed before failing with TOO_MANY_REDIRECTS
+    'MAX_REDIRECTS': int(os.environ.get('MAX_REDIRECTS', '10')),
+    # Response bodies: maximum bytes read when capturing, bytes kept as preview,
+    # and bytes read when not capturing so that the connection can be reused
+    'BODY_MAX_BYTES': int(os.environ.get('BODY_MAX_BYTES', str(10 * 1024 * 1024))),
+    'BODY_PREVIEW_BYTES': int(os.environ.get('BODY_PREVIEW_BYTES', '1024')),
+    'BODY_DRAIN_BYTES': int(os.environ.get('BODY_DRAIN_BYTES', str(64 * 1024))),
+    # Response headers captured: "allow" (the HEADERS_ALLOW ones), "deny" (all but the HEADERS_DENY
+    # ones) or "all", maximum number of headers of a response and maximum length of a value
+    'HEADERS_CAPTURE': os.environ.get('HEADERS_CAPTURE', 'allow'),
+    'HEADERS_ALLOW': _list('HEADERS_ALLOW', 'Content-Type,Content-Length,Date,Server,Location'),
+    'HEADERS_DENY': _list('HEADERS_DENY', 'Set-Cookie'),
+    'HEADERS_MAX_COUNT': int(os.environ.get('HEADERS_MAX_COUNT', '64')),
+    'HEADER_VALUE_MAX_LENGTH': int(os.environ.get('HEADER_VALUE_MAX_LENGTH', '1024')),
+    # Politeness with the target hosts: token bucket (requests per second and burst), requests
+    # in flight per host and overall, seconds a request can wait for a slot of its host
+    'HOST_RATE': float(os.environ.get('HOST_RATE', '10')),
+    'HOST_BURST': float(os.environ.get('HOST_BURST', '20')),
+    'HOST_CONCURRENCY': int(os.environ.get('HOST_CONCURRENCY', '8')),
+    'SCHEDULER_MAX_ACTIVE': int(os.environ.get('SCHEDULER_MAX_ACTIVE', '1000')),
+    'HOST_QUEUE_TIMEOUT': float(os.environ.get('HOST_QUEUE_TIMEOUT', '10')),
+    # Background jobs: maximum number of queued jobs, jobs run at the same time
+    'JOB_QUEUE_MAX_SIZE': int(os.environ.get('JOB_QUEUE_MAX_SIZE', '1000')),
+    'JOB_WORKERS': int(os.environ.get('JOB_WORKERS', '50')),
+    # Batches: maximum number of requests, requests performed at the same time overall and per host
+    'BATCH_MAX_SIZE': int(os.environ.get('BATCH_MAX_SIZE', '1000')),
+    'BATCH_CONCURRENCY': int(os.environ.get('BATCH_CONCURRENCY', '50')),
+    'BATCH_HOST_CONCURRENCY': int(os.environ.get('BATCH_HOST_CONCURRENCY', '4')),
+    # Streamed results: documents stored and read from the database in a single round-trip
+    'STREAM_CHUNK_SIZE': int(os.environ.get('STREAM_CHUNK_SIZE', '100')),
+    # Results listed by GET /api/HTTP: default and maximum number of results per page
+    'HISTORY_PAGE_SIZE': int(os.environ.get('HISTORY_PAGE_SIZE', '50')),
+    'HISTORY_MAX_PAGE_SIZE': int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '500')),
+    # Domain statistics: seconds the hourly counters are kept, maximum hours read at once
+    'STATS_HOURLY_TTL': int(os.environ.get('STATS_HOURLY_TTL', str(90 * 24 * 3600))),
+    'STATS_MAX_HOURS': int(os.environ.get('STATS_MAX_HOURS', str(7 * 24))),
+    # Retention of the results: seconds after which they are deleted, and after which their
+    # responses and requests are dropped (compacted), keeping their summary. 0 keeps them
+    'RESULTS_TTL': int(os.environ.get('RESULTS_TTL', '0')),
+    'RESULTS_COMPACT_AFTER': int(os.environ.get('RESULTS_COMPACT_AFTER', '0')),
+    # Deduplicated storage of the redirect chains, see app/chains.py, and the response headers
+    # changing at every request, stored with the results instead of the chains
+    'RESULTS_DEDUP': os.environ.get('RESULTS_DEDUP', 'false').lower() == 'true',
+    'RESULTS_DEDUP_VOLATILE_HEADERS': _list(
+        'RESULTS_DEDUP_VOLATILE_HEADERS',
+        'Date,Age,Expires,Set-Cookie,CF-RAY,X-Request-Id,X-Timer,X-Served-By,X-Cache,'
+        'X-Cache-Hits,Server-Timing'),
+    # Compaction of the results: seconds between two passes, results compacted by every update
+    'RESULTS_COMPACT_INTERVAL': float(os.environ.get('RESULTS_COMPACT_INTERVAL', '3600')),
+    'RESULTS_COMPACT_BATCH': int(os.environ.get('RESULTS_COMPACT_BATCH', '1000')),
+    # Monitors, see app/monitors.py: whether this server can run them, checks in flight at once,
+    # shortest interval in seconds, seconds between two reads of the changed monitors, seconds
+    # a server keeps running them after its last renewal of the lease, monitors listed per page
+    'MONITORS_ENABLED': os.environ.get('MONITORS_ENABLED', 'true').lower() == 'true',
+    'MONITORS_CONCURRENCY': int(os.environ.get('MONITORS_CONCURRENCY', '100')),
+    'MONITORS_MIN_INTERVAL': float(os.environ.get('MONITORS_MIN_INTERVAL', '60')),
+    'MONITORS_SYNC_INTERVAL': float(os.environ.get('MONITORS_SYNC_INTERVAL', '5')),
+    'MONITORS_LEASE_TTL': float(os.environ.get('MONITORS_LEASE_TTL', '30')),
+    'MONITORS_PAGE_SIZE': int(os.environ.get('MONITORS_PAGE_SIZE', '100')),
+    # Results cache: maximum number of results and maximum age a request can accept, in seconds
+    'RESULT_CACHE_MAX_SIZE': int(os.environ.get('RESULT_CACHE_MAX_SIZE', '10000')),
+    'RESULT_CACHE_MAX_AGE': float(os.environ.get('RESULT_CACHE_MAX_AGE', '3600')),
+    # Results cache shared by the worker processes: "memory" (none) or "mongo"
+    'RESULT_CACHE_BACKEND': os.environ.get('RESULT_CACHE_BACKEND', 'memory'),
+    # Encoded results served by GET /api/HTTP/{uid}: maximum number of results and total bytes
+    'VIEW_CACHE_MAX_ENTRIES': int(os.environ.get('VIEW_CACHE_MAX_ENTRIES', '10000')),
+    'VIEW_CACHE_MAX_BYTES': int(os.environ.get('VIEW_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    # Readiness probe: seconds to wait for every dependency, and the fraction of the job queue,
+    # of the outgoing requests or of the connection pool in use above which the server is
+    # reported saturated
+    'READY_TIMEOUT': float(os.environ.get('READY_TIMEOUT', '1')),
+    'READY_SATURATION': float(os.environ.get('READY_SATURATION', '0.9')),
+    # SSRF protection: CIDR ranges and host patterns ("name" or "*.domain") that can not be
+    # requested, the allowed ones override them, and the JSON file of the tenant policies
+    'SSRF_DENY': _list('SSRF_DENY', SSRF_DENY_DEFAULT),
+    'SSRF_ALLOW': _list('SSRF_ALLOW', ''),
+    'SSRF_DENY_HOSTS': _list('SSRF_DENY_HOSTS', 'localhost,*.localhost,*.local,*.internal'),
+    'SSRF_ALLOW_HOSTS': _list('SSRF_ALLOW_HOSTS', ''),
+    'SSRF_POLICY_FILE': os.environ.get('SSRF_POLICY_FILE', ''),
+    # DNS resolutions cache: TTL in seconds of resolved and unresolvable domains, maximum size
+    'DNS_CACHE_TTL': float(os.environ.get('DNS_CACHE_TTL', '60')),
+    'DNS_CACHE_NEGATIVE_TTL': float(os.environ.get('DNS_CACHE_NEGATIVE_TTL', '10')),
+    'DNS_CACHE_MAX_SIZE': int(os.environ.get('DNS_CACHE_MAX_SIZE', '10000')),
+    # Connection pool of the shared async HTTP client, and whether it negotiates HTTP/2 with ALPN
+    'HTTP2': os.environ.get('HTTP2', 'false').lower() == 'true',
+    'HTTP_MAX_CONNECTIONS': int(os.environ.get('HTTP_MAX_CONNECTIONS', '1000')),
+    'HTTP_MAX_KEEPALIVE_CONNECTIONS': int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', '200')),
+    'HTTP_KEEPALIVE_EXPIRY': float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30')),
+}
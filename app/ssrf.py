@@ -0,0 +1,240 @@
+"""
+This module contains the SSRF policies: the hosts and the addresses the API may connect to.
+
+A policy is made of allowed and denied CIDR ranges and host patterns, compiled once when the
+server starts. The ranges become sorted and merged intervals for each IP version, so an
+address is checked with a binary search whatever the number of ranges. The host patterns
+are exact names or "*.domain" for every subdomain, looked up by suffix in sets. Names are
+compared IDNA-encoded, so "bücher.example" and "xn--bcher-kva.example" are the same host.
+
+A host matching a denied pattern is refused, a host matching an allowed pattern is accepted
+whatever its addresses. Otherwise every resolved address of the host must be accepted: an
+address in an allowed range is accepted, an address in a denied range is refused and any
+other address is accepted. IPv4 addresses embedded in IPv6 ones (IPv4-mapped, 6to4, NAT64)
+are checked as IPv4 addresses.
+
+The policies of the tenants are read from the JSON file SSRF_POLICY_FILE. They are applied
+on top of the default policy, so a tenant can only refuse more.
+
+The addresses approved for a hop are kept in the pinned_addresses context variable: the
+transports of both request engines only connect to them, see app/utils.py.
+
+Classes:
+    SSRFPolicy: Compiled allow and deny lists of CIDR ranges and host patterns.
+
+Functions:
+    load_tenant_policies: Read and compile the policies of the tenants.
+    allows: Return True if the policies allow connecting to the host at the given addresses.
+"""
+
+from bisect import bisect_right
+from contextvars import ContextVar
+import ipaddress
+import json
+from typing import Iterable
+from app.models.shared import JSONException
+from app.settings import settings
+
+IPAddress = ipaddress.IPv4Address | ipaddress.IPv6Address
+
+# IPv6 prefix of the IPv4 addresses translated by NAT64 (RFC 6052)
+NAT64_PREFIX = ipaddress.IPv6Network('64:ff9b::/96')
+
+
+class _IntervalIndex:
+    """Sorted and merged intervals of addresses, searched with a binary search."""
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, networks: Iterable[ipaddress.IPv4Network | ipaddress.IPv6Network]):
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        intervals = sorted((int(net.network_address), int(net.broadcast_address))
+                           for net in networks)
+        for start, end in intervals:
+            # Overlapping and adjacent ranges are merged
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, address: int) -> bool:
+        index = bisect_right(self.starts, address) - 1
+        return index >= 0 and address <= self.ends[index]
+
+
+class _HostPatterns:
+    """Exact host names and "*.domain" patterns, matched without scanning the patterns."""
+
+    __slots__ = ('names', 'domains')
+
+    def __init__(self, patterns: Iterable[str]):
+        self.names: set[str] = set()
+        self.domains: set[str] = set()
+        for pattern in patterns:
+            pattern = _normalize_host(pattern)
+            if pattern.startswith('*.'):
+                self.domains.add(pattern[2:])
+            else:
+                self.names.add(pattern)
+
+    def match(self, host: str) -> bool:
+        """Return True if the normalized host matches a pattern."""
+        if host in self.names:
+            return True
+        if not self.domains:
+            return False
+        # Every parent domain of the host, "a.b.example.com" -> "b.example.com", "example.com"...
+        position = host.find('.')
+        while position != -1:
+            if host[position + 1:] in self.domains:
+                return True
+            position = host.find('.', position + 1)
+        return False
+
+
+def _normalize_host(host: str) -> str:
+    """Lowercase the host, remove the trailing dot of fully qualified names and IDNA-encode
+    internationalized names, as they are dialled."""
+    host = host.strip().lower().rstrip('.')
+    if not host.isascii():
+        host = host.encode('idna').decode('ascii')
+    return host
+
+
+def _unwrap(address: IPAddress) -> IPAddress:
+    """Return the IPv4 address embedded in an IPv6 address, or the address itself."""
+    if address.version == 6:
+        embedded = address.ipv4_mapped or address.sixtofour
+        if embedded is None and address in NAT64_PREFIX:
+            embedded = ipaddress.IPv4Address(int(address) & 0xFFFFFFFF)
+        if embedded is not None:
+            return embedded
+    return address
+
+
+class SSRFPolicy:
+    """Compiled allow and deny lists of CIDR ranges and host patterns."""
+
+    def __init__(
+                self,
+                allow: Iterable[str] = (),
+                deny: Iterable[str] = (),
+                allow_hosts: Iterable[str] = (),
+                deny_hosts: Iterable[str] = ()
+            ):
+        """
+        Args:
+            allow (Iterable[str]): CIDR ranges accepted even if they are in a denied range.
+            deny (Iterable[str]): CIDR ranges refused.
+            allow_hosts (Iterable[str]): Host patterns accepted whatever their addresses.
+            deny_hosts (Iterable[str]): Host patterns refused.
+
+        Raises:
+            ValueError: If a CIDR range is invalid.
+        """
+        self._allow = self._compile(allow)
+        self._deny = self._compile(deny)
+        self._allow_hosts = _HostPatterns(allow_hosts)
+        self._deny_hosts = _HostPatterns(deny_hosts)
+
+    @classmethod
+    def from_dict(cls, config: dict) -> 'SSRFPolicy':
+        """Build a policy from a dict with the optional lists "allow", "deny", "allow_hosts"
+        and "deny_hosts"."""
+        unknown = set(config) - {'allow', 'deny', 'allow_hosts', 'deny_hosts'}
+        if unknown:
+            raise ValueError(f'Unknown keys in the SSRF policy: {", ".join(sorted(unknown))}')
+        return cls(**config)
+
+    @staticmethod
+    def _compile(cidrs: Iterable[str]) -> dict[int, _IntervalIndex]:
+        networks = [ipaddress.ip_network(cidr.strip(), strict=False) for cidr in cidrs]
+        return {
+            version: _IntervalIndex(net for net in networks if net.version == version)
+            for version in (4, 6)
+        }
+
+    def allows_address(self, address: IPAddress) -> bool:
+        """Return True if the policy accepts the given address."""
+        address = _unwrap(address)
+        value = int(address)
+        if value in self._allow[address.version]:
+            return True
+        return value not in self._deny[address.version]
+
+    def allows(self, host: str, addresses: Iterable[str]) -> bool:
+        """Return True if the policy accepts the host and every one of its addresses.
+
+        Args:
+            host (str): The host of the URL, a name or an IP address.
+            addresses (Iterable[str]): Every resolved address of the host.
+        """
+        host = _normalize_host(host)
+        if self._deny_hosts.match(host):
+            return False
+        if self._allow_hosts.match(host):
+            return True
+        return all(self.allows_address(ipaddress.ip_address(address)) for address in addresses)
+
+
+def load_tenant_policies(path: str) -> dict[str, SSRFPolicy]:
+    """Read and compile the policies of the tenants.
+
+    Args:
+        path (str): JSON file mapping every tenant to its policy, see SSRFPolicy.from_dict.
+                    No tenant is configured when empty.
+
+    Raises:
+        OSError: If the file can not be read.
+        ValueError: If the file or one of its policies is invalid.
+
+    Returns:
+        dict[str, SSRFPolicy]: The policy of every tenant.
+    """
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as file:
+        config = json.load(file)
+    return {tenant: SSRFPolicy.from_dict(policy) for tenant, policy in config.items()}
+
+
+# Policy applied to every request
+default_policy = SSRFPolicy(
+    allow=settings['SSRF_ALLOW'],
+    deny=settings['SSRF_DENY'],
+    allow_hosts=settings['SSRF_ALLOW_HOSTS'],
+    deny_hosts=settings['SSRF_DENY_HOSTS']
+)
+
+# Policies applied on top of the default one to the requests of a tenant
+tenant_policies = load_tenant_policies(settings['SSRF_POLICY_FILE'])
+
+# IDNA-encoded host -> IP addresses approved for the hop running in the current task, or in
+# the current thread for the sync engine: the transports only connect to them
+pinned_addresses: ContextVar[dict[str, tuple[str, ...]]] = ContextVar('pinned_addresses')
+
+
+def allows(host: str, addresses: Iterable[str], tenant: str | None = None) -> bool:
+    """Return True if the policies allow connecting to the host at the given addresses.
+
+    Args:
+        host (str): The host of the URL, a name or an IP address.
+        addresses (Iterable[str]): Every resolved address of the host.
+        tenant (str | None, optional): The tenant whose policy is applied too.
+
+    Raises:
+        JSONException: If no policy is configured for the tenant.
+    """
+    policies = [default_policy]
+    if tenant is not None:
+        if tenant not in tenant_policies:
+            raise JSONException(
+                id='UNKNOWN_TENANT',
+                detail=f'No SSRF policy is configured for the tenant {tenant}',
+                status_code=400
+            )
+        policies.append(tenant_policies[tenant])
+    addresses = tuple(addresses)
+    return all(policy.allows(host, addresses) for policy in policies)
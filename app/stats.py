@@ -0,0 +1,149 @@
+"""
+This module contains the statistics of the requested domains, rolled up as results are stored.
+
+Every stored result increments the counters of its domain twice: in the all-time document of
+the domain (collection domain_stats, _id is the domain) and in the document of the domain
+and the hour it was performed (collection domain_stats_hourly). The counters of the results
+stored together are summed first, so that a batch costs one bulk write per collection, with
+one upsert per domain or per domain and hour. Reading the statistics of a domain never scans
+the results.
+
+Counters of a document:
+    requests: Number of results.
+    hops: Results by number of responses in the redirect chain.
+    status: Results by status code of the last response.
+    servers: Results by Server header of the last response.
+
+Only completed redirect chains are counted: failed requests do not store their URL.
+
+Functions:
+    record: Increment the counters of the domains of the given result documents.
+    read: Return the all-time and the hourly counters of a domain.
+"""
+
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+import logging
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from app import headers, metrics
+
+logger = logging.getLogger(__name__)
+
+# Counters incremented by every result, see _increments
+COUNTERS = ('hops', 'status', 'servers')
+
+# Maximum length of a Server header counted, longer ones are truncated
+MAX_SERVER_LENGTH = 64
+
+
+def _escape(key: str) -> str:
+    """Escape a counter name, MongoDb field names can not contain dots nor start with $."""
+    return key.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def _unescape(key: str) -> str:
+    """Return the original name of an escaped counter."""
+    return key.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+def _hour(created_at: datetime) -> datetime:
+    """Return the start of the UTC hour of the given date."""
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _increments(document: dict) -> Counter | None:
+    """Return the counters incremented by a result document, None if it is not counted."""
+    data = document.get('data')
+    if document.get('state', 'done') != 'done' or not data or not data.get('response'):
+        return None
+    last = data['response'][-1]
+    server = headers.expand(last.get('headers') or {}).get('Server', '')
+    server = server[:MAX_SERVER_LENGTH] or 'unknown'
+    return Counter({
+        'requests': 1,
+        f'hops.{len(data["response"])}': 1,
+        f'status.{last["status_code"]}': 1,
+        f'servers.{_escape(server)}': 1,
+    })
+
+
+async def record(db: AsyncIOMotorDatabase, documents: list[dict]) -> None:
+    """Increment the counters of the domains of the given result documents.
+
+    Errors are logged and not raised: the results are stored anyway.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database of the results.
+        documents (list[dict]): The stored result documents.
+    """
+    totals: defaultdict[str, Counter] = defaultdict(Counter)
+    hourly: defaultdict[tuple[str, datetime], Counter] = defaultdict(Counter)
+    for document in documents:
+        increments = _increments(document)
+        if increments is None:
+            continue
+        domain = document['data']['url']['domain']
+        totals[domain].update(increments)
+        hourly[domain, _hour(document['created_at'])].update(increments)
+    if not totals:
+        return
+
+    try:
+        with metrics.PHASE_MONGO_INSERT.time():
+            await asyncio.gather(
+                db.domain_stats.bulk_write([
+                    UpdateOne({'_id': domain}, {'$inc': dict(increments)}, upsert=True)
+                    for domain, increments in totals.items()
+                ], ordered=False),
+                db.domain_stats_hourly.bulk_write([
+                    UpdateOne(
+                        {'_id': f'{domain}|{hour.isoformat()}'},
+                        {'$inc': dict(increments),
+                         '$setOnInsert': {'domain': domain, 'hour': hour}},
+                        upsert=True
+                    )
+                    for (domain, hour), increments in hourly.items()
+                ], ordered=False)
+            )
+    except PyMongoError:
+        logger.exception('Statistics of %d results could not be updated', len(documents))
+
+
+def _counters(document: dict | None) -> dict:
+    """Return the counters of a statistics document, with their original names."""
+    document = document or {}
+    return {'requests': document.get('requests', 0)} | {
+        counter: {_unescape(key): value for key, value in document.get(counter, {}).items()}
+        for counter in COUNTERS
+    }
+
+
+async def read(db: AsyncIOMotorDatabase, domain: str, hours: int) -> dict:
+    """Return the all-time and the hourly counters of a domain.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database of the results.
+        domain (str): The domain, as stored in data.url.domain.
+        hours (int): Number of past hours, the current one included, of the hourly counters.
+
+    Returns:
+        dict: The domain, its all-time counters and the counters of every hour with results,
+              oldest first.
+    """
+    since = _hour(datetime.now(timezone.utc)) - timedelta(hours=hours - 1)
+    with metrics.PHASE_MONGO_FIND.time():
+        total = await db.domain_stats.find_one({'_id': domain})
+        hourly = [] if hours == 0 else [
+            document async for document in db.domain_stats_hourly.find(
+                {'domain': domain, 'hour': {'$gte': since}}, sort=[('hour', 1)])
+        ]
+    return {
+        'domain': domain,
+        'total': _counters(total),
+        'hourly': [{'hour': document['hour']} | _counters(document) for document in hourly],
+    }
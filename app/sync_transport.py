@@ -0,0 +1,88 @@
+"""
+This module contains the transport of the sync engine, see REQUEST_ENGINE.
+
+Like the shared asynchronous client of app/utils.py, the sessions of the sync engine only
+connect to the IP addresses approved by the SSRF check of the hop, so a second DNS lookup
+can not point the connection somewhere else (DNS rebinding). It is imported by the sync
+engine only, so that requests is not imported when the server starts.
+
+Classes:
+    PinnedHTTPAdapter: Requests adapter whose connections are opened to the approved addresses.
+"""
+
+import socket
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection
+from app.ssrf import pinned_addresses
+
+
+class _PinnedConnectionMixin:  # pylint: disable=too-few-public-methods
+    """Opens the socket of an urllib3 connection to the approved addresses of its host.
+
+    They are tried in order until a connection succeeds. Connections to hosts that were not
+    approved are refused.
+    """
+
+    def _new_conn(self) -> socket.socket:
+        # The host as dialled, IDNA-encoded like the keys of the approved addresses
+        addresses = pinned_addresses.get({}).get(self._dns_host.lower())
+        if not addresses:
+            raise NewConnectionError(self, f'The address of {self.host} was not approved')
+        for ip in addresses[:-1]:
+            try:
+                return self._connect_to(ip)
+            except (OSError, NewConnectionError, ConnectTimeoutError):
+                continue
+        return self._connect_to(addresses[-1])
+
+    def _connect_to(self, ip: str) -> socket.socket:
+        """Open a socket to the given address, errors are raised like urllib3 does."""
+        try:
+            return connection.create_connection(
+                (ip, self.port), self.timeout, source_address=self.source_address,
+                socket_options=self.socket_options
+            )
+        except socket.timeout as exc:
+            raise ConnectTimeoutError(self, f'Connection to {self.host} timed out') from exc
+        except OSError as exc:
+            raise NewConnectionError(
+                self, f'Failed to establish a new connection: {exc}') from exc
+
+
+class _PinnedHTTPConnection(_PinnedConnectionMixin, HTTPConnection):
+    """HTTP connection opened to the approved addresses."""
+
+
+class _PinnedHTTPSConnection(_PinnedConnectionMixin, HTTPSConnection):
+    """HTTPS connection opened to the approved addresses, the certificate is checked against
+    the host name."""
+
+
+class _PinnedHTTPConnectionPool(HTTPConnectionPool):
+    """Pool of _PinnedHTTPConnection."""
+
+    ConnectionCls = _PinnedHTTPConnection
+
+
+class _PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    """Pool of _PinnedHTTPSConnection."""
+
+    ConnectionCls = _PinnedHTTPSConnection
+
+
+class PinnedHTTPAdapter(HTTPAdapter):
+    """Requests adapter whose connections are opened to the approved addresses.
+
+    The approved addresses are set by the hop in the pinned_addresses context variable of
+    app/ssrf.py.
+    """
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _PinnedHTTPConnectionPool,
+            'https': _PinnedHTTPSConnectionPool
+        }
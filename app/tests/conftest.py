@@ -1,18 +1,73 @@
 """This module contains fixtures that are used across multiple test files."""
 
-from typing import Generator, Any
+from contextlib import ExitStack
+from typing import Callable, Generator, Any
 import secrets
+import socket
+from unittest import mock
+import httpx
 import pytest
 from fastapi.testclient import TestClient
+from pymongo import MongoClient
 from pymongo.database import Database
 from ..main import app
 from .. import database
+from ..utils import dns_cache
+from ..cache import result_cache, view_cache
+from ..metrics import REGISTRY
+from ..scheduler import host_scheduler
+
+
+def addrinfo(*addresses: str) -> list[tuple]:
+    """Return the result of socket.getaddrinfo resolving a host to the given addresses"""
+    return [
+        (socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM, 6, '',
+         (address, 0))
+        for address in addresses
+    ]
+
+
+@pytest.fixture
+def mock_http() -> Generator[Callable[..., ExitStack], Any, None]:
+    """
+    Return a function patching the resolver and the shared async HTTP client: every host
+    resolves to the given addresses, 123.1.2.3 by default, and every request is answered by
+    the given handler. The patches are undone when its result is used as a context manager,
+    or when the test terminates
+    """
+    with ExitStack() as patches:
+        def patch(handler: Callable, *addresses: str) -> ExitStack:
+            stack = patches.enter_context(ExitStack())
+            stack.enter_context(mock.patch('app.utils.socket.getaddrinfo',
+                                           return_value=addrinfo(*addresses or ('123.1.2.3',))))
+            stack.enter_context(mock.patch(
+                'app.utils.get_http_client',
+                return_value=httpx.AsyncClient(transport=httpx.MockTransport(handler))))
+            return stack
+        yield patch
 
 
 # https://www.fastapitutorial.com/blog/unit-testing-in-fastapi/
 # https://fastapi.tiangolo.com/advanced/testing-database/
 
 
+@pytest.fixture(autouse=True)
+def clear_caches() -> Generator[None, Any, None]:
+    """
+    Start every test with empty caches and metrics, so that mocked resolutions and results
+    do not leak between tests
+    """
+    dns_cache.clear()
+    result_cache.clear()
+    view_cache.clear()
+    host_scheduler.clear()
+    REGISTRY.reset()
+    yield
+    dns_cache.clear()
+    result_cache.clear()
+    view_cache.clear()
+
+
 @pytest.fixture(scope="function")
 def test_db() -> Generator[Database, Any, None]:
     """
@@ -20,10 +75,18 @@ def test_db() -> Generator[Database, Any, None]:
     """
     #test db creation
     test_db_name = "pytest-" + secrets.token_hex(16)
-    temp_db = database.client[test_db_name]
+    config = database.get_config()
+    sync_client = MongoClient(
+        config['host'],
+        config['port'],
+        username=config['user'],
+        password=config['password']
+    )
+    temp_db = sync_client[test_db_name]
     yield temp_db
     #test db cleanup
-    database.client.drop_database(test_db_name)
+    sync_client.drop_database(test_db_name)
+    sync_client.close()
 
 
 @pytest.fixture(scope="function")
@@ -36,9 +99,10 @@ def client(
     """
 
     def _get_test_db():
-        """ Return a test version of the MongoDb Scanner database
+        """ Return a test version of the MongoDb Scanner database, using the async client
+        created by the app when it starts
         """
-        return test_db
+        return database.client[test_db.name]
 
     app.dependency_overrides[database.get_db] = _get_test_db
     with TestClient(app) as test_client:
@@ -0,0 +1,153 @@
+"""Test for cache module in app/cache.py"""
+
+import asyncio
+from unittest import mock
+import pytest
+from app.cache import normalize_url, etag_matches, ResultCache, EncodedCache, MongoCacheBackend
+from app.models.database import RequestModel
+
+
+def make_record(uid: str) -> RequestModel:
+    """Return a minimal record to store in the cache"""
+    return RequestModel(_id=uid, status=200, errors=None, data=None)
+
+
+@pytest.mark.parametrize("url,normalized", [
+        ("HTTPS://WWW.Google.com", "https://www.google.com/"),
+        ("https://www.google.com:443/search?q=1#top", "https://www.google.com/search?q=1"),
+        ("http://www.google.com:8080/Search", "http://www.google.com:8080/Search"),
+        ("http://[::1]:80/", "http://[::1]/"),
+    ])
+def test_normalize_url(url, normalized):
+    """Test normalize_url function from cache.py module"""
+    assert normalize_url(url) == normalized
+
+
+def test_result_cache_lru():
+    """Test ResultCache class from cache.py module
+
+        Test if results older than max_age are ignored and the least recently used is evicted
+    """
+    cache = ResultCache(max_size=2)
+    first = cache.key('get', 'https://first.google.com')
+    second = cache.key('GET', 'https://second.google.com')
+    cache.set(first, make_record('1'))
+    cache.set(second, make_record('2'))
+    assert cache.get(first, max_age=60).id == '1'
+    assert cache.get(first, max_age=-1) is None
+    cache.set(cache.key('GET', 'https://third.google.com'), make_record('3'))
+    assert cache.get(second, max_age=60) is None
+    assert cache.get(first, max_age=60).id == '1'
+
+
+def test_result_cache_single_flight():
+    """Test ResultCache class from cache.py module
+
+        Test if concurrent misses of the same key share a single fetch
+    """
+    cache = ResultCache(max_size=10)
+    key = cache.key('GET', 'https://www.google.com/')
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return make_record(str(len(calls)))
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_fetch(key, 60, fetch) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert [record.id for record, _ in results] == ['1'] * 5
+    assert [cached for _, cached in results] == [False, True, True, True, True]
+    assert cache.stats() == {'size': 1, 'hits': 4, 'misses': 1}
+
+
+def test_encoded_cache_bounds():
+    """Test EncodedCache class from cache.py module
+
+        Test if the cache is bounded by the number of entries and by the total bytes
+    """
+    cache = EncodedCache(max_entries=3, max_bytes=10)
+    body, etag = cache.set('a', b'aaaa')
+    assert cache.get('a') == (body, etag)
+    cache.set('b', b'bbbb')
+    cache.set('c', b'cccc')
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 8
+    cache.set('d', b'd' * 11)
+    assert cache.get('d') is None
+    assert cache.get('c') == (b'cccc', EncodedCache.etag(b'cccc'))
+
+
+def test_encoded_cache_expiration():
+    """Test EncodedCache class from cache.py module
+
+        Test if the entries are not served after their expiration, and already expired
+        entries are not stored
+    """
+    cache = EncodedCache(max_entries=3, max_bytes=10)
+    with mock.patch('app.cache.time.time', return_value=1000):
+        cache.set('a', b'aaaa', expires=1010)
+        cache.set('b', b'bbbb', expires=1000)
+        cache.set('c', b'cccc')
+        assert cache.get('a') == (b'aaaa', EncodedCache.etag(b'aaaa'))
+        assert cache.get('b') is None
+    with mock.patch('app.cache.time.time', return_value=1010):
+        assert cache.get('a') is None
+        assert cache.get('c') == (b'cccc', EncodedCache.etag(b'cccc'))
+    assert cache.stats()['bytes'] == 4
+
+
+@pytest.mark.parametrize("if_none_match,matches", [
+        (None, False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"xyz", "abc"', True),
+        ('*', True),
+        ('"xyz"', False),
+    ])
+def test_etag_matches(if_none_match, matches):
+    """Test etag_matches function from cache.py module"""
+    assert etag_matches(if_none_match, '"abc"') is matches
+
+
+class FakeCacheCollection:
+    """Collection of the shared cache, supports the queries of MongoCacheBackend only"""
+
+    def __init__(self):
+        self.entries = {}
+
+    async def find_one(self, query):
+        """Return the entry of the _id stored since the given date"""
+        entry = self.entries.get(query['_id'])
+        if entry is None or entry['stored_at'] < query['stored_at']['$gte']:
+            return None
+        return entry
+
+    async def replace_one(self, query, entry, **_):
+        """Store the entry, always upserted"""
+        self.entries[query['_id']] = entry
+
+
+def test_result_cache_shared():
+    """Test if a result fetched by a worker process is served to the others"""
+    backend = MongoCacheBackend(FakeCacheCollection())
+    worker_1 = ResultCache(max_size=10, shared=backend)
+    worker_2 = ResultCache(max_size=10, shared=backend)
+    key = ResultCache.key('GET', 'https://www.google.com/')
+
+    async def fetch():
+        return make_record('1')
+
+    async def unexpected_fetch():
+        raise AssertionError('the result should be shared')
+
+    async def run():
+        assert await worker_1.get_or_fetch(key, 60, fetch) == (make_record('1'), False)
+        assert await worker_2.get_or_fetch(key, 60, unexpected_fetch) == (make_record('1'), True)
+        # Now in the cache of the second worker too
+        assert worker_2.get(key, 60) == make_record('1')
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+"""Test for the deduplicated storage of the redirect chains in app/chains.py"""
+
+from datetime import datetime, timezone
+from app import chains
+
+
+def _document(uid: str, date: str, ttfb: float) -> dict:
+    return {
+        '_id': uid,
+        'created_at': datetime(2023, 11, 20, tzinfo=timezone.utc),
+        'status': 200,
+        'errors': None,
+        'summary': {'status_code': 200, 'hops': 1, 'error': None},
+        'data': {
+            'url': {'url': 'https://example.com/', 'protocol': 'https',
+                    'domain': 'example.com', 'path': '/'},
+            'response': [{
+                'http_version': 'HTTP/2',
+                'status_code': 200,
+                'headers': [0, 'text/html', 2, date, 'X-Custom', 'a'],
+                'timings': {'dns': 1.0, 'ttfb': ttfb},
+                'connection_reused': False,
+            }],
+            'request': [{'method': 'GET', 'url': 'https://example.com/'}],
+        },
+    }
+
+
+def test_split_and_merge():
+    """Test that the results of the same chain share it and are rebuilt from it"""
+    first = _document('a', 'Mon, 20 Nov 2023 10:00:00 GMT', 10.5)
+    second = _document('b', 'Tue, 21 Nov 2023 10:00:00 GMT', 12.0)
+
+    first_result, first_chain = chains.split(first)
+    second_result, second_chain = chains.split(second)
+    assert first_result['chain'] == second_result['chain']
+    assert first_chain == second_chain == {
+        'request': [{'method': 'GET', 'url': 'https://example.com/'}],
+        'response': [{'http_version': 'HTTP/2', 'status_code': 200,
+                      'headers': [0, 'text/html', 'X-Custom', 'a']}],
+    }
+    assert second_result['data']['response'] == [{
+        'timings': {'dns': 1.0, 'ttfb': 12.0},
+        'connection_reused': False,
+        'headers': [2, 'Tue, 21 Nov 2023 10:00:00 GMT'],
+        'header_positions': [1],
+    }]
+    assert second_result['summary'] == second['summary']
+
+    # The headers are rebuilt in the captured order
+    merged = chains._merge(second_result, second_chain)  # pylint: disable=protected-access
+    assert merged['data']['response'] == second['data']['response']
+    assert merged['data']['request'] == second['data']['request']
+    assert 'chain' not in merged
+
+    # Results stored without the positions get their volatile headers last
+    del second_result['data']['response'][0]['header_positions']
+    merged = chains._merge(second_result, second_chain)  # pylint: disable=protected-access
+    assert merged['data']['response'][0]['headers'] == \
+        [0, 'text/html', 'X-Custom', 'a', 2, 'Tue, 21 Nov 2023 10:00:00 GMT']
+
+    # A different stable header is a different chain
+    third = _document('c', 'Mon, 20 Nov 2023 10:00:00 GMT', 10.5)
+    third['data']['response'][0]['headers'][5] = 'b'
+    assert chains.split(third)[0]['chain'] != first_result['chain']
+
+    # Failed results have no chain
+    failed = {'_id': 'd', 'status': 500, 'errors': {'id': 'SSRF_DETECTED'}, 'data': None}
+    assert chains.split(failed) == (failed, None)
+
+
+def test_merge_expired_chain():
+    """Test that a result whose chain expired is returned as compacted"""
+    result, _ = chains.split(_document('a', 'Mon, 20 Nov 2023 10:00:00 GMT', 10.5))
+    merged = chains._merge(result, None)  # pylint: disable=protected-access
+    assert merged['compacted'] is True
+    assert merged['data'] == {'url': result['data']['url']}
+    assert 'chain' not in merged
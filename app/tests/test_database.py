@@ -1,12 +1,18 @@
 """Database tests"""
 
-from pymongo.database import Database
+import asyncio
+import os
+from unittest import mock
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson.raw_bson import RawBSONDocument
 from bson import CodecOptions
-from app.database import config, get_db
+from pymongo.errors import BulkWriteError
+from app import database
+from app.database import get_config, get_db, WriteBehindBuffer
 
 def test_database_config():
     """Test the database configuration"""
+    config = get_config()
     assert len(config['host']) > 0
     assert isinstance(config['port'], int)
     assert len(config['user']) > 0
@@ -16,9 +22,116 @@ def test_database_config():
 def test_get_db():
     """Test the database connection"""
     # This is the real database, tests should not write or read from it
-    db = get_db()
-    assert isinstance(db, Database)
-    # Perform a non-intrusive ping
-    options = CodecOptions(RawBSONDocument)
-    result = db.command("ping", codec_options=options)
+    async def ping():
+        try:
+            db = get_db()
+            assert isinstance(db, AsyncIOMotorDatabase)
+            # Perform a non-intrusive ping
+            options = CodecOptions(RawBSONDocument)
+            return await db.command("ping", codec_options=options)
+        finally:
+            await database.shutdown()
+
+    result = asyncio.run(ping())
     assert isinstance(result, RawBSONDocument)
+
+
+class FakeCollection:  # pylint: disable=too-few-public-methods
+    """Collection that records the insert_many calls, refusing the given write errors"""
+    full_name = "test.results"
+
+    def __init__(self, write_errors=()):
+        self.inserted = []
+        self.write_errors = list(write_errors)
+
+    async def insert_many(self, documents, **_):
+        """Record the inserted documents, raise the write errors if any"""
+        self.inserted.append(list(documents))
+        if self.write_errors:
+            raise BulkWriteError({'writeErrors': self.write_errors})
+
+
+def test_write_behind_buffer():
+    """Test the write-behind buffer
+
+        Documents are readable before they are flushed, and flushed when the buffer is full
+        or when the buffer is stopped
+    """
+    collection = FakeCollection()
+
+    async def run():
+        buffer = WriteBehindBuffer(max_size=2, max_delay=60)
+        buffer.start()
+        buffer.add(collection, [{'_id': '1'}])
+        assert buffer.get(collection, '1') == {'_id': '1'}
+        assert not collection.inserted
+        buffer.add(collection, [{'_id': '2'}])
+        await asyncio.sleep(0)
+        assert collection.inserted == [[{'_id': '1'}, {'_id': '2'}]]
+        buffer.add(collection, [{'_id': '3'}])
+        await buffer.stop()
+        assert buffer.get(collection, '3') is None
+
+    asyncio.run(run())
+    assert collection.inserted == [[{'_id': '1'}, {'_id': '2'}], [{'_id': '3'}]]
+
+
+def test_write_behind_buffer_prepare():
+    """Test that the documents prepared by the write-behind buffer are inserted, and the
+    buffered ones are read back and passed to on_insert"""
+    collection = FakeCollection()
+    inserted = []
+
+    async def prepare(_, documents):
+        return [document | {'prepared': True} for document in documents]
+
+    async def on_insert(_, documents):
+        inserted.extend(documents)
+
+    async def run():
+        buffer = WriteBehindBuffer(max_size=10, max_delay=60, on_insert=on_insert,
+                                   prepare=prepare)
+        buffer.add(collection, [{'_id': '1'}])
+        assert buffer.get(collection, '1') == {'_id': '1'}
+        await buffer.flush()
+
+    asyncio.run(run())
+    assert collection.inserted == [[{'_id': '1', 'prepared': True}]]
+    assert inserted == [{'_id': '1'}]
+
+
+def test_write_behind_buffer_write_errors():
+    """Test that the duplicates refused by MongoDb were stored by a previous flush, and the
+    documents refused for another reason are dropped"""
+    collection = FakeCollection(write_errors=[
+        {'index': 0, 'code': 11000, 'errmsg': 'E11000 duplicate key error'},
+        {'index': 2, 'code': 121, 'errmsg': 'Document failed validation'},
+    ])
+    inserted = []
+
+    async def on_insert(_, documents):
+        inserted.extend(documents)
+
+    async def run():
+        buffer = WriteBehindBuffer(max_size=10, max_delay=60, on_insert=on_insert)
+        buffer.add(collection, [{'_id': '1'}, {'_id': '2'}, {'_id': '3'}])
+        await buffer.flush()
+        assert buffer.get(collection, '3') is None
+
+    asyncio.run(run())
+    assert inserted == [{'_id': '1'}, {'_id': '2'}]
+
+
+def test_reset_after_fork():
+    """Test if a forked worker process does not inherit the MongoDb client of its parent"""
+    database.client = mock.MagicMock()
+    try:
+        pid = os.fork()
+        if pid == 0:
+            # Child process: exit code 0 if the client was forgotten
+            os._exit(0 if database.client is None else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert database.client is not None
+    finally:
+        database.client = None
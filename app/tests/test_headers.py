@@ -0,0 +1,51 @@
+"""Test for the capture of the response headers in app/headers.py"""
+
+import pytest
+from app.headers import HeaderPolicy, HEADER_NAMES, canonical_name, compact, expand
+
+
+def test_canonical_name():
+    """Test canonical_name function from headers.py module"""
+    assert canonical_name('content-type') == 'Content-Type'
+    assert canonical_name('CONTENT-TYPE') == 'Content-Type'
+    assert canonical_name('etag') == 'ETag'
+    assert canonical_name('x-custom-header') == 'X-Custom-Header'
+    assert canonical_name('x-custom-header') is canonical_name('X-CUSTOM-HEADER')
+
+
+def test_header_policy():
+    """Test HeaderPolicy class from headers.py module
+
+        Names are matched case-insensitively, values of repeated headers are joined,
+        the number of headers and the length of the values are capped
+    """
+    response = [
+        ('content-type', 'text/html'),
+        ('Server', 'nginx'),
+        ('set-cookie', 'a=1'),
+        ('Set-Cookie', 'b=2'),
+        ('X-Long', 'x' * 20),
+    ]
+    policy = HeaderPolicy('allow', allow=['Content-Type', 'set-cookie'])
+    assert policy.capture(response) == {'Content-Type': 'text/html', 'Set-Cookie': 'a=1, b=2'}
+
+    policy = HeaderPolicy('deny', deny=['Set-Cookie'], max_length=10)
+    assert policy.capture(response) == {
+        'Content-Type': 'text/html', 'Server': 'nginx', 'X-Long': 'x' * 10}
+
+    policy = HeaderPolicy('all', max_count=2)
+    assert policy.capture(response) == {'Content-Type': 'text/html', 'Server': 'nginx'}
+
+    with pytest.raises(ValueError):
+        HeaderPolicy('some')
+
+
+def test_compact_headers():
+    """Test compact and expand functions from headers.py module"""
+    headers = {'Content-Type': 'text/html', 'X-Custom': '1', 'Server': 'nginx'}
+    stored = compact(headers)
+    assert stored == [0, 'text/html', 'X-Custom', '1', HEADER_NAMES.index('Server'), 'nginx']
+    assert expand(stored) == headers
+    assert list(expand(stored)) == list(headers)
+    # Documents stored before the compact representation
+    assert expand(headers) is headers
@@ -0,0 +1,50 @@
+"""Test for jobs module in app/jobs.py"""
+
+import asyncio
+import pytest
+from app.jobs import JobQueue
+from app.models.shared import JSONException
+
+
+def test_job_queue():
+    """Test JobQueue from jobs.py module
+
+        First test: Test if the jobs are run by the workers, even after a failing job
+        Second test: Test if a job is refused with status 429 when the queue is full
+    """
+    async def main():
+        queue = JobQueue(max_size=2, workers=1)
+        queue.start()
+        done = []
+        release = asyncio.Event()
+
+        async def failing_job():
+            raise ValueError('failed')
+
+        async def job():
+            done.append(True)
+
+        async def blocking_job():
+            await release.wait()
+
+        queue.submit(failing_job)
+        queue.submit(job)
+        await asyncio.sleep(0.01)
+        assert done == [True]
+
+        # The worker is busy with the first job, the queue holds two more
+        queue.submit(blocking_job)
+        await asyncio.sleep(0.01)
+        queue.submit(job)
+        queue.submit(job)
+        with pytest.raises(JSONException) as exc:
+            queue.submit(job)
+        assert exc.value.id == 'QUEUE_FULL'
+        assert exc.value.status_code == 429
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert done == [True] * 3
+        await queue.stop()
+
+    asyncio.run(main())
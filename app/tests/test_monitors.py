@@ -0,0 +1,72 @@
+"""Test for the scheduler of the monitors in app/monitors.py"""
+
+from datetime import datetime, timezone
+from app.monitors import MonitorScheduler, fingerprint
+
+
+def _monitor(uid: str, interval: float, last_run: float | None = None, updated: int = 0) -> dict:
+    return {
+        '_id': uid,
+        'url': f'https://{uid}.example.com/',
+        'method': 'GET',
+        'interval': interval,
+        'updated_at': datetime.fromtimestamp(updated, timezone.utc),
+        'last_run': None if last_run is None else datetime.fromtimestamp(last_run, timezone.utc),
+    }
+
+
+def test_pop_due():
+    """Test that the monitors are run in the order they are due, every interval seconds"""
+    scheduler = MonitorScheduler(concurrency=10, sync_interval=5, lease_ttl=30)
+    assert scheduler.pop_due(1000) == (None, None)
+
+    scheduler.apply(_monitor('a', 60, last_run=950))
+    scheduler.apply(_monitor('b', 300, last_run=950))
+    scheduler.apply(_monitor('c', 10, last_run=985))
+
+    monitor, _ = scheduler.pop_due(1000)
+    assert monitor['_id'] == 'c'
+    assert scheduler.pop_due(1000) == (None, 5)
+    assert scheduler.pop_due(1005)[0]['_id'] == 'c'
+    # Late checks are not caught up: the next ones are an interval later
+    assert scheduler.pop_due(1100)[0]['_id'] == 'a'
+    assert scheduler.pop_due(1100)[0]['_id'] == 'c'
+    assert scheduler.pop_due(1100) == (None, 10)
+    assert scheduler.stats() == {'leader': False, 'monitors': 3, 'running': 0}
+
+
+def test_apply_changes():
+    """Test that updated monitors are rescheduled and deleted ones are not run anymore"""
+    scheduler = MonitorScheduler(concurrency=10, sync_interval=5, lease_ttl=30)
+    scheduler.apply(_monitor('a', 60, last_run=900))
+    scheduler.apply(_monitor('b', 60, last_run=900))
+
+    # Same version: nothing changes
+    scheduler.apply(_monitor('a', 60, last_run=900))
+    # New interval, the state known by the scheduler is kept
+    scheduler._monitors['b']['fingerprint'] = 'abc'  # pylint: disable=protected-access
+    scheduler.apply(_monitor('b', 600, last_run=100, updated=1))
+    assert scheduler._monitors['b']['fingerprint'] == 'abc'  # pylint: disable=protected-access
+    scheduler.apply(_monitor('a', 60, updated=1) | {'deleted': True})
+
+    assert scheduler.pop_due(1000) == (None, 500)
+    assert scheduler.pop_due(1500)[0]['interval'] == 600
+    assert scheduler.stats()['monitors'] == 1
+
+
+def test_fingerprint():
+    """Test that the fingerprint ignores the volatile fields of the results"""
+    def document(date: str, ttfb: float) -> dict:
+        return {'status': 200, 'errors': None, 'data': {
+            'url': {'url': 'https://example.com/'},
+            'response': [{'http_version': 'HTTP/1.1', 'status_code': 200,
+                          'headers': [2, date], 'timings': {'ttfb': ttfb}}],
+            'request': [{'method': 'GET', 'url': 'https://example.com/'}],
+        }}
+
+    assert fingerprint(document('Mon', 10)) == fingerprint(document('Tue', 20))
+    changed = document('Mon', 10)
+    changed['data']['response'][0]['status_code'] = 500
+    assert fingerprint(changed) != fingerprint(document('Mon', 10))
+    assert fingerprint({'status': 500, 'errors': {'id': 'SSRF_DETECTED'}, 'data': None}) \
+        == 'SSRF_DETECTED'
@@ -0,0 +1,37 @@
+from unittest import mock
+import httpx
+from app import database
+from app.main import app
+from app.settings import settings
+
+
+def test_deduplicated_results(client, mock_http):
+    dates = iter(["Mon, 20 Nov 2023 10:00:00 GMT", "Mon, 20 Nov 2023 10:00:01 GMT",
+                  "Mon, 20 Nov 2023 10:00:02 GMT", "Mon, 20 Nov 2023 10:00:03 GMT"])
+
+    def handler(request):
+        if request.url.path == "/old":
+            return httpx.Response(301, headers={"Location": "/new", "Date": next(dates)})
+        return httpx.Response(200, headers={"Server": "nginx", "Date": next(dates)})
+
+    with mock_http(handler), mock.patch.dict(settings, {'RESULTS_DEDUP': True}):
+        posted = [client.post("/api/HTTP/GET", json={"url": "https://www.google.com/old"})
+                  for _ in range(2)]
+
+    db = app.dependency_overrides[database.get_db]()
+    stored = [client.portal.call(db.results.find_one, {'_id': response.json()["_id"]})
+              for response in posted]
+    # Both results reference the same chain and keep their own Date headers
+    assert stored[0]['chain'] == stored[1]['chain']
+    assert 'request' not in stored[0]['data']
+    assert stored[1]['data']['response'][1]['headers'] == [2, "Mon, 20 Nov 2023 10:00:03 GMT"]
+    chain = client.portal.call(db.chains.find_one, {'_id': stored[0]['chain']})
+    assert chain['last_seen'] == max(document['created_at'] for document in stored)
+
+    # Views and exports rebuild the full results
+    for response in posted:
+        view = client.get(f"/api/HTTP/{response.json()['_id']}")
+        assert view.json() == response.json()
+    exported = client.get("/api/HTTP/export").text.splitlines()
+    assert len(exported) == 2
+    assert all('"Location":"/new"' in line for line in exported)
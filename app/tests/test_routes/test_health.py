@@ -0,0 +1,39 @@
+from unittest import mock
+from pymongo.errors import ServerSelectionTimeoutError
+
+
+def test_healthz(client):
+    response = client.get("/healthz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_readyz(client):
+    with mock.patch('app.database.ping', return_value=1.5), \
+         mock.patch('app.routers.health.socket.getaddrinfo', return_value=[]):
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        assert response.json()["mongo"]["latency_ms"] == 1.5
+        assert response.json()["dns"]["ok"] is True
+        assert response.json()["saturation"]["saturated"] == []
+
+
+def test_readyz_saturated(client):
+    stats = {'queued': 950, 'max_size': 1000, 'workers': 50}
+    with mock.patch('app.database.ping', return_value=1.5), \
+         mock.patch('app.routers.health.socket.getaddrinfo', return_value=[]), \
+         mock.patch('app.routers.health.job_queue.stats', return_value=stats):
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["status"] == "saturated"
+        assert response.json()["saturation"]["saturated"] == ["jobs"]
+
+
+def test_readyz_mongo_unreachable(client):
+    with mock.patch('app.database.ping', side_effect=ServerSelectionTimeoutError('unreachable')), \
+         mock.patch('app.routers.health.socket.getaddrinfo', return_value=[]):
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["status"] == "degraded"
+        assert response.json()["mongo"] == {"ok": False, "error": "unreachable"}
@@ -1,8 +1,21 @@
 import json
+import time
 import pytest
 from unittest import mock
-from app.utils import url_info, detect_ssrf, resolve_ip, make_request
+import httpx
+from app import database
+from app.main import app
+from app.models.api import BatchRequest
+from app.routers.http import perform_a_batch_stream
+from app.utils import url_info, detect_ssrf, resolve_addresses, make_request
 from app.models.shared import JSONException
+from app.tests.conftest import addrinfo
+
+
+def mock_transport(handler):
+    """Patch the shared async HTTP client so that every request is answered by `handler`"""
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return mock.patch('app.utils.get_http_client', return_value=mock_client)
 
 def test_http_post(client):
     response = client.post(
@@ -17,22 +30,16 @@ def test_http_post(client):
 
 
 def test_api_google_mock_200(client):
-    with mock.patch('app.utils.detect_ssrf') as mock_detect_ssrf, \
-         mock.patch('app.utils.requests') as mock_requests:
-        mock_detect_ssrf.return_value = False
-
-        mock_response = mock.MagicMock()
-        mock_response.status_code = 200
-        mock_response.is_redirect = False
-        mock_response.raw.version = 11
-        mock_response.headers = {
+    def handler(request):
+        return httpx.Response(200, headers={
             "Content-Type": "text/html",
             "Content-Length": "123",
             "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
             "Server": "Apache 19/1.2",
-        }
+        })
 
-        mock_requests.request.return_value = mock_response
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
 
         response = client.post(
             "/api/HTTP/GET",
@@ -50,23 +57,17 @@ def test_api_google_mock_200(client):
 
 
 def test_api_google_mock_302_infinite_redirect(client):
-    with mock.patch('app.utils.detect_ssrf') as mock_detect_ssrf, \
-         mock.patch('app.utils.requests') as mock_requests:
-        mock_detect_ssrf.return_value = False
-
-        mock_response = mock.MagicMock()
-        mock_response.status_code = 302
-        mock_response.is_redirect = True
-        mock_response.raw.version = 11
-        mock_response.headers = {
+    def handler(request):
+        return httpx.Response(302, headers={
             "Content-Type": "text/html",
             "Content-Length": "123",
             "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
             "Server": "Apache 19/1.2",
             "Location": "https://www.google.it/"
-        }
+        })
 
-        mock_requests.request.return_value = mock_response
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
 
         response = client.post(
             "/api/HTTP/GET",
@@ -81,39 +82,25 @@ def test_api_google_mock_302_infinite_redirect(client):
 
 
 def test_api_google_mock_302_single_redirect(client):
-    with mock.patch('app.utils.detect_ssrf') as mock_detect_ssrf, \
-         mock.patch('app.utils.requests') as mock_requests:
-        mock_detect_ssrf.return_value = False
-        
-        def mocked_requests_get(*args, **kwargs):
-            if args[1] == "https://first.google.com":
-                mock_response = mock.MagicMock()
-                mock_response.status_code = 302
-                mock_response.is_redirect = True
-                mock_response.raw.version = 11
-                mock_response.headers = {
-                    "Content-Type": "text/html",
-                    "Content-Length": "123",
-                    "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
-                    "Server": "Apache 2/1.20",
-                    "Location": "https://second.google.com"
-                }
-                return mock_response
-            elif args[1] == "https://second.google.com":
-                mock_response = mock.MagicMock()
-                mock_response.status_code = 200
-                mock_response.is_redirect = False
-                mock_response.raw.version = 11
-                mock_response.headers = {
-                    "Content-Type": "text/html",
-                    "Content-Length": "123",
-                    "Date": "Mon, 18 Oct 2021 14:00:01 GMT",
-                    "Server": "Nginx 1.2",
-                }
-                return mock_response
-
-
-        mock_requests.request.side_effect = mocked_requests_get
+    def handler(request):
+        if request.url.host == "first.google.com":
+            return httpx.Response(302, headers={
+                "Content-Type": "text/html",
+                "Content-Length": "123",
+                "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
+                "Server": "Apache 2/1.20",
+                "Location": "https://second.google.com"
+            })
+        elif request.url.host == "second.google.com":
+            return httpx.Response(200, headers={
+                "Content-Type": "text/html",
+                "Content-Length": "123",
+                "Date": "Mon, 18 Oct 2021 14:00:01 GMT",
+                "Server": "Nginx 1.2",
+            })
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
 
         response = client.post(
             "/api/HTTP/GET",
@@ -128,33 +115,26 @@ def test_api_google_mock_302_single_redirect(client):
         assert response.json()["data"]["response"][1]["status_code"] == 200
 
 def test_api_google_mock_302_single_redirect_ssrf(client):
-    with mock.patch('app.utils.requests') as mock_requests, \
-         mock.patch('app.utils.socket.gethostbyname') as mock_gethostbyname:
-
-        def mocked_get_host_by_name(*args, **kwargs):
-            if args[0] == "first.google.com":
-                return "123.1.2.3"
-            elif args[0] == "second.google.com":
-                return "127.0.0.1"
-        
-        def mocked_requests_get(*args, **kwargs):
-            if args[1] == "https://first.google.com":
-                mock_response = mock.MagicMock()
-                mock_response.status_code = 302
-                mock_response.is_redirect = True
-                mock_response.raw.version = 11
-                mock_response.headers = {
-                    "Content-Type": "text/html",
-                    "Content-Length": "123",
-                    "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
-                    "Server": "Apache 2/1.20",
-                    "Location": "https://second.google.com"
-                }
-                return mock_response
-
-
-        mock_gethostbyname.side_effect = mocked_get_host_by_name
-        mock_requests.request.side_effect = mocked_requests_get
+    def mocked_getaddrinfo(*args, **kwargs):
+        if args[0] == "first.google.com":
+            return addrinfo("123.1.2.3")
+        elif args[0] == "second.google.com":
+            # A single private address among the public ones is refused
+            return addrinfo("123.1.2.4", "fd00::1")
+
+    def handler(request):
+        if request.url.host == "first.google.com":
+            return httpx.Response(302, headers={
+                "Content-Type": "text/html",
+                "Content-Length": "123",
+                "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
+                "Server": "Apache 2/1.20",
+                "Location": "https://second.google.com"
+            })
+
+    with mock_transport(handler), \
+         mock.patch('app.utils.socket.getaddrinfo') as mock_getaddrinfo:
+        mock_getaddrinfo.side_effect = mocked_getaddrinfo
 
         response = client.post(
             "/api/HTTP/GET",
@@ -169,22 +149,16 @@ def test_api_google_mock_302_single_redirect_ssrf(client):
 
 
 def test_add_view(client):
-    with mock.patch('app.utils.detect_ssrf') as mock_detect_ssrf, \
-         mock.patch('app.utils.requests') as mock_requests:
-        mock_detect_ssrf.return_value = False
-
-        mock_response = mock.MagicMock()
-        mock_response.status_code = 200
-        mock_response.is_redirect = False
-        mock_response.raw.version = 11
-        mock_response.headers = {
+    def handler(request):
+        return httpx.Response(200, headers={
             "Content-Type": "text/html",
             "Content-Length": "123",
             "Date": "Mon, 18 Oct 2021 14:00:00 GMT",
             "Server": "Apache 19/1.2",
-        }
+        })
 
-        mock_requests.request.return_value = mock_response
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
 
         response = client.post(
             "/api/HTTP/GET",
@@ -213,4 +187,279 @@ def test_add_view_not_found(client):
     )
     assert response.status_code == 500
     assert response.json()["status"] == 500
-    assert response.json()["errors"]["id"] == "ID_NOT_FOUND"
\ No newline at end of file
+    assert response.json()["errors"]["id"] == "ID_NOT_FOUND"
+
+def test_batch(client):
+    def mocked_getaddrinfo(*args, **kwargs):
+        if args[0] == "private.google.com":
+            return addrinfo("127.0.0.1")
+        return addrinfo("123.1.2.3")
+
+    def handler(request):
+        return httpx.Response(200, headers={"Server": f"Nginx {request.url.host}"})
+
+    with mock.patch('app.utils.socket.getaddrinfo') as mock_getaddrinfo, \
+         mock_transport(handler):
+        mock_getaddrinfo.side_effect = mocked_getaddrinfo
+
+        response = client.post(
+            "/api/HTTP/batch",
+            json={
+                "requests": [
+                    {"url": "https://first.google.com/", "method": "GET"},
+                    {"url": "https://private.google.com/", "method": "GET"},
+                    {"url": "https://second.google.com/", "method": "HEAD"},
+                ],
+                "concurrency": 2
+            }
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert response.json()["ids"] == [result["_id"] for result in results]
+        assert results[0]["data"]["response"][0]["headers"]["Server"] == "Nginx first.google.com"
+        assert results[1]["errors"]["id"] == "SSRF_DETECTED"
+        assert results[2]["data"]["request"][0]["method"] == "HEAD"
+
+        # Every result is stored
+        response = client.get(f"/api/HTTP/{results[1]['_id']}")
+        assert response.json()["errors"]["id"] == "SSRF_DETECTED"
+
+
+def test_batch_too_large(client):
+    with mock.patch.dict('app.routers.http.settings', {'BATCH_MAX_SIZE': 1}):
+        response = client.post(
+            "/api/HTTP/batch",
+            json={
+                "requests": [
+                    {"url": "https://first.google.com/", "method": "GET"},
+                    {"url": "https://second.google.com/", "method": "GET"},
+                ]
+            }
+        )
+    assert response.status_code == 413
+    assert response.json()["errors"]["id"] == "BATCH_TOO_LARGE"
+
+
+def test_batch_stream(client):
+    def handler(request):
+        return httpx.Response(200, headers={"Server": f"Nginx {request.url.host}"})
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        response = client.post(
+            "/api/HTTP/batch/stream",
+            json={
+                "requests": [
+                    {"url": "https://first.google.com/", "method": "GET"},
+                    {"url": "https://second.google.com/", "method": "GET"},
+                ]
+            }
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(result["data"]["url"]["domain"] for result in results) == [
+            "first.google.com", "second.google.com"
+        ]
+
+    # Export the stored results of a domain
+    response = client.get("/api/HTTP/export", params={"domain": "second.google.com"})
+    assert response.status_code == 200
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [result["_id"] for result in exported] == [
+        result["_id"] for result in results if result["data"]["url"]["domain"] == "second.google.com"
+    ]
+
+
+def test_batch_stream_disconnect(client, mock_http):
+    batch = BatchRequest(requests=[
+        {"url": f"https://host{index}.google.com/", "method": "GET"} for index in range(5)
+    ])
+    db = app.dependency_overrides[database.get_db]()
+
+    async def read_and_disconnect():
+        response = await perform_a_batch_stream(batch, db)
+        lines = [await anext(response.body_iterator) for _ in range(3)]
+        await response.body_iterator.aclose()
+        return [json.loads(line)["_id"] for line in lines]
+
+    with mock_http(lambda _: httpx.Response(200)), \
+         mock.patch.dict('app.routers.http.settings', {'STREAM_CHUNK_SIZE': 2}):
+        received = client.portal.call(read_and_disconnect)
+
+    # The results sent before the client went away are stored
+    assert all(client.portal.call(db.results.find_one, {'_id': uid}) for uid in received)
+
+
+def test_cached_request(client):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, headers={"Server": "Nginx 1.2"})
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        first = client.post("/api/HTTP/GET", json={"url": "https://www.google.it/"}).json()
+        second = client.post(
+            "/api/HTTP/GET", json={"url": "HTTPS://www.google.it", "cache_max_age": 60}
+        ).json()
+        third = client.post("/api/HTTP/GET", json={"url": "https://www.google.it/"}).json()
+
+    assert len(calls) == 2
+    assert first["cached"] is False
+    assert second["cached"] is True
+    assert second["_id"] == first["_id"]
+    assert third["_id"] != first["_id"]
+
+
+def test_view_etag(client):
+    def handler(request):
+        return httpx.Response(200, headers={"Server": "Nginx 1.2"})
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        id = client.post("/api/HTTP/GET", json={"url": "https://www.google.it/"}).json()["_id"]
+
+    response = client.get(f"/api/HTTP/{id}")
+    assert response.status_code == 200
+    assert response.json()["_id"] == id
+    etag = response.headers["etag"]
+
+    response = client.get(f"/api/HTTP/{id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+
+def test_background_request(client):
+    def handler(request):
+        return httpx.Response(200, headers={"Server": "Nginx 1.2"})
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        response = client.post(
+            "/api/HTTP/GET",
+            json={"url": "https://first.google.com", "background": True}
+        )
+        assert response.status_code == 202
+        assert response.json()["state"] == "pending"
+        uid = response.json()["_id"]
+
+        for _ in range(100):
+            response = client.get(f"/api/HTTP/{uid}")
+            assert response.status_code == 200
+            if response.json()["state"] == "done":
+                break
+            # Results not done yet must not be cached
+            assert "ETag" not in response.headers
+            time.sleep(0.01)
+        assert response.json()["state"] == "done"
+        assert response.json()["status"] == 200
+        assert response.json()["data"]["response"][0]["headers"]["Server"] == "Nginx 1.2"
+        assert "ETag" in response.headers
+
+
+def test_background_queue_full(client):
+    with mock.patch('app.routers.http.job_queue.submit', side_effect=JSONException(
+            id='QUEUE_FULL', detail='Too many background jobs, retry later', status_code=429)):
+        response = client.post(
+            "/api/HTTP/GET",
+            json={"url": "https://first.google.com", "background": True}
+        )
+        assert response.status_code == 429
+        assert response.json()["errors"]["id"] == "QUEUE_FULL"
+
+
+def test_list_requests(client):
+    def handler(request):
+        if request.url.host == "missing.google.com":
+            return httpx.Response(404)
+        return httpx.Response(200)
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        response = client.post(
+            "/api/HTTP/batch",
+            json={
+                "requests": [
+                    {"url": "https://first.google.com/", "method": "GET"},
+                    {"url": "https://missing.google.com/", "method": "GET"},
+                    {"url": "https://first.google.com/a", "method": "GET"},
+                    {"url": "https://second.google.com/", "method": "GET"},
+                    {"url": "https://first.google.com/b", "method": "GET"},
+                ]
+            }
+        )
+        ids = set(response.json()["ids"])
+
+    # Results stored before created_at existed come last
+    db = app.dependency_overrides[database.get_db]()
+    legacy = [
+        {"_id": uid, "status": 200, "errors": None,
+         "data": {"url": {"url": "https://old.google.com/", "protocol": "https",
+                          "domain": "old.google.com", "path": "/"}}}
+        for uid in ("00000000-0000-4000-8000-000000000001", "00000000-0000-4000-8000-000000000002")
+    ]
+    client.portal.call(db.results.insert_many, legacy)
+
+    # Every page starts after the last result of the previous one
+    listed = []
+    cursor = None
+    while True:
+        params = {"limit": 2} | ({"cursor": cursor} if cursor else {})
+        page = client.get("/api/HTTP", params=params).json()
+        assert len(page["results"]) <= 2
+        listed += page["results"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(listed) == 7
+    assert {result["_id"] for result in listed[:5]} == ids
+    positions = [(result["created_at"], result["_id"]) for result in listed[:5]]
+    assert positions == sorted(positions, reverse=True)
+    assert [(result["created_at"], result["_id"]) for result in listed[5:]] == \
+        [(None, document["_id"]) for document in reversed(legacy)]
+    assert "data" not in listed[0]
+
+    response = client.get("/api/HTTP", params={"domain": "first.google.com", "status": 200})
+    results = response.json()["results"]
+    assert len(results) == 3
+    assert results[0]["summary"] == {"status_code": 200, "hops": 1, "error": None}
+    assert {result["url"]["path"] for result in results} == {"/", "/a", "/b"}
+
+    response = client.get("/api/HTTP", params={"status": 404})
+    assert [result["url"]["domain"] for result in response.json()["results"]] == \
+        ["missing.google.com"]
+
+    response = client.get("/api/HTTP", params={"since": "2999-01-01T00:00:00"})
+    assert response.json() == {"results": [], "next_cursor": None}
+
+    response = client.get("/api/HTTP", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+    assert response.json()["errors"]["id"] == "INVALID_CURSOR"
+
+
+def test_headers_capture(client):
+    def handler(request):
+        return httpx.Response(200, headers=[
+            ("content-type", "text/html"),
+            ("x-powered-by", "PHP"),
+            ("set-cookie", "session=1"),
+        ])
+
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock_transport(handler):
+        # Names are matched case-insensitively
+        response = client.post("/api/HTTP/GET", json={"url": "https://www.google.it/"})
+        assert response.json()["data"]["response"][0]["headers"] == {"Content-Type": "text/html"}
+
+        # Every header but the denied ones
+        response = client.post(
+            "/api/HTTP/GET", json={"url": "https://www.google.it/", "all_headers": True})
+        headers = {"Content-Type": "text/html", "X-Powered-By": "PHP"}
+        assert response.json()["data"]["response"][0]["headers"] == headers
+
+        # Headers are stored compacted and expanded when read
+        response = client.get(f"/api/HTTP/{response.json()['_id']}")
+        assert response.json()["data"]["response"][0]["headers"] == headers
@@ -0,0 +1,25 @@
+import httpx
+
+
+def test_metrics(client, mock_http):
+    def handler(request):
+        if request.url.path == "/":
+            return httpx.Response(301, headers={"Location": "/home"})
+        return httpx.Response(200)
+
+    with mock_http(handler):
+        assert client.post("/api/HTTP/GET", json={"url": "https://google.com/"}).status_code == 200
+        client.get("/api/HTTP/025cc803-cfe4-42c0-bc8c-e47dfa20c8ee")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+        assert 'caas_errors_total{id="ID_NOT_FOUND"} 1' in lines
+        assert 'caas_redirect_depth_bucket{le="0"} 0' in lines
+        assert 'caas_redirect_depth_bucket{le="1"} 1' in lines
+        assert 'caas_phase_seconds_count{phase="dns"} 2' in lines
+        assert 'caas_phase_seconds_count{phase="chain"} 1' in lines
+        assert 'caas_phase_seconds_count{phase="serialization"} 1' in lines
+        # The request serving the metrics is in flight
+        assert 'caas_http_requests_in_flight 1' in lines
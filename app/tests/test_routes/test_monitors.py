@@ -0,0 +1,48 @@
+import httpx
+from app import database
+from app.main import app
+from app.monitors import MonitorScheduler
+
+
+def test_monitors(client, mock_http):
+    response = client.post("/api/monitors", json={
+        "url": "https://www.google.com/", "method": "GET", "interval": 300, "diff": True})
+    assert response.status_code == 201
+    monitor = response.json()
+    assert monitor["interval"] == 300
+    assert monitor["last_run"] is None
+
+    response = client.post("/api/monitors", json={
+        "url": "https://www.google.com/", "method": "GET", "interval": 1})
+    assert response.status_code == 400
+    assert response.json()["errors"]["id"] == "INTERVAL_TOO_SHORT"
+
+    assert client.get(f"/api/monitors/{monitor['_id']}").json() == monitor
+    assert client.get("/api/monitors").json() == {"monitors": [monitor], "next_cursor": None}
+
+    # Checks in diff mode store a result only when the redirect chain changes
+    statuses = iter([200, 200, 404])
+
+    def handler(_):
+        return httpx.Response(next(statuses), headers={"Date": "Mon, 20 Nov 2023 10:00:00 GMT"})
+
+    db = app.dependency_overrides[database.get_db]()
+    scheduler = MonitorScheduler(concurrency=1, sync_interval=5, lease_ttl=30)
+    with mock_http(handler):
+        stored = client.portal.call(db.monitors.find_one, {'_id': monitor['_id']})
+        for _ in range(3):
+            client.portal.call(scheduler.check, db, stored)
+    client.portal.call(scheduler.flush, db)
+
+    results = client.get("/api/HTTP", params={"monitor": monitor["_id"]}).json()["results"]
+    assert [result["summary"]["status_code"] for result in results] == [404, 200]
+    checked = client.get(f"/api/monitors/{monitor['_id']}").json()
+    assert checked["last_status"] == 404
+    assert checked["last_error"] is None
+    assert checked["last_result"] == results[0]["_id"]
+    assert checked["changed_at"] == checked["last_run"]
+
+    assert client.delete(f"/api/monitors/{monitor['_id']}").status_code == 204
+    assert client.get(f"/api/monitors/{monitor['_id']}").status_code == 404
+    assert client.delete(f"/api/monitors/{monitor['_id']}").status_code == 404
+    assert client.get("/api/monitors").json()["monitors"] == []
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+import time
+from unittest import mock
+import httpx
+from app import database, retention
+from app.cache import view_cache
+from app.main import app
+from app.settings import settings
+
+
+def test_compact_results(client, mock_http):
+    def handler(request):
+        if request.url.path == "/old":
+            return httpx.Response(301, headers={"Location": "/new"})
+        return httpx.Response(200, headers={"Server": "nginx"})
+
+    with mock_http(handler):
+        uids = [
+            client.post("/api/HTTP/GET", json={"url": url}).json()["_id"]
+            for url in ("https://www.google.com/old", "https://www.google.com/")
+        ]
+    # Cache the view, it must not be served once compacted
+    assert len(client.get(f"/api/HTTP/{uids[0]}").json()["data"]["response"]) == 2
+
+    db = app.dependency_overrides[database.get_db]()
+    # Nothing is old enough yet
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    assert client.portal.call(retention.compact, db, past, 1) == 0
+    # Results are compacted in batches, and only once
+    future = datetime.now(timezone.utc) + timedelta(minutes=1)
+    assert client.portal.call(retention.compact, db, future, 1) == 2
+    assert client.portal.call(retention.compact, db, future, 1) == 0
+
+    result = client.get(f"/api/HTTP/{uids[0]}").json()
+    assert result["compacted"] is True
+    assert result["status"] == 200
+    assert result["data"]["url"]["path"] == "/old"
+    assert result["data"]["response"] == []
+    assert result["data"]["request"] == []
+
+    listed = client.get("/api/HTTP").json()["results"]
+    assert [result["compacted"] for result in listed] == [True, True]
+    assert listed[1]["summary"] == {"status_code": 200, "hops": 2, "error": None}
+
+
+def test_views_expire_before_compaction(client, mock_http):
+    def handler(_):
+        return httpx.Response(200)
+
+    with mock_http(handler):
+        uid = client.post("/api/HTTP/GET", json={"url": "https://www.google.com/"}).json()["_id"]
+    view_cache.clear()
+
+    # The view is cached until the result may be compacted by any process
+    with mock.patch.dict(settings, {'RESULTS_COMPACT_AFTER': 60}):
+        client.get(f"/api/HTTP/{uid}")
+        client.get(f"/api/HTTP/{uid}")
+        assert view_cache.stats()['hits'] == 1
+        with mock.patch('app.cache.time.time', return_value=time.time() + 60):
+            client.get(f"/api/HTTP/{uid}")
+            # Expired, and not cached again once the result may be compacted
+            stats = view_cache.stats()
+            assert (stats['size'], stats['hits'], stats['misses']) == (0, 1, 2)
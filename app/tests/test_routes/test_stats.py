@@ -0,0 +1,38 @@
+import httpx
+
+
+def test_domain_stats(client, mock_http):
+    def handler(request):
+        if request.url.path == "/old":
+            return httpx.Response(301, headers={"Location": "/new"})
+        if request.url.path == "/missing":
+            return httpx.Response(404, headers={"Server": "nginx/1.25.3"})
+        return httpx.Response(200, headers={"Server": "nginx/1.25.3"})
+
+    with mock_http(handler):
+        client.post("/api/HTTP/batch", json={"requests": [
+            {"url": "https://www.google.com/old", "method": "GET"},
+            {"url": "https://www.google.com/missing", "method": "GET"},
+            {"url": "https://www.google.com/", "method": "GET"},
+            {"url": "https://private.google.com/", "method": "GET", "tenant": "unknown"},
+        ]})
+        client.post("/api/HTTP/GET", json={"url": "https://www.google.com/"})
+
+    response = client.get("/api/stats/www.google.com")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["total"] == {
+        "requests": 4,
+        "hops": {"1": 3, "2": 1},
+        "status": {"200": 3, "404": 1},
+        "servers": {"nginx/1.25.3": 4},
+    }
+    assert len(stats["hourly"]) == 1
+    assert stats["hourly"][0]["requests"] == 4
+
+    response = client.get("/api/stats/unknown.google.com", params={"hours": 0})
+    assert response.json() == {
+        "domain": "unknown.google.com",
+        "total": {"requests": 0, "hops": {}, "status": {}, "servers": {}},
+        "hourly": [],
+    }
@@ -0,0 +1,80 @@
+"""Test for scheduler module in app/scheduler.py"""
+
+import asyncio
+import time
+import pytest
+from app.scheduler import HostScheduler
+from app.models.shared import JSONException
+
+
+def test_host_concurrency():
+    """Test if a host never has more than host_concurrency requests in flight"""
+    scheduler = HostScheduler(rate=0, burst=1, host_concurrency=2, max_active=100)
+    in_flight = []
+
+    async def request(host):
+        async with scheduler.slot(host, timeout=1):
+            in_flight.append(host)
+            assert in_flight.count(host) <= 2
+            await asyncio.sleep(0.01)
+            in_flight.remove(host)
+
+    async def main():
+        await asyncio.gather(*(request(host) for host in ['a.com'] * 6 + ['b.com'] * 2))
+
+    asyncio.run(main())
+    assert scheduler.stats() == {'hosts': 2, 'active': 0, 'waiting': 0}
+
+
+def test_host_rate():
+    """Test if the requests to a host are spaced by its token bucket"""
+    scheduler = HostScheduler(rate=20, burst=1, host_concurrency=10, max_active=100)
+
+    async def main():
+        start = time.monotonic()
+        for _ in range(3):
+            async with scheduler.slot('a.com', timeout=1):
+                pass
+        return time.monotonic() - start
+
+    # The first request uses the burst, the other two wait 50 ms each
+    assert asyncio.run(main()) >= 0.09
+
+
+def test_fair_queue():
+    """Test if a host with a long queue does not delay the requests to other hosts"""
+    scheduler = HostScheduler(rate=0, burst=1, host_concurrency=10, max_active=1)
+    order = []
+
+    async def request(host, index):
+        async with scheduler.slot(host, timeout=1):
+            order.append(f'{host}{index}')
+            await asyncio.sleep(0.01)
+
+    async def main():
+        tasks = [asyncio.create_task(request('a', index)) for index in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request('b', 0)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ['a0', 'a1', 'b0', 'a2', 'a3']
+
+
+def test_queue_timeout():
+    """Test if a request waiting longer than its timeout fails with HOST_QUEUE_TIMEOUT"""
+    scheduler = HostScheduler(rate=0, burst=1, host_concurrency=1, max_active=100)
+
+    async def main():
+        async with scheduler.slot('a.com', timeout=1):
+            with pytest.raises(JSONException) as exc:
+                async with scheduler.slot('a.com', timeout=0.05):
+                    pass
+            assert exc.value.id == 'HOST_QUEUE_TIMEOUT'
+            assert exc.value.status_code == 429
+            assert scheduler.stats()['waiting'] == 0
+        # The slot is free again
+        async with scheduler.slot('a.com', timeout=0.05):
+            pass
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""Test for the SSRF policies in app/ssrf.py"""
+
+import ipaddress
+import json
+from unittest import mock
+import pytest
+from app import ssrf
+from app.models.shared import JSONException
+from app.ssrf import SSRFPolicy, load_tenant_policies
+
+
+def test_policy_ranges():
+    """Test the allowed and denied CIDR ranges of SSRFPolicy
+
+        Overlapping and adjacent ranges are merged, allowed ranges override denied ones
+        and IPv4 addresses embedded in IPv6 ones are checked as IPv4
+    """
+    policy = SSRFPolicy(
+        allow=['10.1.2.0/24'],
+        deny=['10.0.0.0/9', '10.128.0.0/9', '10.0.0.0/16', '2001:db8::/32']
+    )
+    # The merged denied ranges have no gap and no overflow
+    for address, allowed in (('9.255.255.255', True), ('10.0.0.0', False),
+                             ('10.127.255.255', False), ('10.128.0.0', False),
+                             ('11.0.0.0', True)):
+        assert policy.allows_address(ipaddress.ip_address(address)) is allowed
+    assert policy.allows('example.com', ['10.1.2.3']) is True
+    assert policy.allows('example.com', ['10.1.3.1']) is False
+    assert policy.allows('example.com', ['10.255.255.255']) is False
+    assert policy.allows('example.com', ['11.0.0.0', '2001:db9::1']) is True
+    assert policy.allows('example.com', ['11.0.0.0', '2001:db8::1']) is False
+    assert policy.allows('example.com', ['::ffff:10.1.3.1']) is False
+    assert policy.allows('example.com', ['::ffff:10.1.2.3']) is True
+    assert policy.allows('example.com', []) is True
+
+    with pytest.raises(ValueError):
+        SSRFPolicy(deny=['10.0.0.0/33'])
+
+
+def test_policy_hosts():
+    """Test the allowed and denied host patterns of SSRFPolicy"""
+    policy = SSRFPolicy(
+        deny=['127.0.0.0/8'],
+        allow_hosts=['status.internal'],
+        deny_hosts=['localhost', '*.internal']
+    )
+    assert policy.allows('localhost', ['1.1.1.1']) is False
+    assert policy.allows('LOCALHOST.', ['1.1.1.1']) is False
+    assert policy.allows('api.localhost', ['1.1.1.1']) is True
+    assert policy.allows('metadata.google.internal', ['1.1.1.1']) is False
+    assert policy.allows('internal', ['1.1.1.1']) is True
+    # Denied patterns win over allowed ones
+    assert policy.allows('status.internal', ['1.1.1.1']) is False
+
+    # Internationalized names match in both forms
+    policy = SSRFPolicy(deny_hosts=['*.bücher.example'])
+    assert policy.allows('www.xn--bcher-kva.example', ['1.1.1.1']) is False
+    assert policy.allows('www.bücher.example', ['1.1.1.1']) is False
+
+    policy = SSRFPolicy(deny=['127.0.0.0/8'], allow_hosts=['status.example.com'])
+    assert policy.allows('status.example.com', ['127.0.0.1']) is True
+    assert policy.allows('www.example.com', ['127.0.0.1']) is False
+
+
+def test_tenant_policies(tmp_path):
+    """Test the policies of the tenants, applied on top of the default policy"""
+    path = tmp_path / 'policies.json'
+    path.write_text(json.dumps({
+        'acme': {'deny': ['8.8.8.0/24'], 'allow': ['127.0.0.1/32']},
+        'umbrella': {'deny_hosts': ['*.example.com']}
+    }))
+    policies = load_tenant_policies(str(path))
+    assert load_tenant_policies('') == {}
+
+    with mock.patch.object(ssrf, 'tenant_policies', policies):
+        assert ssrf.allows('dns.google', ['8.8.8.8']) is True
+        assert ssrf.allows('dns.google', ['8.8.8.8'], 'acme') is False
+        assert ssrf.allows('dns.google', ['8.8.8.8'], 'umbrella') is True
+        assert ssrf.allows('www.example.com', ['1.1.1.1'], 'umbrella') is False
+        # A tenant can not allow what the default policy refuses
+        assert ssrf.allows('example.com', ['127.0.0.1'], 'acme') is False
+
+        with pytest.raises(JSONException) as exc:
+            ssrf.allows('dns.google', ['8.8.8.8'], 'unknown')
+        assert exc.value.id == 'UNKNOWN_TENANT'
+        assert exc.value.status_code == 400
+
+    path.write_text(json.dumps({'acme': {'denied': ['8.8.8.0/24']}}))
+    with pytest.raises(ValueError):
+        load_tenant_policies(str(path))
@@ -0,0 +1,70 @@
+"""Test the startup of the server, in a new process to measure a cold start"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+# Imports the app, runs its lifespan and calls the readiness probe, printing the timings
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from fastapi.testclient import TestClient
+from app.main import app
+imported = time.perf_counter()
+with TestClient(app) as client:
+    started = time.perf_counter()
+    response = client.get('/readyz')
+print(json.dumps({
+    'import': imported - start,
+    'startup': started - imported,
+    'readyz_status': response.status_code,
+    'readyz': response.json(),
+}))
+"""
+
+
+def run_startup(environment: dict) -> subprocess.CompletedProcess:
+    """Run the startup script in a new interpreter with the given environment variables"""
+    env = {key: value for key, value in os.environ.items() if not key.startswith('MONGO_')}
+    return subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT],
+        env=env | environment,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        capture_output=True,
+        text=True,
+        timeout=60,
+        check=False
+    )
+
+
+def test_cold_start_without_mongo():
+    """Test if the server starts quickly in degraded mode when MongoDb is unreachable"""
+    # A port nobody listens on
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    result = run_startup({
+        'MONGO_HOST': '127.0.0.1',
+        'MONGO_PORT': str(port),
+        'MONGO_USERNAME': 'user',
+        'MONGO_PASSWORD': 'password',
+        'MONGO_DB_NAME': 'test',
+    })
+    assert result.returncode == 0, result.stderr
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    assert timings['readyz_status'] == 503
+    assert timings['readyz']['mongo']['ok'] is False
+    # The lifespan does not wait for MongoDb
+    assert timings['startup'] < 1
+    assert timings['import'] + timings['startup'] < 5
+
+
+def test_startup_missing_configuration():
+    """Test if a missing environment variable is reported by name when the server starts"""
+    result = run_startup({'MONGO_HOST': 'localhost'})
+    assert result.returncode != 0
+    assert 'ConfigurationError' in result.stderr
+    assert 'MONGO_USERNAME, MONGO_PASSWORD, MONGO_DB_NAME' in result.stderr
@@ -1,9 +1,23 @@
 """Test for utils module in app/utils.py"""
 
+import asyncio
+import hashlib
+from datetime import timedelta
+import http.server
+import socket
+import threading
+import time
 from unittest import mock
+import httpx
 import pytest
-from app.utils import url_info, detect_ssrf, resolve_ip, make_request
+from app import ssrf
+from app.ssrf import SSRFPolicy
+from app.scheduler import HostScheduler
+from app.settings import settings
+from app.utils import url_info, detect_ssrf, resolve_addresses, resolve_addresses_async, \
+    make_request, make_request_async, close_http_client, dns_cache, DNSCache
 from app.models.shared import JSONException
+from app.tests.conftest import addrinfo
 
 def test_url_info():
     """Test url_info function from utils.py module"""
@@ -18,24 +32,250 @@ def test_url_info():
         url_info("http://[2001::2/124]/]")
 
 
-def test_resolve_ip():
-    """Test resolve_ip function from utils.py module
+def test_resolve_addresses():
+    """Test resolve_addresses function from utils.py module
     
         First test: Test if raises JSONException when the domain is unresolvable
-        Second test: Test if returns the correct IP address when the domain is resolvable
+        Second test: Test if returns every IPv4 and IPv6 address when the domain is resolvable
     """
     with pytest.raises(JSONException):
-        resolve_ip("this.does.not.exists@")
+        resolve_addresses("this.does.not.exists@")
 
     with mock.patch('app.utils.socket') as mock_socket:
-        # Mock the gethostbyname function to return a valid IP address
-        mock_socket.gethostbyname.return_value = '192.168.0.1'
+        # Mock the getaddrinfo function to return valid IP addresses, each one once per protocol
+        mock_socket.getaddrinfo.return_value = addrinfo('192.168.0.1', '2001:db8::1', '192.168.0.1')
 
         # Test with a valid IP address input
-        assert resolve_ip('192.168.0.1') == '192.168.0.1'
+        assert resolve_addresses('192.168.0.1') == ('192.168.0.1',)
 
         # Test with a valid domain input
-        assert resolve_ip('example.com') == '192.168.0.1'
+        assert resolve_addresses('example.com') == ('192.168.0.1', '2001:db8::1')
+
+        # Test with a domain without addresses
+        mock_socket.getaddrinfo.return_value = []
+        with pytest.raises(JSONException):
+            resolve_addresses('empty.example.com')
+
+
+def test_resolve_addresses_cache():
+    """Test the DNS cache used by resolve_addresses and resolve_addresses_async
+
+        Resolutions and NXDOMAIN answers are cached, the cache is shared by the async path
+    """
+    with mock.patch('app.utils.socket.getaddrinfo') as mock_getaddrinfo:
+        mock_getaddrinfo.return_value = addrinfo('123.1.2.3')
+        assert resolve_addresses('Example.com') == ('123.1.2.3',)
+        assert resolve_addresses('example.com') == ('123.1.2.3',)
+        assert asyncio.run(resolve_addresses_async('example.com')) == ('123.1.2.3',)
+        assert mock_getaddrinfo.call_count == 1
+        assert dns_cache.stats() == {'size': 1, 'hits': 2, 'misses': 1}
+
+        mock_getaddrinfo.side_effect = socket.gaierror(
+            socket.EAI_NONAME, 'Name or service not known')
+        for _ in range(2):
+            with pytest.raises(JSONException):
+                asyncio.run(resolve_addresses_async('missing.example.com'))
+        assert mock_getaddrinfo.call_count == 2
+
+
+def test_dns_cache_eviction():
+    """Test DNSCache class from utils.py module
+
+        Test if entries expire after their TTL and the least recently used entry is evicted
+    """
+    cache = DNSCache(ttl=60, negative_ttl=0, max_size=2)
+    cache.set('a.com', ('1.1.1.1',))
+    cache.set('b.com', ('2.2.2.2',))
+    assert cache.get('a.com') == (True, ('1.1.1.1',))
+    cache.set('c.com', ('3.3.3.3',))
+    assert cache.get('b.com') == (False, None)
+    assert cache.get('a.com') == (True, ('1.1.1.1',))
+    cache.set('d.com', None)
+    assert cache.get('d.com') == (False, None)
+
+
+def test_make_request_async_pinned_address():
+    """Test make_request_async function from utils.py module
+
+        Test if the connection is opened to the IP addresses approved by the SSRF check,
+        in order until one of them answers
+    """
+    with mock.patch('app.utils.socket.getaddrinfo',
+                    return_value=addrinfo('2001:4860::1', '123.1.2.3')), \
+         mock.patch('app.utils.httpcore.AnyIOBackend.connect_tcp') as mock_connect_tcp:
+        mock_connect_tcp.side_effect = OSError('unreachable')
+
+        async def request():
+            try:
+                return await make_request_async('http://example.com:8080/', 'GET')
+            finally:
+                await close_http_client()
+
+        with pytest.raises(JSONException) as exc:
+            asyncio.run(request())
+        assert exc.value.id == 'REQUEST_EXCEPTION'
+        assert [call.args[:2] for call in mock_connect_tcp.call_args_list] == [
+            ('2001:4860::1', 8080), ('123.1.2.3', 8080)]
+
+
+def test_make_request_async_connection_reuse():
+    """Test make_request_async function from utils.py module
+
+        Test if the hops to the same origin reuse the pooled connection
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Redirects / to /home/ on the same connection"""
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Answer every GET request"""
+            self.send_response(301 if self.path == '/' else 200)
+            if self.path == '/':
+                self.send_header('Location', '/home/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    async def request():
+        try:
+            return await make_request_async(f'http://example.com:{server.server_port}/', 'GET')
+        finally:
+            await close_http_client()
+
+    try:
+        with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('127.0.0.1')), \
+             mock.patch.object(ssrf, 'default_policy', SSRFPolicy()):
+            result = asyncio.run(request())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    responses = result['data']['response']
+    assert [response['connection_reused'] for response in responses] == [False, True]
+    assert responses[0]['timings']['connect'] is not None
+    assert responses[1]['timings']['connect'] is None
+
+
+def test_make_request_idn_pinned_address():
+    """Test make_request and make_request_async functions from utils.py module
+
+        Test if the internationalized hosts are resolved and pinned IDNA-encoded, as they are
+        dialled, by both engines: the connection is opened to the approved address
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Answers 200 with the Host header of the request"""
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Answer every GET request"""
+            self.send_response(200)
+            self.send_header('X-Host', self.headers['Host'])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://bücher.example:{server.server_port}/'
+
+    async def request():
+        try:
+            return await make_request_async(url, 'GET', all_headers=True)
+        finally:
+            await close_http_client()
+
+    resolved = []
+    getaddrinfo = socket.getaddrinfo
+
+    def mocked_getaddrinfo(host, *args, **kwargs):
+        # The sockets of the sync engine are opened with getaddrinfo too, on the pinned address
+        resolved.append(host)
+        if host == 'xn--bcher-kva.example':
+            return addrinfo('127.0.0.1')
+        return getaddrinfo(host, *args, **kwargs)
+
+    try:
+        with mock.patch('app.utils.socket.getaddrinfo', side_effect=mocked_getaddrinfo), \
+             mock.patch.object(ssrf, 'default_policy', SSRFPolicy()):
+            results = [asyncio.run(request()), make_request(url, 'GET', all_headers=True)]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert set(resolved) <= {'xn--bcher-kva.example', '127.0.0.1'}
+    for result in results:
+        assert result['errors'] is None
+        assert result['data']['response'][0]['headers']['X-Host'].startswith(
+            'xn--bcher-kva.example:')
+
+
+def test_make_request_pinned_address():
+    """Test make_request function from utils.py module
+
+        Test if the sync engine only connects to the addresses approved by the SSRF check,
+        in order until one of them answers
+    """
+    with mock.patch('app.utils.socket.getaddrinfo',
+                    return_value=addrinfo('2001:4860::1', '123.1.2.3')), \
+         mock.patch('urllib3.util.connection.create_connection') as mock_create_connection:
+        mock_create_connection.side_effect = OSError('unreachable')
+
+        with pytest.raises(JSONException) as exc:
+            make_request('http://example.com:8080/', 'GET')
+        assert exc.value.id == 'REQUEST_EXCEPTION'
+        assert [call.args[0] for call in mock_create_connection.call_args_list] == [
+            ('2001:4860::1', 8080), ('123.1.2.3', 8080)]
+
+
+def test_make_request_slow_body():
+    """Test make_request function from utils.py module
+
+        Test if the sync engine stops reading a body sent slowly when the time budget of the
+        chain runs out, although every chunk arrives within the timeout of a socket operation
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Sends a byte of the body every 0.2 seconds"""
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Answer every GET request"""
+            self.send_response(200)
+            self.send_header('Content-Length', '10')
+            self.end_headers()
+            try:
+                for _ in range(10):
+                    self.wfile.write(b'x')
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except OSError:
+                pass
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    start = time.monotonic()
+    try:
+        with mock.patch.object(ssrf, 'default_policy', SSRFPolicy()), \
+             pytest.raises(JSONException) as error:
+            make_request(f'http://127.0.0.1:{server.server_port}/', 'GET', timeout=0.5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert error.value.id == 'REQUEST_TIMEOUT'
+    assert time.monotonic() - start < 1.5
 
 
 def test_detect_ssrf():
@@ -46,12 +286,24 @@ def test_detect_ssrf():
     """
     with mock.patch('app.utils.socket') as mock_socket:
         # Url is a local IP address
-        mock_socket.gethostbyname.return_value = '127.0.0.1'
+        mock_socket.getaddrinfo.return_value = addrinfo('127.0.0.1')
         assert detect_ssrf('http://example.com') is True
+        dns_cache.clear()
 
         # Url is not a local IP address
-        mock_socket.gethostbyname.return_value = '123.123.123.123'
+        mock_socket.getaddrinfo.return_value = addrinfo('123.123.123.123')
         assert detect_ssrf('http://example.com') is False
+        dns_cache.clear()
+
+        # Url has a public and a link-local IP address
+        mock_socket.getaddrinfo.return_value = addrinfo('123.123.123.123', 'fe80::1')
+        assert detect_ssrf('http://example.com') is True
+        dns_cache.clear()
+
+        # Internationalized hosts are resolved IDNA-encoded, like the engines dial them
+        mock_socket.getaddrinfo.return_value = addrinfo('123.123.123.123')
+        assert detect_ssrf('http://Bücher.example') is False
+        assert mock_socket.getaddrinfo.call_args.args[0] == 'xn--bcher-kva.example'
 
 
 @pytest.mark.parametrize("ssrf_cases", [
@@ -61,6 +313,8 @@ def test_detect_ssrf():
         "192.168.1.1"
         "0", "::", "0.0.0.0", "::1",
         "0:0:0:0:0:FFFF:7F00:0001",
+        "169.254.169.254", "100.64.0.1", "fe80::1", "fc00::1", "2002:7f00:1::",
+        "64:ff9b::a00:1",
     ])
 def test_detect_ssrf_true(ssrf_cases):
     """Test detect_ssrf function from utils.py module
@@ -68,14 +322,15 @@ def test_detect_ssrf_true(ssrf_cases):
         Test a list of possible private IP address / loopback address
     """
     with mock.patch('app.utils.socket') as mock_socket:
-        mock_socket.gethostbyname.return_value = ssrf_cases
+        mock_socket.getaddrinfo.return_value = addrinfo(ssrf_cases)
         assert detect_ssrf('http://example.com') is True
 
 
 @pytest.mark.parametrize("ssrf_cases", [
         "54.0.1.2",
         "123.1.2.3",
-        "8.8.8.8"
+        "8.8.8.8",
+        "2606:4700::1111", "::ffff:8.8.8.8",
     ])
 def test_detect_ssrf_false(ssrf_cases):
     """Test detect_ssrf function from utils.py module
@@ -83,7 +338,7 @@ def test_detect_ssrf_false(ssrf_cases):
         Test a list of possible public IP address
     """
     with mock.patch('app.utils.socket') as mock_socket:
-        mock_socket.gethostbyname.return_value = ssrf_cases
+        mock_socket.getaddrinfo.return_value = addrinfo(ssrf_cases)
         assert detect_ssrf('http://example.com') is False
 
 
@@ -92,18 +347,20 @@ def test_make_request():
     
         Test if returns the correct response when the request is successful
     """
-    with mock.patch('app.utils.detect_ssrf') as mock_detect_ssrf, \
-         mock.patch('app.utils.requests') as mock_requests:
-        mock_detect_ssrf.return_value = False
-
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock.patch('requests.Session.request') as mock_request:
         mock_response = mock.MagicMock()
         mock_response.status_code = 200
         mock_response.is_redirect = False
         mock_response.raw.version = 11
+        mock_response.elapsed = timedelta(milliseconds=50)
+        mock_response.raw.read1.return_value = b''
 
-        mock_requests.request.return_value = mock_response
+        mock_request.return_value = mock_response
 
-        assert make_request('http://example.com', 'GET', [], [], 0) == {
+        result = make_request('http://example.com', 'GET')
+        timings = result['data']['response'][0].pop('timings')
+        assert result == {
             'status': 200,
             'errors': None,
             'data': {
@@ -111,7 +368,8 @@ def test_make_request():
                     {
                         'http_version': 'HTTP/1.1',
                         'status_code': 200,
-                        'headers': {}
+                        'headers': {},
+                        'connection_reused': None
                     }
                 ],
                 'request': [
@@ -122,3 +380,132 @@ def test_make_request():
                 ]
             }
         }
+        assert timings['ttfb'] == 50
+        assert timings['total'] >= timings['dns']
+
+
+def test_make_request_async():
+    """Test make_request_async function from utils.py module
+
+        Test if follows the redirect chain using the shared async client
+    """
+    def handler(request):
+        if request.url.path == "/":
+            return httpx.Response(301, headers={"Location": "/home"})
+        return httpx.Response(200, headers={"Server": "nginx"})
+
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock.patch('app.utils.get_http_client', return_value=mock_client):
+
+        result = asyncio.run(make_request_async('http://example.com/', 'GET'))
+        timings = [response.pop('timings') for response in result['data']['response']]
+        assert result == {
+            'status': 200,
+            'errors': None,
+            'data': {
+                'response': [
+                    {
+                        'http_version': 'HTTP/1.1',
+                        'status_code': 301,
+                        'headers': {'Location': '/home'},
+                        'connection_reused': None
+                    },
+                    {
+                        'http_version': 'HTTP/1.1',
+                        'status_code': 200,
+                        'headers': {'Server': 'nginx'},
+                        'connection_reused': None
+                    }
+                ],
+                'request': [
+                    {
+                        'method': 'GET',
+                        'url': 'http://example.com/'
+                    },
+                    {
+                        'method': 'GET',
+                        'url': 'http://example.com/home'
+                    }
+                ]
+            }
+        }
+        for timing in timings:
+            assert timing['total'] >= timing['ttfb'] >= 0
+
+
+def test_make_request_async_time_budget():
+    """Test make_request_async function from utils.py module
+
+        Test if the time budget is shared by the whole redirect chain
+    """
+    async def handler(_):
+        await asyncio.sleep(0.05)
+        return httpx.Response(302, headers={"Location": "http://example.com/"})
+
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock.patch('app.utils.get_http_client', return_value=mock_client):
+
+        with pytest.raises(JSONException) as exc:
+            asyncio.run(make_request_async('http://example.com/', 'GET', timeout=0.12))
+        assert exc.value.id == 'REQUEST_TIMEOUT'
+
+
+def test_make_request_async_queue_timeout():
+    """Test make_request_async function from utils.py module
+
+        Test if a hop waiting for a busy host fails with HOST_QUEUE_TIMEOUT when the queue
+        timeout is reached first, and with REQUEST_TIMEOUT when the time budget is
+    """
+    scheduler = HostScheduler(rate=0, burst=1, host_concurrency=1, max_active=100)
+
+    async def request(timeout):
+        async with scheduler.slot('example.com', timeout=1):
+            await make_request_async('http://example.com/', 'GET', timeout=timeout)
+
+    with mock.patch('app.utils.host_scheduler', scheduler), \
+         mock.patch.dict(settings, {'HOST_QUEUE_TIMEOUT': 0.2}):
+        with pytest.raises(JSONException) as exc:
+            asyncio.run(request(0.05))
+        assert exc.value.id == 'REQUEST_TIMEOUT'
+
+        with pytest.raises(JSONException) as exc:
+            asyncio.run(request(5))
+        assert exc.value.id == 'HOST_QUEUE_TIMEOUT'
+
+
+def test_make_request_async_capture_body():
+    """Test make_request_async function from utils.py module
+
+        First test: Test if the digest, the length and the preview of the body are captured
+        Second test: Test if the body is truncated at max_body_bytes
+    """
+    body = b'a' * 3000
+
+    def handler(_):
+        return httpx.Response(200, content=body)
+
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with mock.patch('app.utils.socket.getaddrinfo', return_value=addrinfo('123.1.2.3')), \
+         mock.patch('app.utils.get_http_client', return_value=mock_client):
+
+        result = asyncio.run(make_request_async('http://example.com/', 'GET', capture_body=True))
+        assert result['data']['response'][0]['body'] == {
+            'sha256': hashlib.sha256(body).hexdigest(),
+            'length': 3000,
+            'truncated': False,
+            'preview': 'a' * 1024
+        }
+
+        result = asyncio.run(make_request_async(
+            'http://example.com/', 'GET', capture_body=True, max_body_bytes=2000))
+        assert result['data']['response'][0]['body'] == {
+            'sha256': hashlib.sha256(body[:2000]).hexdigest(),
+            'length': 2000,
+            'truncated': True,
+            'preview': 'a' * 1024
+        }
+
+        result = asyncio.run(make_request_async('http://example.com/', 'GET'))
+        assert 'body' not in result['data']['response'][0]
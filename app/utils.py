@@ -3,16 +3,102 @@ This module contains utility functions used by the API.
 
 Functions:
     url_info: Decompose an URL into its components.
-    resolve_ip: Resolve the given input to an IP address.
-    detect_ssrf: Detect if the given URL has an host that points to a private IP address.
+    resolve_addresses: Resolve the given input to its IPv4 and IPv6 addresses.
+    resolve_addresses_async: Same as resolve_addresses, without blocking the event loop.
+    detect_ssrf: Detect if the given URL has an host refused by the SSRF policies.
     make_request: Make a HTTP request to the given URL, follow redirects and return the responses.
+    make_request_async: Same as make_request, using the shared asynchronous HTTP client.
+    get_http_client: Return the shared asynchronous HTTP client.
+    close_http_client: Close the shared asynchronous HTTP client.
+    http_pool_stats: Return the open and idle connections of the shared asynchronous HTTP client.
+    analyse: Follow the redirect chain of the given URL and build the record to store.
+    analyse_or_error: Same as analyse, errors are returned as a record instead of being raised.
+    pending_record: Build the record of a request that will be performed in background.
 """
 
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hashlib
 import socket
 import ipaddress
-from urllib.parse import urlparse
-import requests
+import os
+import time
+from urllib.parse import urlparse, urljoin
+from uuid import uuid4
+import httpcore
+import httpx
+from app import headers, metrics, ssrf
+from app.models.database import RequestModel
 from app.models.shared import JSONException
+from app.scheduler import host_scheduler
+from app.settings import settings
+
+# Size of the chunks read from the response bodies
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Shared asynchronous HTTP client, created on first use, and its transport
+_http_client: httpx.AsyncClient | None = None
+_http_transport: '_PinnedTransport | None' = None
+
+
+class DNSCache:
+    """TTL and size bounded cache of DNS resolutions.
+
+    Every address of a domain is cached. Unresolvable domains (NXDOMAIN) are cached too,
+    with their own TTL.
+    When the cache is full the least recently used entry is evicted.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # host -> (expiration, addresses or None when the domain does not exist)
+        self._entries: OrderedDict[str, tuple[float, tuple[str, ...] | None]] = OrderedDict()
+
+    def get(self, host: str) -> tuple[bool, tuple[str, ...] | None]:
+        """Return (found, addresses) for the given host, addresses is None for a cached NXDOMAIN."""
+        entry = self._entries.get(host)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[host]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(host)
+        self.hits += 1
+        return True, entry[1]
+
+    def set(self, host: str, addresses: tuple[str, ...] | None) -> None:
+        """Store the resolution of the given host, addresses is None for a NXDOMAIN."""
+        ttl = self.ttl if addresses is not None else self.negative_ttl
+        self._entries[host] = (time.monotonic() + ttl, addresses)
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove every entry and reset the counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the size and the hit/miss counters of the cache."""
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# DNS resolutions shared by the SSRF check and the fetch
+dns_cache = DNSCache(
+    ttl=settings['DNS_CACHE_TTL'],
+    negative_ttl=settings['DNS_CACHE_NEGATIVE_TTL'],
+    max_size=settings['DNS_CACHE_MAX_SIZE']
+)
+
+# Pending asynchronous resolutions, concurrent lookups of the same host share them
+_pending_resolutions: dict[str, asyncio.Future] = {}
 
 
 def url_info(url: str) -> dict[str, str]:
@@ -42,8 +128,61 @@ def url_info(url: str) -> dict[str, str]:
     }
 
 
-def resolve_ip(ip: str) -> str:
-    """Resolve the given input to an IP address.
+def _invalid_domain_exception() -> JSONException:
+    """Return the exception raised when a domain can not be resolved."""
+    return JSONException(
+        id='INVALID_DOMAIN_RECORD',
+        detail='The domain url is pointing to an invalid IP address'
+    )
+
+
+def _cache_resolution_error(host: str, exc: socket.gaierror) -> None:
+    """Cache a failed resolution if the domain does not exist (NXDOMAIN)."""
+    if exc.errno == socket.EAI_NONAME:
+        dns_cache.set(host, None)
+
+
+def _lookup(host: str) -> tuple[str, ...]:
+    """Return every IPv4 and IPv6 address of the host, in the order given by the resolver."""
+    infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    return tuple(dict.fromkeys(info[4][0] for info in infos))
+
+
+def _ip_literal(host: str) -> tuple[str, ...] | None:
+    """Return the host itself if it is an IP address, None otherwise."""
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    return (host,)
+
+
+def _cached_addresses(host: str) -> tuple[bool, tuple[str, ...] | None]:
+    """Return (found, addresses) from the DNS cache.
+
+    Raises:
+        JSONException: If the domain is cached as not existing.
+    """
+    found, addresses = dns_cache.get(host)
+    if found and addresses is None:
+        raise _invalid_domain_exception()
+    return found, addresses
+
+
+def _store_resolution(host: str, addresses: tuple[str, ...]) -> tuple[str, ...]:
+    """Cache the addresses of the host and return them.
+
+    Raises:
+        JSONException: If the domain has no address.
+    """
+    if not addresses:
+        raise _invalid_domain_exception()
+    dns_cache.set(host, addresses)
+    return addresses
+
+
+def resolve_addresses(ip: str) -> tuple[str, ...]:
+    """Resolve the given input to its IPv4 and IPv6 addresses.
 
     Args:
         ip (str): Domain/host/IP to resolve
@@ -52,115 +191,723 @@ def resolve_ip(ip: str) -> str:
         JSONException: If the domain is pointing to an invalid IP address.
 
     Returns:
-        str: The resolved IP address.
+        tuple[str, ...]: Every resolved IP address.
     """
     # If the input is an IP, return it
+    literal = _ip_literal(ip)
+    if literal is not None:
+        return literal
+    host = ip.lower()
+    found, addresses = _cached_addresses(host)
+    if found:
+        return addresses
+    # Resolve the domain
+    try:
+        addresses = _lookup(host)
+    except socket.gaierror as exc:
+        _cache_resolution_error(host, exc)
+        raise _invalid_domain_exception() from exc
+    return _store_resolution(host, addresses)
+
+
+async def resolve_addresses_async(ip: str) -> tuple[str, ...]:
+    """Resolve the given input to its IPv4 and IPv6 addresses without blocking the event loop.
+
+    Args:
+        ip (str): Domain/host/IP to resolve
+
+    Raises:
+        JSONException: If the domain is pointing to an invalid IP address.
+
+    Returns:
+        tuple[str, ...]: Every resolved IP address.
+    """
+    # If the input is an IP, return it
+    literal = _ip_literal(ip)
+    if literal is not None:
+        return literal
+    host = ip.lower()
+    found, addresses = _cached_addresses(host)
+    if found:
+        return addresses
+    # Wait for the lookup already running for the same host, if any
+    pending = _pending_resolutions.get(host)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    # Resolve the domain in a worker thread
+    pending = asyncio.get_running_loop().create_future()
+    _pending_resolutions[host] = pending
     try:
-        _ = ipaddress.ip_address(ip)
-        return ip
-    except ValueError:
-        # Resolve the domain
         try:
-            return socket.gethostbyname(ip)
+            addresses = await asyncio.to_thread(_lookup, host)
         except socket.gaierror as exc:
-            raise JSONException(
-                id='INVALID_DOMAIN_RECORD',
-                detail='The domain url is pointing to an invalid IP address'
-            ) from exc
+            _cache_resolution_error(host, exc)
+            raise _invalid_domain_exception() from exc
+        addresses = _store_resolution(host, addresses)
+        pending.set_result(addresses)
+        return addresses
+    except Exception as exc:
+        pending.set_exception(exc)
+        # Mark the exception as retrieved when no other lookup is waiting for it
+        pending.exception()
+        raise
+    except BaseException:
+        pending.cancel()
+        raise
+    finally:
+        del _pending_resolutions[host]
+
 
+def detect_ssrf(url: str, tenant: str | None = None) -> bool:
+    """Detect if the given URL has an host refused by the SSRF policies.
 
-def detect_ssrf(url: str) -> bool:
-    """Detect if the given URL has an host that points to a private IP address.
+    Every address of the host is checked, see app/ssrf.py. The host is resolved and checked
+    like the engines do before a hop, IDNA-encoded.
 
     Args:
         url (str): The URL to check.
+        tenant (str | None, optional): The tenant whose policy is applied too.
 
     Returns:
-        bool: True if the URL has an host that points to a private IP address, False otherwise.
+        bool: True if the host or one of its addresses is refused, False otherwise.
     """
-    # Parse the URL and get the domain
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
-    # Check if the domain is an IP
-    ip = resolve_ip(domain)
-    if ip is None:
-        return False
-    # Check if IP is private
-    ip_object = ipaddress.ip_address(ip)
-    return ip_object.is_private
+    host = _pinned_host(url)
+    return not ssrf.allows(host, resolve_addresses(host), tenant)
+
+
+def _pinned_host(url: str) -> str:
+    """Return the host of the URL as dialled by the transports: lowercase and IDNA-encoded.
+
+    Raises:
+        JSONException: If the host is invalid.
+    """
+    try:
+        return httpx.URL(url).raw_host.decode('ascii').lower()
+    except httpx.InvalidURL as exc:
+        raise JSONException(
+            id='INVALID_URL', detail='The URL you provided is invalid') from exc
+
+
+def _approved_addresses(host: str, tenant: str | None) -> tuple[str, ...]:
+    """Resolve the given host and return its IP addresses if the SSRF policies allow them.
+
+    Raises:
+        JSONException: If the host or one of its addresses is refused.
+    """
+    addresses = resolve_addresses(host)
+    if not ssrf.allows(host, addresses, tenant):
+        raise _ssrf_exception()
+    return addresses
+
+
+async def _approved_addresses_async(host: str, tenant: str | None) -> tuple[str, ...]:
+    """Same as _approved_addresses, without blocking the event loop."""
+    addresses = await resolve_addresses_async(host)
+    if not ssrf.allows(host, addresses, tenant):
+        raise _ssrf_exception()
+    return addresses
+
+
+def _chain_deadline(timeout: float | None) -> float:
+    """Return the monotonic deadline of a redirect chain.
+
+    Args:
+        timeout (float | None): Time budget in seconds requested by the caller.
+                                Defaults to REQUEST_TIMEOUT, capped at REQUEST_TIMEOUT_MAX.
+
+    Returns:
+        float: The deadline, comparable with time.monotonic().
+    """
+    if timeout is None:
+        timeout = settings['REQUEST_TIMEOUT']
+    return time.monotonic() + min(timeout, settings['REQUEST_TIMEOUT_MAX'])
+
+
+def _remaining_time(deadline: float) -> float:
+    """Return the seconds left before the deadline of the redirect chain.
+
+    Raises:
+        JSONException: If the deadline is already expired.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _timeout_exception()
+    return remaining
+
+
+def _timeout_exception() -> JSONException:
+    """Return the exception raised when the redirect chain runs out of time."""
+    return JSONException(
+        id='REQUEST_TIMEOUT',
+        detail='The redirect chain did not complete within the time budget'
+    )
+
+
+def _elapsed_ms(start: float, end: float | None = None) -> float:
+    """Return the milliseconds elapsed between two time.perf_counter() values."""
+    if end is None:
+        end = time.perf_counter()
+    return round((end - start) * 1000, 3)
+
+
+def _header_policy(all_headers: bool) -> headers.HeaderPolicy:
+    """Return the policy capturing the headers of the responses, see app/headers.py."""
+    return headers.all_headers_policy if all_headers else headers.default_policy
+
+
+def _ssrf_exception() -> JSONException:
+    """Return the exception raised when an URL points to a refused host or address."""
+    return JSONException(
+        id='SSRF_DETECTED',
+        detail='The URL you provided points to a private or forbidden address. This is not allowed'
+    )
+
+
+def _chain_result(request_list: list, responses: list) -> dict:
+    """Return the result of a completed redirect chain in standard "HTTPResponse" format."""
+    return {
+        'status': 200,
+        'errors': None,
+        'data': {
+            'response': responses,
+            'request': request_list
+        }
+    }
+
+
+def _too_many_redirects() -> JSONException:
+    """Return the exception raised when the redirect chain is too long."""
+    return JSONException(id='TOO_MANY_REDIRECTS',
+                         detail='Too many redirects while following the url you provided')
+
+
+class _BodyReader:
+    """Consume a response body chunk by chunk, up to a maximum number of bytes.
+
+    When capturing, the SHA-256 and the length of the consumed bytes are computed while
+    streaming and only the first BODY_PREVIEW_BYTES are kept.
+    """
+
+    def __init__(self, capture: bool, max_bytes: int | None):
+        self.capture = capture
+        if not capture:
+            # Small bodies are read anyway, so that the connection can be reused
+            self.max_bytes = settings['BODY_DRAIN_BYTES']
+        elif max_bytes is None:
+            self.max_bytes = settings['BODY_MAX_BYTES']
+        else:
+            self.max_bytes = min(max_bytes, settings['BODY_MAX_BYTES'])
+        self.length = 0
+        self.truncated = False
+        self._digest = hashlib.sha256()
+        self._preview = bytearray()
+
+    def feed(self, chunk: bytes) -> bool:
+        """Consume a chunk of the body.
+
+        Returns:
+            bool: False when the maximum number of bytes is reached and the rest of the body
+                  must not be read.
+        """
+        if self.length + len(chunk) > self.max_bytes:
+            chunk = chunk[:self.max_bytes - self.length]
+            self.truncated = True
+        self.length += len(chunk)
+        if self.capture:
+            self._digest.update(chunk)
+            missing = settings['BODY_PREVIEW_BYTES'] - len(self._preview)
+            if missing > 0:
+                self._preview += chunk[:missing]
+        return not self.truncated
+
+    def result(self) -> dict:
+        """Return the digest, the length and the preview of the captured body."""
+        return {
+            'sha256': self._digest.hexdigest(),
+            'length': self.length,
+            'truncated': self.truncated,
+            'preview': self._preview.decode('utf-8', errors='replace')
+        }
 
 
 def make_request(
             url: str,
             method: str,
-            request_list: list,
-            responses: list,
-            redirect_count: int
+            timeout: float | None = None,
+            capture_body: bool = False,
+            max_body_bytes: int | None = None,
+            tenant: str | None = None,
+            all_headers: bool = False
         ) -> dict:
-    """Make a HTTP request to the given URL.
+    """Make a HTTP request to the given URL and follow the redirect chain.
 
     Args:
         url (str): URL to make the request to.
         method (str): HTTP method to use. Must be one of: post, get, put, delete, info.
-        request_list (list, optional): Previous history of performed request. Defaults to [].
-        responses (list, optional): Previous history of received responses. Defaults to [].
-        redirect_count (int, optional): Redirect counter.  Defaults to 0.
+        timeout (float | None, optional): Time budget in seconds for the whole redirect chain.
+                                          Defaults to REQUEST_TIMEOUT.
+        capture_body (bool, optional): Capture the digest and a preview of every body.
+        max_body_bytes (int | None, optional): Maximum bytes of a body to read when capturing.
+                                               Defaults to BODY_MAX_BYTES.
+        tenant (str | None, optional): The tenant whose SSRF policy is applied too.
+        all_headers (bool, optional): Capture every header instead of the configured ones.
 
     Returns:
         dict: Dict in standard "HTTPResponse" format. See app/models/api.py for more details.
     """
+    # Only the sync engine uses requests, it is not imported when the server starts
+    import requests  # pylint: disable=import-outside-toplevel
+    from urllib3.exceptions import ReadTimeoutError  # pylint: disable=import-outside-toplevel
+    from app.sync_transport import PinnedHTTPAdapter  # pylint: disable=import-outside-toplevel
 
-    # Detect SSRF
-    if detect_ssrf(url):
-        raise JSONException(
-            id='SSRF_DETECTED',
-            detail='The URL you provided is a private IP address. This is not allowed'
+    deadline = _chain_deadline(timeout)
+    request_list = []
+    responses = []
+    redirect_count = 0
+
+    # The hops share a session, so the hops to the same origin reuse its pooled connection.
+    # Like the async engine, its connections are opened to the addresses approved for the hop
+    with requests.Session() as session:
+        session.trust_env = False
+        session.mount('http://', PinnedHTTPAdapter())
+        session.mount('https://', PinnedHTTPAdapter())
+        while True:
+            remaining = _remaining_time(deadline)
+            hop_start = time.perf_counter()
+
+            # Detect SSRF, the DNS lookup is timed as part of the hop
+            host = _pinned_host(url)
+            ssrf.pinned_addresses.set({host: _approved_addresses(host, tenant)})
+            dns_time = _elapsed_ms(hop_start)
+
+            # Append the current request to the list of requests
+            request_list.append({
+                'method': method,
+                'url': url
+            })
+
+            try:
+                response = session.request(
+                    method, url, allow_redirects=False, timeout=remaining, stream=True)
+                # Stream the body, the connection is closed early when the body is too large.
+                # The timeout applies to every socket operation, so the deadline of the chain
+                # is checked on every chunk too: read1 returns the bytes received so far
+                body = _BodyReader(capture_body, max_body_bytes)
+                try:
+                    while chunk := response.raw.read1(BODY_CHUNK_SIZE, decode_content=True):
+                        _remaining_time(deadline)
+                        if not body.feed(chunk):
+                            break
+                finally:
+                    response.close()
+            except JSONException:
+                raise
+            except (requests.Timeout, ReadTimeoutError) as e:
+                raise _timeout_exception() from e
+            except Exception as e:
+                raise JSONException(
+                        id='REQUEST_EXCEPTION',
+                        detail=f'Generic request exception: {e}'
+                    ) from e
+
+            # If the response is a redirect and the redirect counter is too high, return an error
+            if response.is_redirect and redirect_count >= settings['MAX_REDIRECTS']:
+                raise _too_many_redirects()
+
+            # Append the current response to the list of responses
+            responses.append({
+                # urllib3 reports the version as an int, 11 for HTTP/1.1
+                'http_version': f'HTTP/{response.raw.version // 10}.{response.raw.version % 10}',
+                'status_code': response.status_code,
+                'headers': _header_policy(all_headers).capture(response.headers.items()),
+                'timings': {
+                    'queue': None,
+                    'dns': dns_time,
+                    'connect': None,
+                    'tls': None,
+                    'ttfb': round(response.elapsed.total_seconds() * 1000, 3),
+                    'total': _elapsed_ms(hop_start)
+                },
+                # urllib3 does not tell whether the pooled connection was reused
+                'connection_reused': None
+            })
+            if capture_body:
+                responses[-1]['body'] = body.result()
+
+            if not response.is_redirect:
+                return _chain_result(request_list, responses)
+
+            # If the response is a redirect, follow the redirected URL
+            redirect_count += 1
+            url = urljoin(url, response.headers['Location'])
+
+
+class _PinnedNetworkBackend(httpcore.AsyncNetworkBackend):
+    """Network backend that connects to the IP addresses approved by the SSRF check.
+
+    The approved addresses are set by the hop in the `ssrf.pinned_addresses` context variable,
+    keyed by the IDNA-encoded host, so a second DNS lookup can not point the connection
+    somewhere else (DNS rebinding). The sync engine is pinned too, see app/sync_transport.py.
+    They are tried in order until a connection succeeds.
+    Connections to hosts that were not approved are refused.
+    """
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None,
+                          socket_options=None) -> httpcore.AsyncNetworkStream:
+        addresses = ssrf.pinned_addresses.get({}).get(host.lower())
+        if not addresses:
+            raise httpcore.ConnectError(f'The address of {host} was not approved')
+        for ip in addresses[:-1]:
+            try:
+                return await self._backend.connect_tcp(
+                    ip, port, timeout=timeout, local_address=local_address,
+                    socket_options=socket_options
+                )
+            except (OSError, httpcore.ConnectError, httpcore.ConnectTimeout):
+                continue
+        return await self._backend.connect_tcp(
+            addresses[-1], port, timeout=timeout, local_address=local_address,
+            socket_options=socket_options
         )
 
-    # Append the current request to the list of requests
-    request_list.append({
-        'method': method,
-        'url': url
-    })
+    async def connect_unix_socket(self, path, timeout=None,
+                                  socket_options=None) -> httpcore.AsyncNetworkStream:
+        raise httpcore.ConnectError('Unix sockets are not allowed')
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+class _PinnedTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport whose connections are opened by _PinnedNetworkBackend."""
+
+    def __init__(self, limits: httpx.Limits, http2: bool = False):
+        super().__init__(limits=limits, trust_env=False, http2=http2)
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(trust_env=False, http2=http2),
+            http1=True,
+            http2=http2,
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_PinnedNetworkBackend()
+        )
+
+    @property
+    def pool(self) -> httpcore.AsyncConnectionPool:
+        """The connection pool of the transport."""
+        return self._pool
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared asynchronous HTTP client.
+
+    The client is created on first use and keeps a pool of keep-alive connections
+    for every origin, so consecutive requests to the same origin reuse the connection.
+    With HTTP2, the HTTPS origins supporting HTTP/2 share one multiplexed connection.
+
+    Returns:
+        httpx.AsyncClient: The shared client.
+    """
+    global _http_client, _http_transport  # pylint: disable=global-statement
+    if _http_client is None or _http_client.is_closed:
+        _http_transport = _PinnedTransport(httpx.Limits(
+            max_connections=settings['HTTP_MAX_CONNECTIONS'],
+            max_keepalive_connections=settings['HTTP_MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=settings['HTTP_KEEPALIVE_EXPIRY']
+        ), http2=settings['HTTP2'])
+        _http_client = httpx.AsyncClient(
+            follow_redirects=False,
+            timeout=10,
+            trust_env=False,
+            transport=_http_transport
+        )
+    return _http_client
+
+
+def http_pool_stats() -> dict[str, int]:
+    """Return the open connections of the shared client, the idle ones and the maximum."""
+    connections = [] if _http_transport is None else _http_transport.pool.connections
+    return {
+        'connections': len(connections),
+        'idle': sum(1 for connection in connections if connection.is_idle()),
+        'max_connections': settings['HTTP_MAX_CONNECTIONS']
+    }
+
+
+async def close_http_client() -> None:
+    """Close the shared asynchronous HTTP client and its connections."""
+    global _http_client, _http_transport  # pylint: disable=global-statement
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        _http_transport = None
+
+
+def _reset_after_fork() -> None:
+    """Forget the client and the pending resolutions inherited from the parent process,
+    they are bound to its sockets and event loop."""
+    global _http_client, _http_transport  # pylint: disable=global-statement
+    _http_client = None
+    _http_transport = None
+    _pending_resolutions.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def _fetch_async(
+            method: str,
+            url: str,
+            timeout: float,
+            body: _BodyReader,
+            tenant: str | None
+        ) -> tuple[httpx.Response, dict, bool | None]:
+    """Perform a single hop of the redirect chain with the shared asynchronous client.
+
+    Args:
+        method (str): HTTP method to use.
+        url (str): URL to make the request to.
+        timeout (float): Seconds left in the budget of the redirect chain.
+        body (_BodyReader): Consumes the body of the response.
+        tenant (str | None): The tenant whose SSRF policy is applied too.
+
+    Returns:
+        tuple[httpx.Response, dict, bool | None]: The response, the timings of the hop in
+                                                  milliseconds and whether a pooled connection
+                                                  was reused, None if the transport is not traced.
+    """
+    hop_start = time.perf_counter()
+    timings = {'queue': None, 'dns': None, 'connect': None, 'tls': None, 'ttfb': None,
+               'total': None}
+    started = {}
+
+    async def trace(event: str, _: dict) -> None:
+        # Events are named like "connection.connect_tcp.started"
+        now = time.perf_counter()
+        step, _, state = event.rpartition('.')
+        step = step.rpartition('.')[2]
+        if state == 'started':
+            started[step] = now
+        elif state == 'complete' and step in started:
+            if step == 'connect_tcp':
+                timings['connect'] = _elapsed_ms(started[step], now)
+            elif step == 'start_tls':
+                timings['tls'] = _elapsed_ms(started[step], now)
 
+    # Detect SSRF, the connection is then opened to the same IP addresses that were approved
+    host = _pinned_host(url)
+    ssrf.pinned_addresses.set({host: await _approved_addresses_async(host, tenant)})
+    timings['dns'] = _elapsed_ms(hop_start)
+
+    request_start = time.perf_counter()
+    client = get_http_client()
+    request = client.build_request(method, url, timeout=timeout, extensions={'trace': trace})
+    response = await client.send(request, stream=True)
     try:
-        response = requests.request(method, url, allow_redirects=False, timeout=10)
-    except Exception as e:
-        raise JSONException(
-                id='REQUEST_EXCEPTION',
-                detail=f'Generic request exception: {e}'
-            ) from e
-
-    # If the response is a redirect and the redirect counter is greater than 5, return an error
-    if response.is_redirect and redirect_count >= 10:
-        raise JSONException(id='TOO_MANY_REDIRECTS',
-                            detail='Too many redirects while following the url you provided')
-
-    # Filter the headers to keep only the ones we want to show
-    headers_to_keep = ['Content-Type',
-                       'Content-Length', 'Date', 'Server', 'Location']
-    filtered_headers = {key: value for key,
-                        value in response.headers.items() if key in headers_to_keep}
-
-    # Append the current response to the list of responses
-    responses.append({
-        'http_version': f'HTTP/{response.raw.version / 10}',
-        'status_code': response.status_code,
-        'headers': filtered_headers
-    })
-
-    # If the response is a redirect (3xx), call the function again with the redirected URL
-    if not response.is_redirect:
-        return {
-            'status': 200,
-            'errors': None,
-            'data': {
-                'response': responses,
-                'request': request_list
-            }
-        }
+        timings['ttfb'] = _elapsed_ms(request_start)
+        # Stream the body, the connection is closed early when the body is too large
+        async for chunk in response.aiter_bytes(BODY_CHUNK_SIZE):
+            if not body.feed(chunk):
+                break
+    finally:
+        await response.aclose()
+    timings['total'] = _elapsed_ms(hop_start)
+    # A new connection is opened with connect_tcp, a pooled one only sends the request
+    reused = 'connect_tcp' not in started if started else None
+    return response, timings, reused
+
+
+async def make_request_async(
+            url: str,
+            method: str,
+            timeout: float | None = None,
+            capture_body: bool = False,
+            max_body_bytes: int | None = None,
+            tenant: str | None = None,
+            all_headers: bool = False
+        ) -> dict:
+    """Make a HTTP request to the given URL using the shared asynchronous client
+    and follow the redirect chain.
+
+    Args:
+        url (str): URL to make the request to.
+        method (str): HTTP method to use. Must be one of: post, get, put, delete, info.
+        timeout (float | None, optional): Time budget in seconds for the whole redirect chain.
+                                          Defaults to REQUEST_TIMEOUT.
+        capture_body (bool, optional): Capture the digest and a preview of every body.
+        max_body_bytes (int | None, optional): Maximum bytes of a body to read when capturing.
+                                               Defaults to BODY_MAX_BYTES.
+        tenant (str | None, optional): The tenant whose SSRF policy is applied too.
+        all_headers (bool, optional): Capture every header instead of the configured ones.
+
+    Returns:
+        dict: Dict in standard "HTTPResponse" format. See app/models/api.py for more details.
+    """
+    deadline = _chain_deadline(timeout)
+    request_list = []
+    responses = []
+    redirect_count = 0
+
+    while True:
+        remaining = _remaining_time(deadline)
+
+        # Append the current request to the list of requests
+        request_list.append({
+            'method': method,
+            'url': url
+        })
+
+        body = _BodyReader(capture_body, max_body_bytes)
+        queue_start = time.perf_counter()
+        budget_bound = remaining < settings['HOST_QUEUE_TIMEOUT']
+        try:
+            # Wait for a slot of the target host, see app/scheduler.py
+            async with host_scheduler.slot(urlparse(url).hostname or '',
+                                           min(remaining, settings['HOST_QUEUE_TIMEOUT'])):
+                queued = _elapsed_ms(queue_start)
+                remaining = _remaining_time(deadline)
+                response, timings, reused = await asyncio.wait_for(
+                    _fetch_async(method, url, remaining, body, tenant), remaining)
+            timings['queue'] = queued
+        except JSONException as e:
+            # The wait was cut short by the time budget of the chain, not by the queue
+            if e.id == 'HOST_QUEUE_TIMEOUT' and budget_bound:
+                raise _timeout_exception() from e
+            raise
+        except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+            raise _timeout_exception() from e
+        except Exception as e:
+            raise JSONException(
+                    id='REQUEST_EXCEPTION',
+                    detail=f'Generic request exception: {e}'
+                ) from e
+
+        # If the response is a redirect and the redirect counter is too high, return an error
+        if response.is_redirect and redirect_count >= settings['MAX_REDIRECTS']:
+            raise _too_many_redirects()
+
+        # Append the current response to the list of responses
+        responses.append({
+            'http_version': response.http_version,
+            'status_code': response.status_code,
+            'headers': _header_policy(all_headers).capture(
+                (key.decode('latin-1'), value.decode('latin-1'))
+                for key, value in response.headers.raw
+            ),
+            'timings': timings,
+            'connection_reused': reused
+        })
+        if capture_body:
+            responses[-1]['body'] = body.result()
+
+        if not response.is_redirect:
+            return _chain_result(request_list, responses)
 
-    # If the response is a redirect, call the function again with the redirected URL
-    redirect_count += 1
-    redirected_url = response.headers['Location']
-    return make_request(redirected_url, method, request_list, responses, redirect_count)
+        # If the response is a redirect, follow the redirected URL
+        redirect_count += 1
+        url = urljoin(url, response.headers['Location'])
+
+
+def _observe_chain(responses: list[dict]) -> None:
+    """Record the redirect depth and the timings of every hop of a completed chain."""
+    metrics.REDIRECT_DEPTH.observe(len(responses) - 1)
+    for response in responses:
+        timings = response['timings']
+        if timings['queue'] is not None:
+            metrics.PHASE_QUEUE.observe(timings['queue'] / 1000)
+        metrics.PHASE_DNS.observe(timings['dns'] / 1000)
+        metrics.PHASE_FETCH.observe((timings['total'] - timings['dns']) / 1000)
+        # Connect and TLS are missing when a pooled connection is reused
+        if timings['connect'] is not None:
+            metrics.PHASE_CONNECT.observe(timings['connect'] / 1000)
+        if timings['tls'] is not None:
+            metrics.PHASE_TLS.observe(timings['tls'] / 1000)
+        if response['connection_reused'] is not None:
+            (metrics.HOP_CONNECTIONS_REUSED if response['connection_reused']
+             else metrics.HOP_CONNECTIONS_NEW).inc()
+
+
+def _now() -> datetime:
+    """Return the current UTC time, truncated to the milliseconds stored by MongoDb."""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+async def analyse(
+            url: str,
+            method: str,
+            timeout: float | None = None,
+            capture_body: bool = False,
+            max_body_bytes: int | None = None,
+            tenant: str | None = None,
+            all_headers: bool = False
+        ) -> RequestModel:
+    """Follow the redirect chain of the given URL and build the record to store.
+
+    Args:
+        url (str): URL to make the request to.
+        method (str): HTTP method to use.
+        timeout (float | None, optional): Time budget in seconds for the whole redirect chain.
+        capture_body (bool, optional): Capture the digest and a preview of every body.
+        max_body_bytes (int | None, optional): Maximum bytes of a body to read when capturing.
+        tenant (str | None, optional): The tenant whose SSRF policy is applied too.
+        all_headers (bool, optional): Capture every header instead of the configured ones.
+
+    Raises:
+        JSONException: If the redirect chain can not be followed.
+
+    Returns:
+        RequestModel: The new record, not stored yet.
+    """
+    # Make the request. The sync engine is kept for benchmarking and runs in a worker thread
+    with metrics.CHAINS_IN_FLIGHT.track(), metrics.PHASE_CHAIN.time():
+        if settings['REQUEST_ENGINE'] == 'sync':
+            response_and_request = await asyncio.to_thread(
+                make_request, url, method, timeout, capture_body, max_body_bytes, tenant,
+                all_headers)
+        else:
+            response_and_request = await make_request_async(
+                url, method, timeout, capture_body, max_body_bytes, tenant, all_headers)
+    _observe_chain(response_and_request['data']['response'])
+    # Decompose the URL, see models/api.py
+    url_analysis = {'url': url_info(url)}
+    # If there are no errors, merge the URL analysis with the response and request data
+    if response_and_request['errors'] is None:
+        response_and_request['data'] = url_analysis | response_and_request['data']
+    return RequestModel(
+        **response_and_request | {'_id': str(uuid4()), 'created_at': _now()})
+
+
+def pending_record() -> RequestModel:
+    """Build the record of a request that will be performed in background.
+
+    Returns:
+        RequestModel: The new record, in the "pending" state, not stored yet.
+    """
+    return RequestModel(
+        _id=str(uuid4()),
+        created_at=_now(),
+        state='pending',
+        status=202,
+        errors=None,
+        data=None
+    )
+
+
+async def analyse_or_error(url: str, method: str, *args, **kwargs) -> RequestModel:
+    """Same as analyse, errors are returned as a record instead of being raised."""
+    try:
+        return await analyse(url, method, *args, **kwargs)
+    except JSONException as exc:
+        metrics.ERRORS.labels(exc.id).inc()
+        return RequestModel(
+            _id=str(uuid4()),
+            created_at=_now(),
+            status=500,
+            errors={'id': exc.id, 'detail': exc.detail},
+            data=None
+        )
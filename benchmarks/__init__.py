@@ -0,0 +1 @@
+"""Benchmarks of the API, run them from the root of the repository with python -m."""
@@ -0,0 +1,40 @@
+"""
+Run the API for the load benchmark: MongoDb is replaced by the in-memory stand-in and the
+SSRF policy only allows the loopback addresses of the local target server.
+
+Usage:
+    python -m benchmarks.api [port]
+"""
+
+import os
+import sys
+
+# The database configuration is read when the API is imported, the values are not used
+for variable in ('MONGO_HOST', 'MONGO_USERNAME', 'MONGO_PASSWORD', 'MONGO_DB_NAME'):
+    os.environ.setdefault(variable, 'benchmark')
+# Every request goes to the same local target, the politeness limits would be the bottleneck
+os.environ.setdefault('HOST_RATE', '0')
+os.environ.setdefault('HOST_CONCURRENCY', '1000')
+# The target server is reached as "localhost", every other address is refused
+os.environ.setdefault('SSRF_DENY', '0.0.0.0/0,::/0')
+os.environ.setdefault('SSRF_ALLOW', '127.0.0.0/8,::1/128')
+os.environ.setdefault('SSRF_DENY_HOSTS', '')
+
+# pylint: disable=wrong-import-position
+import uvicorn
+from app import database
+from app.main import app
+from benchmarks.memorydb import MemoryDatabase
+
+
+def run(port: int) -> None:
+    """Serve the API on 127.0.0.1 with an in-memory database."""
+    memory_db = MemoryDatabase()
+    app.dependency_overrides[database.get_db] = lambda: memory_db
+    # Used by database.startup() to create the indexes
+    database.get_db = lambda: memory_db
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -0,0 +1,179 @@
+"""
+Load benchmark of POST /api/HTTP/{method}, against a local target server.
+
+The target server (benchmarks.target) and the API (benchmarks.api, with an in-memory database)
+are started as subprocesses on free ports. Every scenario is then driven at each concurrency
+level and the throughput and the latency percentiles are printed as JSON, to be compared
+between commits.
+
+Scenarios:
+    status:    a single 200 response.
+    redirects: a chain of 5 redirects.
+    delay:     a 50 ms slow response.
+    large:     a 1 MiB body, captured with its digest.
+    drip:      a body sent in 10 chunks, 20 ms apart.
+
+Usage:
+    python -m benchmarks.load [--requests N] [--concurrency 1,10,50] [--scenarios status,delay]
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import socket
+import subprocess
+import sys
+import time
+import httpx
+
+# Path on the target server and options of the request of every scenario
+SCENARIOS = {
+    'status': ('/status/200', {}),
+    'redirects': ('/redirect/5', {}),
+    'delay': ('/delay/50', {}),
+    'large': (f'/bytes/{1024 * 1024}', {'capture_body': True}),
+    'drip': ('/drip/10?delay_ms=20', {}),
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start(module: str, port: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, '-m', module, str(port)])
+
+
+async def _wait_ready(url: str, timeout: float = 30) -> None:
+    """Wait until the given URL responds, the servers take a moment to start."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+def _percentile(sorted_values: list[float], percent: float) -> float:
+    """Return the nearest-rank percentile of already sorted values."""
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(
+            client: httpx.AsyncClient,
+            api_url: str,
+            body: dict,
+            requests: int,
+            concurrency: int
+        ) -> dict:
+    """Send the same request with the given concurrency and measure every response.
+
+    Args:
+        client (httpx.AsyncClient): Client used to call the API.
+        api_url (str): URL of POST /api/HTTP/GET.
+        body (dict): Body of the requests.
+        requests (int): Number of requests to send.
+        concurrency (int): Number of requests in flight at the same time.
+
+    Returns:
+        dict: Throughput in requests per second, error count and latency percentiles in ms.
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.post(api_url, json=body)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200 or response.json()['status'] != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 1),
+        'latency_ms': {
+            'p50': round(_percentile(latencies, 50), 2),
+            'p95': round(_percentile(latencies, 95), 2),
+            'p99': round(_percentile(latencies, 99), 2),
+            'max': round(latencies[-1], 2),
+        }
+    }
+
+
+async def run(scenarios: list[str], concurrencies: list[int], requests: int) -> dict:
+    """Start the servers, run every scenario at every concurrency level and stop the servers."""
+    target_port, api_port = _free_port(), _free_port()
+    processes = [_start('benchmarks.target', target_port), _start('benchmarks.api', api_port)]
+    try:
+        target_url = f'http://localhost:{target_port}'
+        api_url = f'http://127.0.0.1:{api_port}/api/HTTP/GET'
+        await _wait_ready(f'{target_url}/status/200')
+        await _wait_ready(f'http://127.0.0.1:{api_port}/metrics')
+
+        results = []
+        limits = httpx.Limits(max_connections=max(concurrencies))
+        async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+            for scenario in scenarios:
+                path, options = SCENARIOS[scenario]
+                body = {'url': target_url + path, **options}
+                # Warm up the connections and the caches of the API
+                await drive(client, api_url, body, requests=min(requests, 20), concurrency=1)
+                for concurrency in concurrencies:
+                    results.append({'scenario': scenario} | await drive(
+                        client, api_url, body, requests, concurrency))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario and concurrency level')
+    parser.add_argument('--concurrency', default='1,10,50',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma separated scenarios among {", ".join(SCENARIOS)}')
+    args = parser.parse_args()
+    report = asyncio.run(run(
+        scenarios=args.scenarios.split(','),
+        concurrencies=[int(level) for level in args.concurrency.split(',')],
+        requests=args.requests
+    ))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
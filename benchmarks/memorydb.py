@@ -0,0 +1,239 @@
+"""
+In-memory stand-in of the MongoDb database used by the load benchmark.
+
+Only the subset of the Motor API used by the API is implemented, so that the benchmark
+measures the API and not the database.
+"""
+
+import copy
+from typing import Any
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import UpdateResult
+
+
+def _get_path(document: dict, path: str) -> Any:
+    """Return the value of a dotted path of the document, None if missing."""
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+# Comparison operators of the queries
+OPERATORS = {
+    '$ne': lambda value, operand: value != operand,
+    '$lt': lambda value, operand: value is not None and value < operand,
+    '$lte': lambda value, operand: value is not None and value <= operand,
+    '$gt': lambda value, operand: value is not None and value > operand,
+    '$gte': lambda value, operand: value is not None and value >= operand,
+    '$in': lambda value, operand: value in operand,
+    '$exists': lambda value, operand: (value is not None) == operand,
+}
+
+
+def _matches_condition(value: Any, condition: Any) -> bool:
+    """Return True if the value matches an equality condition or a dict of operators."""
+    if isinstance(condition, dict) and condition and all(key in OPERATORS for key in condition):
+        return all(OPERATORS[key](value, operand) for key, operand in condition.items())
+    return value == condition
+
+
+def _matches(document: dict, query: dict) -> bool:
+    """Return True if the document matches a query of conditions, "$or" and "$and"."""
+    for path, condition in query.items():
+        if path == '$or':
+            if not any(_matches(document, subquery) for subquery in condition):
+                return False
+        elif path == '$and':
+            if not all(_matches(document, subquery) for subquery in condition):
+                return False
+        elif not _matches_condition(_get_path(document, path), condition):
+            return False
+    return True
+
+
+def _set_path(document: dict, path: str, value: Any) -> None:
+    """Set the value of a dotted path of the document, creating the missing subdocuments."""
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def _unset_path(document: dict, path: str) -> None:
+    """Remove a dotted path of the document, if present."""
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+def _apply_update(document: dict, update: dict, inserting: bool) -> None:
+    """Apply the $set, $unset, $inc, $max and, when inserting, $setOnInsert operators of an
+    update."""
+    for path in update.get('$unset', {}):
+        _unset_path(document, path)
+    for path, value in update.get('$set', {}).items():
+        _set_path(document, path, copy.deepcopy(value))
+    for path, value in update.get('$inc', {}).items():
+        _set_path(document, path, (_get_path(document, path) or 0) + value)
+    for path, value in update.get('$max', {}).items():
+        current = _get_path(document, path)
+        if current is None or value > current:
+            _set_path(document, path, value)
+    if inserting:
+        for path, value in update.get('$setOnInsert', {}).items():
+            _set_path(document, path, copy.deepcopy(value))
+
+
+def _project(document: dict, projection: dict | None) -> dict:
+    """Return a copy of the document with only the included dotted paths, and _id."""
+    if not projection:
+        return copy.deepcopy(document)
+    projected = {'_id': document['_id']}
+    for path in projection:
+        value, target = document, projected
+        parts = path.split('.')
+        for part in parts[:-1]:
+            value = value.get(part) if isinstance(value, dict) else None
+            if not isinstance(value, dict):
+                break
+            target = target.setdefault(part, {})
+        else:
+            if isinstance(value, dict) and parts[-1] in value:
+                target[parts[-1]] = copy.deepcopy(value[parts[-1]])
+    return projected
+
+
+class MemoryCursor:
+    """Asynchronous cursor over a snapshot of the matching documents."""
+
+    def __init__(self, documents: list[dict]):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._documents)
+        except StopIteration as exc:
+            raise StopAsyncIteration from exc
+
+    async def close(self) -> None:
+        """Release the cursor, nothing to do in memory."""
+
+
+class MemoryCollection:
+    """Collection keeping copies of the documents in a dict keyed by _id."""
+
+    def __init__(self, database: 'MemoryDatabase', name: str):
+        self.database = database
+        self.name = name
+        self.full_name = f'{database.name}.{name}'
+        self.documents: dict[Any, dict] = {}
+
+    async def create_index(self, keys, **_) -> str:
+        """Indexes are not needed in memory."""
+        return '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+    async def insert_one(self, document: dict) -> None:
+        """Store a copy of the document."""
+        self.documents[document['_id']] = copy.deepcopy(document)
+
+    async def insert_many(self, documents: list[dict], ordered: bool = True) -> None:  # pylint: disable=unused-argument
+        """Store a copy of every document."""
+        for document in documents:
+            await self.insert_one(document)
+
+    async def replace_one(self, query: dict, document: dict, upsert: bool = False) -> None:
+        """Replace the first matching document, or insert it when upserting."""
+        for key, existing in self.documents.items():
+            if _matches(existing, query):
+                self.documents[key] = copy.deepcopy(document)
+                return
+        if upsert:
+            await self.insert_one(document)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        """Update the first matching document, or insert a new one when upserting."""
+        for existing in self.documents.values():
+            if _matches(existing, query):
+                _apply_update(existing, update, inserting=False)
+                return UpdateResult({'n': 1, 'nModified': 1}, acknowledged=True)
+        if upsert:
+            # Equality conditions of the query are fields of the new document
+            document = {path: value for path, value in query.items()
+                        if not path.startswith('$') and not isinstance(value, dict)}
+            _apply_update(document, update, inserting=True)
+            document.setdefault('_id', str(len(self.documents)))
+            if document['_id'] in self.documents:
+                raise DuplicateKeyError(f'Duplicate _id {document["_id"]}')
+            self.documents[document['_id']] = document
+            return UpdateResult({'n': 1, 'nModified': 0, 'upserted': document['_id']},
+                                acknowledged=True)
+        return UpdateResult({'n': 0, 'nModified': 0}, acknowledged=True)
+
+    async def update_many(self, query: dict, update: dict) -> None:
+        """Update every matching document."""
+        for existing in self.documents.values():
+            if _matches(existing, query):
+                _apply_update(existing, update, inserting=False)
+
+    async def bulk_write(self, requests: list, ordered: bool = True) -> None:  # pylint: disable=unused-argument
+        """Apply every pymongo.UpdateOne of the list."""
+        for request in requests:
+            # pylint: disable=protected-access
+            await self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+
+    async def find_one(self, query: dict) -> dict | None:
+        """Return a copy of the first matching document."""
+        if set(query) == {'_id'}:
+            document = self.documents.get(query['_id'])
+            return copy.deepcopy(document)
+        for document in self.documents.values():
+            if _matches(document, query):
+                return copy.deepcopy(document)
+        return None
+
+    def find(
+                self,
+                query: dict | None = None,
+                projection: dict | None = None,
+                sort: list[tuple[str, int]] | None = None,
+                limit: int = 0,
+                **_
+            ) -> MemoryCursor:
+        """Return a cursor over copies of the matching documents."""
+        documents = [document for document in self.documents.values()
+                     if _matches(document, query or {})]
+        # Sort by the last key first, sorts are stable. Missing values sort first, like null
+        for path, direction in reversed(sort or []):
+            documents.sort(key=lambda document, path=path: (
+                               _get_path(document, path) is not None, _get_path(document, path)),
+                           reverse=direction < 0)
+        if limit:
+            documents = documents[:limit]
+        return MemoryCursor([_project(document, projection) for document in documents])
+
+
+class MemoryDatabase:
+    """Database creating its collections on first access, like Motor does."""
+
+    def __init__(self, name: str = 'benchmark'):
+        self.name = name
+        self._collections: dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
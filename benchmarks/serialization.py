@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the serialization of a new result in POST /api/HTTP/{method}.
+
+    before: the record is validated, dumped for MongoDb, then validated and serialized
+            again by FastAPI through the response_model.
+    after:  the record is validated once, dumped for MongoDb and encoded once, the encoded
+            bytes are returned as a raw Response (and cached for later views).
+
+Usage:
+    python -m benchmarks.serialization [iterations]
+"""
+
+import asyncio
+import json
+import sys
+import time
+from uuid import uuid4
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from app.models.database import RequestModel
+
+
+def sample_result() -> dict:
+    """Return a result of a redirect chain with three hops, as built by app.utils.analyse"""
+    hops = [
+        ('http://google.com/', 301, {'Location': 'https://google.com/'}),
+        ('https://google.com/', 301, {'Location': 'https://www.google.com/'}),
+        ('https://www.google.com/', 200, {}),
+    ]
+    return {
+        '_id': str(uuid4()),
+        'created_at': '2023-11-20T10:00:00.123Z',
+        'status': 200,
+        'errors': None,
+        'data': {
+            'url': {'url': hops[0][0], 'protocol': 'http', 'domain': 'google.com', 'path': '/'},
+            'request': [{'method': 'GET', 'url': url} for url, _, _ in hops],
+            'response': [{
+                'http_version': 'HTTP/1.1',
+                'status_code': status_code,
+                'headers': {
+                    'Content-Type': 'text/html; charset=UTF-8',
+                    'Content-Length': '220',
+                    'Date': 'Mon, 20 Nov 2023 10:00:00 GMT',
+                    'Server': 'gws',
+                } | headers,
+                'timings': {'dns': 1.2, 'connect': 10.4, 'tls': 20.1, 'ttfb': 45.3, 'total': 46.0}
+            } for _, status_code, headers in hops]
+        }
+    }
+
+
+async def before(result: dict, field) -> bytes:
+    """Serialization path used before: the response_model validates the record again"""
+    record = RequestModel(**result)
+    _ = record.model_dump(by_alias=True)
+    content = await serialize_response(field=field, response_content=record, by_alias=True)
+    return JSONResponse(content).body
+
+
+async def after(result: dict) -> bytes:
+    """Serialization path used now: the record is validated and encoded once"""
+    record = RequestModel(**result)
+    _ = record.to_document()
+    return Response(record.model_dump_json(by_alias=True), media_type='application/json').body
+
+
+async def measure(iterations: int) -> dict:
+    """Return the CPU time per request of both paths, in microseconds"""
+    result = sample_result()
+    field = create_response_field(name='Response_perform_a_request', type_=RequestModel)
+    timings = {}
+    for name, path in (('before', lambda: before(result, field)), ('after', lambda: after(result))):
+        # Warm up
+        for _ in range(100):
+            await path()
+        start = time.process_time()
+        for _ in range(iterations):
+            await path()
+        timings[name] = round((time.process_time() - start) / iterations * 1e6, 2)
+    return {
+        'iterations': iterations,
+        'before_us_per_request': timings['before'],
+        'after_us_per_request': timings['after'],
+        'speedup': round(timings['before'] / timings['after'], 2)
+    }
+
+
+if __name__ == '__main__':
+    results = asyncio.run(measure(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,74 @@
+"""
+Local HTTP target server of the load benchmark, a stand-in for the websites analysed by the API.
+
+Endpoints:
+    /status/{code}: Respond with the given status code and an empty body.
+    /redirect/{hops}: Redirect {hops} times before responding 200.
+    /delay/{ms}: Respond 200 after {ms} milliseconds.
+    /bytes/{size}: Respond with a body of {size} bytes.
+    /drip/{chunks}?delay_ms=: Send {chunks} chunks of 1 KiB, waiting delay_ms before each one.
+
+Usage:
+    python -m benchmarks.target [port]
+"""
+
+import asyncio
+import sys
+from fastapi import FastAPI
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+import uvicorn
+
+app = FastAPI(openapi_url=None)
+
+# Chunk of the large and the slow-drip bodies
+CHUNK = b'x' * 1024
+
+
+@app.api_route("/status/{code}", methods=["GET", "HEAD", "POST", "PUT", "DELETE"])
+async def status(code: int):
+    """Respond with the given status code and an empty body."""
+    return Response(status_code=code)
+
+
+@app.api_route("/redirect/{hops}", methods=["GET", "HEAD"])
+async def redirect(hops: int):
+    """Redirect {hops} times before responding 200, with relative Location headers."""
+    if hops <= 0:
+        return Response(status_code=200)
+    return RedirectResponse(f'/redirect/{hops - 1}', status_code=302)
+
+
+@app.api_route("/delay/{ms}", methods=["GET", "HEAD"])
+async def delay(ms: int):
+    """Respond 200 after {ms} milliseconds."""
+    await asyncio.sleep(ms / 1000)
+    return Response(status_code=200)
+
+
+@app.api_route("/bytes/{size}", methods=["GET"])
+async def large_body(size: int):
+    """Respond with a body of {size} bytes, streamed in chunks of 1 KiB."""
+    async def chunks():
+        for offset in range(0, size, len(CHUNK)):
+            yield CHUNK[:size - offset]
+    return StreamingResponse(chunks(), headers={'Content-Length': str(size)},
+                             media_type='application/octet-stream')
+
+
+@app.api_route("/drip/{chunks}", methods=["GET"])
+async def drip(chunks: int, delay_ms: int = 10):
+    """Send {chunks} chunks of 1 KiB, waiting delay_ms milliseconds before each one."""
+    async def slow_chunks():
+        for _ in range(chunks):
+            await asyncio.sleep(delay_ms / 1000)
+            yield CHUNK
+    return StreamingResponse(slow_chunks(), media_type='application/octet-stream')
+
+
+def run(port: int) -> None:
+    """Serve the target on 127.0.0.1."""
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8081)